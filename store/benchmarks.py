@@ -0,0 +1,365 @@
+'''
+Benchmarks for the pricing engine.
+
+The suite generates a synthetic catalogue, carts and a mixed offer set at a
+configurable scale, times each stage of pricing, and writes the results as
+JSON so they can be compared between releases. Run from the store directory:
+
+    python benchmarks.py --products 100000 --carts 1000 --output results.json
+
+Pass --scaling to also measure how lookups, offer indexing and store memory
+scale with catalogue and offer set size, and the memory used per cart line
+and offer.
+'''
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import tempfile
+import timeit
+import tracemalloc
+from decimal import Decimal
+
+from cache import OfferResultCache
+from cart import Cart, CartItem, carts_from_records
+from compiled import MinorUnitPricingTable, PricingTable
+from offers import DependentDiscountOffer, MultiBuyOffer, NoOffer, OfferBook
+from product import CompactProductStore, ProductStore
+
+
+def synthetic_products(count):
+    '''Return a list of count (product_name, price) tuples.'''
+    return list(iter_synthetic_products(count))
+
+
+def iter_synthetic_products(count):
+    '''Yield count (product_name, price) tuples.'''
+    for i in range(count):
+        yield 'product-{0}'.format(i), Decimal(i % 1000) / 100
+
+
+def synthetic_catalogue(count, rng):
+    '''Return a list of count (product_name, price) tuples with random prices
+    between 0.05 and 20.00.'''
+    return [('product-{0}'.format(i), Decimal(rng.randint(5, 2000)) / 100)
+            for i in range(count)]
+
+
+def synthetic_offers(product_names, count, rng):
+    '''Return a list of count offers on random products, split evenly
+    between MultiBuyOffer, DependentDiscountOffer and NoOffer.'''
+    offers = []
+    for i in range(count):
+        target_product = rng.choice(product_names)
+        kind = i % 3
+        if kind == 0:
+            offers.append(MultiBuyOffer(
+                target_product, rng.randint(1, 5), rng.randint(1, 2)))
+        elif kind == 1:
+            offers.append(DependentDiscountOffer(
+                target_product, rng.choice(product_names),
+                Decimal(rng.randint(5, 50)) / 100))
+        else:
+            offers.append(NoOffer(target_product))
+    return offers
+
+
+def synthetic_cart_lines(product_names, carts, lines, rng):
+    '''Return carts lists of lines (product_name, quantity) tuples.'''
+    return [[(rng.choice(product_names), rng.randint(1, 10)) for _ in range(lines)]
+            for _ in range(carts)]
+
+
+def _timing(name, function, operations, repeat):
+    '''Return a result dict for the best of repeat runs of function, which
+    performs operations operations per run.'''
+    seconds = min(timeit.Timer(function).repeat(repeat=repeat, number=1))
+    return {
+        'name': name,
+        'operations': operations,
+        'seconds': seconds,
+        'ns_per_operation': seconds * 1e9 / max(operations, 1),
+    }
+
+
+def run_suite(products=10000, carts=1000, lines=20, offers=3000, seed=0, repeat=3):
+    '''Return a list of result dicts timing each stage of pricing.'''
+    rng = random.Random(seed)
+    catalogue = synthetic_catalogue(products, rng)
+    product_names = [product_name for product_name, _ in catalogue]
+    offer_list = synthetic_offers(product_names, offers, rng)
+    offer_book = OfferBook(offer_list)
+    cart_lines = synthetic_cart_lines(product_names, carts, lines, rng)
+    line_count = sum(len(lines) for lines in cart_lines)
+    results = []
+
+    directory = tempfile.mkdtemp()
+    try:
+        csv_filepath = os.path.join(directory, 'products.csv')
+        with open(csv_filepath, 'w') as csvfile:
+            for product_name, price in catalogue:
+                csvfile.write('{0},{1}\n'.format(product_name, price))
+        for store_class in (ProductStore, CompactProductStore):
+            results.append(_timing(
+                '{0}.init_from_filepath'.format(store_class.__name__),
+                lambda: store_class.init_from_filepath(csv_filepath),
+                products, repeat))
+    finally:
+        shutil.rmtree(directory)
+
+    store = ProductStore(catalogue)
+    lookups = [rng.choice(product_names) for _ in range(100000)]
+    results.append(_timing(
+        'ProductStore.get_product_price',
+        lambda: [store.get_product_price(name) for name in lookups],
+        len(lookups), repeat))
+
+    def build_carts():
+        built = []
+        for lines in cart_lines:
+            cart = Cart(store)
+            for product_name, quantity in lines:
+                cart.add(product_name, quantity)
+            built.append(cart)
+        return built
+
+    results.append(_timing('Cart.add', build_carts, line_count, repeat))
+    records = [(cart_id, product_name, quantity)
+               for cart_id, lines in enumerate(cart_lines)
+               for product_name, quantity in lines]
+    results.append(_timing(
+        'carts_from_records', lambda: list(carts_from_records(records, store)),
+        line_count, repeat))
+    built_carts = build_carts()
+    results.append(_timing(
+        'Cart.to_bytes', lambda: [cart.to_bytes() for cart in built_carts],
+        carts, repeat))
+    packed_carts = [cart.to_bytes() for cart in built_carts]
+    results.append(_timing(
+        'Cart.from_bytes',
+        lambda: [Cart.from_bytes(data, store) for data in packed_carts],
+        carts, repeat))
+    results.append(_timing(
+        'Cart.get_total',
+        lambda: [cart.get_total() for cart in built_carts], carts, repeat))
+    results.append(_timing(
+        'Cart.get_total[offer list]',
+        lambda: [cart.get_total(offer_list) for cart in built_carts],
+        carts, repeat))
+    results.append(_timing(
+        'Cart.get_total[OfferBook]',
+        lambda: [cart.get_total(offer_book) for cart in built_carts],
+        carts, repeat))
+    results.append(_timing(
+        'Cart.price[OfferBook]',
+        lambda: [cart.price(offer_book) for cart in built_carts],
+        carts, repeat))
+    memoized_offer_book = OfferResultCache(store, maxsize=100000).memoize(offer_list)
+    results.append(_timing(
+        'Cart.get_total[memoized offers]',
+        lambda: [cart.get_total(memoized_offer_book) for cart in built_carts],
+        carts, repeat))
+    pricing_table = PricingTable(offer_book, store)
+    results.append(_timing(
+        'PricingTable.get_total',
+        lambda: [pricing_table.get_total(cart) for cart in built_carts],
+        carts, repeat))
+    minor_unit_pricing_table = MinorUnitPricingTable(offer_book, store)
+    results.append(_timing(
+        'MinorUnitPricingTable.get_total',
+        lambda: [minor_unit_pricing_table.get_total(cart) for cart in built_carts],
+        carts, repeat))
+
+    for offer_class in (MultiBuyOffer, DependentDiscountOffer, NoOffer):
+        cases = []
+        for offer in offer_list:
+            if type(offer) is offer_class:
+                cart = Cart(store)
+                for product_name in offer.dependent_products:
+                    cart.add(product_name, rng.randint(0, 3))
+                cases.append(
+                    (offer, CartItem(offer.target_product, rng.randint(1, 10)), cart))
+        results.append(_timing(
+            '{0}.calculate_line_total'.format(offer_class.__name__),
+            lambda: [offer.calculate_line_total(item, store, cart)
+                     for offer, item, cart in cases],
+            len(cases), repeat))
+    return results
+
+
+def benchmark_product_lookup(sizes=(10, 1000, 100000, 1000000), lookups=100000,
+                             store_class=ProductStore):
+    '''Return a list of (catalogue_size, seconds_per_lookup) tuples.
+
+    Lookups are spread across the catalogue, so a store whose lookup cost
+    grows with its size shows up as a rising time per lookup.
+    '''
+    results = []
+    for size in sizes:
+        store = store_class(iter_synthetic_products(size))
+        names = ['product-{0}'.format(i % size) for i in range(1000)]
+        timer = timeit.Timer(
+            lambda: [store.get_product_price(name) for name in names])
+        runs = max(1, lookups // len(names))
+        seconds = min(timer.repeat(repeat=3, number=runs))
+        results.append((size, seconds / (runs * len(names))))
+    return results
+
+
+def _scan_total(cart, offers):
+    '''Price cart by testing every offer against every item, as
+    Cart.get_total did before offers were indexed.'''
+    totals = []
+    for item in cart:
+        line_total = item.get_line_total(cart.product_store)
+        for offer in offers:
+            if offer.target_product == item.product:
+                offer_total = offer.calculate_line_total(
+                    item, cart.product_store, cart)
+                if offer_total < line_total:
+                    line_total = offer_total
+        totals.append(line_total)
+    return Decimal(sum(totals))
+
+
+def benchmark_offer_lookup(offer_counts=(10, 100, 1000, 10000), cart_lines=50):
+    '''Return a list of (offer_count, scan_seconds, list_seconds,
+    book_seconds) tuples, timing one priced cart for each approach.
+
+    scan_seconds tests every offer against every item; list_seconds passes a
+    plain list to Cart.get_total, which indexes it on each call; book_seconds
+    passes a prebuilt OfferBook.
+    '''
+    results = []
+    for offer_count in offer_counts:
+        products = synthetic_products(max(offer_count, cart_lines))
+        cart = Cart(ProductStore(products))
+        for product_name, _ in products[:cart_lines]:
+            cart.add(product_name, 3)
+        offers = [MultiBuyOffer(product_name, 2, 1)
+                  for product_name, _ in products[:offer_count]]
+        offer_book = OfferBook(offers)
+        row = [offer_count]
+        for price in (lambda: _scan_total(cart, offers),
+                      lambda: cart.get_total(offers),
+                      lambda: cart.get_total(offer_book)):
+            row.append(min(timeit.Timer(price).repeat(repeat=3, number=10)) / 10)
+        results.append(tuple(row))
+    return results
+
+
+def benchmark_store_memory(count=1000000, store_classes=(ProductStore, CompactProductStore)):
+    '''Return a list of (store_class_name, bytes_per_product) tuples.
+
+    Measures the memory allocated while each store is built from a stream
+    of count products and still held once built.
+    '''
+    results = []
+    for store_class in store_classes:
+        tracemalloc.start()
+        store = store_class(iter_synthetic_products(count))
+        allocated, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del store
+        results.append((store_class.__name__, allocated / count))
+    return results
+
+
+class _DictCartItem(CartItem):
+
+    '''A CartItem with a per-instance __dict__, as before CartItem declared
+    __slots__.'''
+
+
+class _DictMultiBuyOffer(MultiBuyOffer):
+
+    '''A MultiBuyOffer with a per-instance __dict__, as before offers
+    declared __slots__.'''
+
+
+def _bytes_per_object(factory, count):
+    '''Return the memory allocated per object by calling factory(i) for i
+    in range(count) and holding the results.'''
+    tracemalloc.start()
+    objects = [factory(i) for i in range(count)]
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del objects
+    return allocated / count
+
+
+def benchmark_object_memory(count=100000):
+    '''Return a list of (class_name, bytes_per_object) tuples for cart
+    lines and offers, with and without __slots__.
+
+    Product names are created beforehand, so only the objects themselves
+    and the list holding them are counted.
+    '''
+    names = ['product-{0}'.format(i) for i in range(count)]
+    results = []
+    for item_class in (_DictCartItem, CartItem):
+        results.append((item_class.__name__, _bytes_per_object(
+            lambda i: item_class(names[i], 3), count)))
+    for offer_class in (_DictMultiBuyOffer, MultiBuyOffer):
+        results.append((offer_class.__name__, _bytes_per_object(
+            lambda i: offer_class(names[i], 2, 1), count)))
+    return results
+
+
+def run_scaling():
+    '''Return a dict of the scaling benchmarks' results.'''
+    return {
+        'get_product_price': {
+            store_class.__name__: [
+                {'products': size, 'ns_per_lookup': seconds * 1e9}
+                for size, seconds in benchmark_product_lookup(store_class=store_class)]
+            for store_class in (ProductStore, CompactProductStore)},
+        'offer_lookup': [
+            {'offers': offer_count, 'scan_us': scan * 1e6, 'list_us': plain * 1e6,
+             'offer_book_us': book * 1e6}
+            for offer_count, scan, plain, book in benchmark_offer_lookup()],
+        'store_memory': [
+            {'store': store_class_name, 'bytes_per_product': bytes_per_product}
+            for store_class_name, bytes_per_product in benchmark_store_memory()],
+        'object_memory': [
+            {'class': class_name, 'bytes_per_object': bytes_per_object}
+            for class_name, bytes_per_object in benchmark_object_memory()],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--products', type=int, default=10000)
+    parser.add_argument('--carts', type=int, default=1000)
+    parser.add_argument('--lines', type=int, default=20, help='lines per cart')
+    parser.add_argument('--offers', type=int, default=3000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--scaling', action='store_true',
+                        help='also run the scaling benchmarks')
+    parser.add_argument('--output', help='write JSON here instead of stdout')
+    args = parser.parse_args(argv)
+
+    parameters = dict(
+        products=args.products, carts=args.carts, lines=args.lines,
+        offers=args.offers, seed=args.seed, repeat=args.repeat)
+    report = {
+        'python': platform.python_version(),
+        'parameters': parameters,
+        'results': run_suite(**parameters),
+    }
+    if args.scaling:
+        report['scaling'] = run_scaling()
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,249 @@
+'''
+Bounded least-recently-used caching for the pricing engine.
+'''
+import threading
+from collections import OrderedDict
+
+from offers import OfferBook
+
+_MISSING = object()
+
+
+class LRUCache(object):
+
+    '''
+    A thread-safe mapping holding at most maxsize entries, evicting the least
+    recently used entry when full. Counts hits, misses and evictions.
+    '''
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        '''Return the value for key, or default if it isn't cached.'''
+        with self._lock:
+            value = self._entries.get(key, _MISSING)
+            if value is _MISSING:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        '''Cache value for key, evicting the least recently used entry if the
+        cache is full.'''
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        '''Remove every entry, keeping the statistics.'''
+        with self._lock:
+            self._entries.clear()
+
+    @property
+    def hit_rate(self):
+        '''Return the fraction of lookups that were hits.'''
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self):
+        '''Return a dict of the cache's size and statistics.'''
+        return {
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hit_rate,
+        }
+
+
+class CachedProductStore(object):
+
+    '''
+    An LRU cache of prices in front of another store.
+
+    The store's version is checked on each lookup, and the cache is emptied
+    when it has changed, so updated prices are never served stale. A price
+    fetched from the store is only cached if the store is still at the
+    version it was fetched at, so a lookup racing an update can't cache the
+    price it replaced.
+    '''
+
+    def __init__(self, store, maxsize=1024):
+        self.store = store
+        self.cache = LRUCache(maxsize)
+        self._version = store.version
+        self._lock = threading.Lock()
+
+    @property
+    def version(self):
+        return self.store.version
+
+    @property
+    def items(self):
+        return self.store.items
+
+    def __len__(self):
+        return len(self.store)
+
+    def __contains__(self, product_name):
+        return product_name in self.store
+
+    def get_product_price(self, product_name):
+        '''Return the price corresponding with the passed product_name.'''
+        version = self.store.version
+        if version != self._version:
+            with self._lock:
+                if version > self._version:
+                    self.cache.clear()
+                    self._version = version
+        price = self.cache.get(product_name, _MISSING)
+        if price is _MISSING:
+            price = self.store.get_product_price(product_name)
+            with self._lock:
+                if self.store.version == version == self._version:
+                    self.cache.put(product_name, price)
+        return price
+
+    def stats(self):
+        '''Return a dict of the cache's size and statistics.'''
+        return self.cache.stats()
+
+
+class OfferResultCache(object):
+
+    '''
+    An LRU cache of offer results for carts priced against one store.
+
+    An offer's line total depends only on its product's price, the line's
+    quantity and the quantities of its dependent products. So the cheapest
+    total of the offers targeting a product is keyed on those offers, the
+    line's quantity, the dependent products' quantities and the store's
+    version, and shared between every cart priced against the store. Offers
+    are wrapped with memoize:
+
+        offer_results = OfferResultCache(product_store)
+        offer_book = offer_results.memoize(offers)
+        total = cart.get_total(offers=offer_book)
+        print(offer_results.stats())
+
+    The offers targeting each product are memoized together, as a cache
+    lookup costs about as much as evaluating one simple offer. Carts priced
+    against the memoized offers must use the cache's store. Custom offers
+    whose totals depend on anything else shouldn't be memoized.
+    '''
+
+    def __init__(self, store, maxsize=10000):
+        self.store = store
+        self.cache = LRUCache(maxsize)
+
+    def memoize(self, offers):
+        '''Return an OfferBook of offers whose results are memoized in
+        this cache.'''
+        return MemoizedOfferBook(offers, self)
+
+    def stats(self):
+        '''Return a dict of the cache's size and statistics.'''
+        return self.cache.stats()
+
+
+class MemoizedOfferBook(OfferBook):
+
+    '''
+    An OfferBook whose for_product returns one MemoizedOffer standing for
+    all the offers targeting the product, where there is more than one. A
+    single offer is cheaper to evaluate than to look up.
+
+    Iterating the book, and depending_on, give the original offers.
+    '''
+
+    def __init__(self, offers, results):
+        self.results = results
+        self._memoized = {}
+        super(MemoizedOfferBook, self).__init__(offers)
+
+    def add(self, offer):
+        '''Add an offer to the book.'''
+        super(MemoizedOfferBook, self).add(offer)
+        self._memoized.pop(offer.target_product, None)
+
+    def for_product(self, product):
+        '''Return the offers targeting product, memoized as one.'''
+        memoized = self._memoized.get(product)
+        if memoized is None:
+            offers = super(MemoizedOfferBook, self).for_product(product)
+            if len(offers) > 1:
+                offers = (MemoizedOffer(offers, self.results),)
+            memoized = self._memoized[product] = offers
+        return memoized
+
+
+class MemoizedOffer(object):
+
+    '''
+    The offers targeting one product, whose calculate_line_total returns the
+    cheapest of their totals from an OfferResultCache where possible.
+
+    The cache keeps the offer giving each total too, which
+    cheapest_line_total returns, so Cart.price reports that offer rather
+    than the MemoizedOffer.
+    '''
+
+    __slots__ = ('offers', 'results', 'target_product', 'dependent_products')
+
+    def __init__(self, offers, results):
+        self.offers = tuple(offers)
+        self.results = results
+        self.target_product = self.offers[0].target_product
+        dependent_products = []
+        for offer in self.offers:
+            for product in offer.dependent_products:
+                if product not in dependent_products:
+                    dependent_products.append(product)
+        self.dependent_products = tuple(dependent_products)
+
+    def calculate_line_total(self, cart_item, store, cart=None, *args):
+        '''Return the cheapest of the offers' totals for cart_item.'''
+        return self.cheapest_line_total(cart_item, store, cart)[0]
+
+    def cheapest_line_total(self, cart_item, store, cart=None, recorder=None):
+        '''Return (the cheapest of the offers' totals for cart_item, the
+        offer giving it). Offers evaluated on a cache miss are timed if a
+        recorder is passed.'''
+        results = self.results
+        if self.dependent_products:
+            dependent_quantities = []
+            for product in self.dependent_products:
+                dependent_item = cart.get_item(product)
+                dependent_quantities.append(
+                    0 if dependent_item is None else dependent_item.quantity)
+            key = (self, cart_item.quantity, tuple(dependent_quantities),
+                   results.store.version)
+        else:
+            key = (self, cart_item.quantity, results.store.version)
+        result = results.cache.get(key, _MISSING)
+        if result is _MISSING:
+            result = None
+            for offer in self.offers:
+                if recorder is None:
+                    line_total = offer.calculate_line_total(cart_item, store, cart)
+                else:
+                    line_total = recorder.time_offer(offer, cart_item, store, cart)
+                if result is None or line_total < result[0]:
+                    result = (line_total, offer)
+            results.cache.put(key, result)
+        return result
@@ -1,10 +1,37 @@
+import json
+import struct
 from decimal import Decimal
+from time import perf_counter
+
+import instrumentation
+from instrumentation import InstrumentedStore
+from offers import as_offer_book, fingerprint_offers
+from product import NoSuchProductError
+
+# Packed binary cart layout (all integers little-endian):
+#
+#     header      magic, format version, flags, line count
+#     pricing     the fingerprints of the catalogue and offers the line
+#                 totals were priced with, each as a length and an ASCII
+#                 string, present if the line totals flag is set
+#     lines       one (name length, quantity) record and UTF-8 encoded name
+#                 per line, each followed, if the line totals flag is set, by
+#                 the length of its total and its total as an ASCII string
+#                 (empty where the line has no cached total)
+CART_MAGIC = b'CART'
+CART_FORMAT_VERSION = 2
+CART_HEADER = struct.Struct('<4sBBI')
+CART_LINE = struct.Struct('<Hq')
+CART_TOTAL_LENGTH = struct.Struct('<B')
+HAS_LINE_TOTALS = 1
 
 
 class Cart(object):
 
     def __init__(self, store=None):
         self.items = []
+        # Maps product name to its CartItem, alongside the ordered items list.
+        self._lines = {}
         self.product_store = store
 
     def __len__(self):
@@ -17,27 +44,80 @@ class Cart(object):
         '''
         Return sum of cart items as a Decimal.
 
-        If a list of offer objects is provided, these are applied where
-        appropriate when summing cart items. Where multiple offers may apply
-        to one cart item, the cheapest is used.
+        If a list of offer objects (or an OfferBook) is provided, these are
+        applied where appropriate when summing cart items. Where multiple
+        offers may apply to one cart item, the cheapest is used.
         '''
+        offer_book = as_offer_book(offers)
+        recorder = instrumentation.recorder
+        store = self.product_store
+        if recorder is not None:
+            started = perf_counter()
+            store = InstrumentedStore(store, recorder)
         totals = []
         for item in self.items:
-            # The original line_total without offers applied.
-            line_total = item.get_line_total(self.product_store)
-
-            if offers is not None:
-                # Apply each offer in turn
-                for offer in offers:
-                    if offer.target_product == item.product:
-                        offer_total = offer.calculate_line_total(
-                            item, self.product_store, self)
-                        # Retain cheapest total to append to totals list.
-                        if offer_total < line_total:
-                            line_total = offer_total
-
-            totals.append(line_total)
-        return Decimal(sum(totals))
+            totals.append(
+                self._get_line_total(item, offer_book, store, recorder))
+        total = Decimal(sum(totals))
+        if recorder is not None:
+            recorder.record(instrumentation.GET_TOTAL, perf_counter() - started)
+        return total
+
+    def price(self, offers=None):
+        '''
+        Return a PricingResult holding the total, as get_total would return
+        it, and for each line its total before and after offers, the offer
+        applied and the saving.
+
+        Each offer is evaluated once, as by get_total.
+        '''
+        offer_book = as_offer_book(offers)
+        recorder = instrumentation.recorder
+        store = self.product_store
+        if recorder is not None:
+            started = perf_counter()
+            store = InstrumentedStore(store, recorder)
+        lines = []
+        for item in self.items:
+            base_total, line_total, offer = self._price_line(
+                item, offer_book, store, recorder)
+            lines.append(LineResult(item.product, item.quantity, base_total, line_total, offer))
+        result = PricingResult(lines)
+        if recorder is not None:
+            recorder.record(instrumentation.GET_TOTAL, perf_counter() - started)
+        return result
+
+    def _get_line_total(self, item, offer_book, store, recorder=None):
+        '''Return the cheapest total for item under the offers in offer_book,
+        with prices from store. Offer evaluations are timed if a recorder is
+        passed.'''
+        return self._price_line(item, offer_book, store, recorder)[1]
+
+    def _price_line(self, item, offer_book, store, recorder=None):
+        '''Return (total without offers, cheapest total, offer giving the
+        cheapest total or None) for item, as _get_line_total.'''
+        # The original line_total without offers applied.
+        base_total = line_total = item.get_line_total(store)
+        applied_offer = None
+
+        if offer_book is not None:
+            # Apply each offer targeting this item in turn
+            for offer in offer_book.for_product(item.product):
+                cheapest_line_total = getattr(offer, 'cheapest_line_total', None)
+                if cheapest_line_total is not None:
+                    # An offer standing for several, such as a MemoizedOffer,
+                    # gives the one that priced the line, and times those it
+                    # evaluates itself.
+                    offer_total, offer = cheapest_line_total(item, store, self, recorder)
+                elif recorder is None:
+                    offer_total = offer.calculate_line_total(item, store, self)
+                else:
+                    offer_total = recorder.time_offer(offer, item, store, self)
+                # Retain cheapest total.
+                if offer_total < line_total:
+                    line_total = offer_total
+                    applied_offer = offer
+        return base_total, line_total, applied_offer
 
     def add(self, item, quantity=1):
         '''
@@ -46,21 +126,257 @@ class Cart(object):
         Adding an existing item is additive. The quantity will increase on an
         existing item by the amount passed with the quantity parameter.
         '''
-        cart_item = self.get_item(item)
+        cart_item = self._lines.get(item)
         if cart_item is None:
             cart_item = CartItem(item, quantity)
             self.items.append(cart_item)
+            self._lines[item] = cart_item
         else:
             cart_item.quantity += quantity
         return cart_item
 
+    def remove(self, item, quantity=None):
+        '''
+        Remove an item from the cart. Return the cart item, or None if the
+        item is not in the cart.
+
+        If quantity is passed, the quantity of the existing item is reduced by
+        that amount, otherwise the whole item is removed. An item whose
+        quantity falls to zero is removed from the cart.
+        '''
+        cart_item = self._lines.get(item)
+        if cart_item is None:
+            return None
+        if quantity is not None:
+            cart_item.quantity -= quantity
+        if quantity is None or cart_item.quantity <= 0:
+            del self._lines[item]
+            self.items.remove(cart_item)
+        return cart_item
+
     def get_item(self, item_name):
         '''Return CartItem where product corresponds with item_name.'''
-        return next((item for item in self.items if item.product == item_name), None)
+        return self._lines.get(item_name)
+
+    def _dump_state(self):
+        '''Return the cart's lines, and any cached pricing, as a dict.'''
+        return {'items': [[item.product, item.quantity] for item in self.items]}
+
+    def _load_state(self, state):
+        '''Replace the cart's lines with those in a dict from
+        _dump_state.'''
+        self.items = [CartItem(product, quantity)
+                      for product, quantity in state['items']]
+        self._lines = dict((item.product, item) for item in self.items)
+
+    def to_json(self):
+        '''Return the cart as a JSON string. The store is not included.'''
+        return json.dumps(self._dump_state(), separators=(',', ':'))
+
+    @classmethod
+    def from_json(cls, data, *args, **kwargs):
+        '''Return a cart restored from to_json output. Other arguments
+        (eg. the store) are passed to the constructor.'''
+        cart = cls(*args, **kwargs)
+        cart._load_state(json.loads(data))
+        return cart
+
+    def to_bytes(self):
+        '''Return the cart packed into bytes. The store is not included.'''
+        state = self._dump_state()
+        line_totals = state.get('line_totals')
+        chunks = [CART_HEADER.pack(
+            CART_MAGIC, CART_FORMAT_VERSION,
+            0 if line_totals is None else HAS_LINE_TOTALS, len(state['items']))]
+        if line_totals is not None:
+            for fingerprint in (state['catalogue'], state['offers']):
+                fingerprint = fingerprint.encode('ascii')
+                chunks.append(CART_TOTAL_LENGTH.pack(len(fingerprint)))
+                chunks.append(fingerprint)
+        for product, quantity in state['items']:
+            name = product.encode('utf-8')
+            chunks.append(CART_LINE.pack(len(name), quantity))
+            chunks.append(name)
+            if line_totals is not None:
+                total = line_totals.get(product, '').encode('ascii')
+                chunks.append(CART_TOTAL_LENGTH.pack(len(total)))
+                chunks.append(total)
+        return b''.join(chunks)
+
+    @classmethod
+    def from_bytes(cls, data, *args, **kwargs):
+        '''Return a cart restored from to_bytes output. Other arguments
+        (eg. the store) are passed to the constructor.'''
+        magic, version, flags, count = CART_HEADER.unpack_from(data)
+        if magic != CART_MAGIC or version != CART_FORMAT_VERSION:
+            raise ValueError('Not a packed cart.')
+        offset = CART_HEADER.size
+        state = {'items': []}
+        if flags & HAS_LINE_TOTALS:
+            for key in ('catalogue', 'offers'):
+                length = data[offset]
+                offset += CART_TOTAL_LENGTH.size
+                state[key] = data[offset:offset + length].decode('ascii')
+                offset += length
+            state['line_totals'] = line_totals = {}
+        for _ in range(count):
+            name_length, quantity = CART_LINE.unpack_from(data, offset)
+            offset += CART_LINE.size
+            product = data[offset:offset + name_length].decode('utf-8')
+            offset += name_length
+            state['items'].append((product, quantity))
+            if flags & HAS_LINE_TOTALS:
+                total_length = data[offset]
+                offset += CART_TOTAL_LENGTH.size
+                if total_length:
+                    line_totals[product] = data[offset:offset + total_length].decode('ascii')
+                    offset += total_length
+        cart = cls(*args, **kwargs)
+        cart._load_state(state)
+        return cart
+
+
+class IncrementalCart(Cart):
+
+    '''
+    A Cart priced against a fixed set of offers, caching the total of each
+    line between calls to get_total.
+
+    Adding or removing an item only reprices that item's line, and the lines
+    whose offers depend on it (eg. the target of a DependentDiscountOffer),
+    the next time get_total is called.
+
+    Every line is repriced when the store's version changes. Otherwise line
+    totals are only invalidated through add and remove, so call invalidate()
+    after changing a CartItem's quantity directly.
+    '''
+
+    def __init__(self, store=None, offers=None):
+        super(IncrementalCart, self).__init__(store)
+        self.offers = as_offer_book(offers)
+        self._line_totals = {}
+        self._dirty = set()
+        self._total = Decimal(0)
+        self._version = getattr(store, 'version', None)
+
+    def get_total(self, offers=None):
+        '''
+        Return sum of cart items as a Decimal, with the cart's offers applied.
+
+        Only lines changed since the last call are repriced. Passing a
+        different set of offers prices the whole cart against those offers
+        instead, without touching the cached totals.
+        '''
+        if offers is not None and offers is not self.offers:
+            return super(IncrementalCart, self).get_total(offers)
+        version = getattr(self.product_store, 'version', None)
+        if version != self._version:
+            self.invalidate()
+            self._version = version
+        recorder = instrumentation.recorder
+        store = self.product_store
+        if recorder is not None:
+            started = perf_counter()
+            store = InstrumentedStore(store, recorder)
+        for product in self._dirty:
+            self._total -= self._line_totals.pop(product, 0)
+            item = self._lines.get(product)
+            if item is not None:
+                line_total = self._get_line_total(
+                    item, self.offers, store, recorder)
+                self._line_totals[product] = line_total
+                self._total += line_total
+        self._dirty.clear()
+        if recorder is not None:
+            recorder.record(instrumentation.GET_TOTAL, perf_counter() - started)
+        return Decimal(self._total)
+
+    def add(self, item, quantity=1):
+        cart_item = super(IncrementalCart, self).add(item, quantity)
+        self.invalidate(item)
+        return cart_item
+
+    def remove(self, item, quantity=None):
+        cart_item = super(IncrementalCart, self).remove(item, quantity)
+        self.invalidate(item)
+        return cart_item
+
+    def price(self, offers=None):
+        '''Return a PricingResult for the cart, with the cart's offers
+        unless others are passed. Every line is priced.'''
+        return super(IncrementalCart, self).price(
+            self.offers if offers is None else offers)
+
+    def invalidate(self, product=None):
+        '''Mark the line for product, and the lines whose offers depend on
+        it, for repricing. With no product, every line is repriced.'''
+        if product is None:
+            self._dirty.update(self._lines)
+            self._dirty.update(self._line_totals)
+            return
+        self._dirty.add(product)
+        if self.offers is not None:
+            self._dirty.update(self.offers.affected_by(product))
+
+    def _pricing_fingerprints(self):
+        '''Return (catalogue fingerprint, offers fingerprint) for the store
+        and offers the cart is priced with, or None if the store has no
+        fingerprint.'''
+        fingerprint = getattr(self.product_store, 'fingerprint', None)
+        if fingerprint is None:
+            return None
+        if self.offers is None:
+            offers_fingerprint = fingerprint_offers(())
+        elif hasattr(self.offers, 'fingerprint'):
+            offers_fingerprint = self.offers.fingerprint()
+        else:
+            offers_fingerprint = fingerprint_offers(self.offers)
+        return fingerprint(), offers_fingerprint
+
+    def _dump_state(self):
+        '''Return the cart's lines, with the totals of the lines priced
+        since they last changed and the fingerprints of the catalogue and
+        offers they were priced with, as a dict.'''
+        state = super(IncrementalCart, self)._dump_state()
+        # Totals priced at an older version of the store are all stale.
+        if self._version is None or self._version != self.product_store.version:
+            return state
+        fingerprints = self._pricing_fingerprints()
+        if fingerprints is not None:
+            state['catalogue'], state['offers'] = fingerprints
+            state['line_totals'] = dict(
+                (product, str(line_total))
+                for product, line_total in self._line_totals.items()
+                if product not in self._dirty)
+        return state
+
+    def _load_state(self, state):
+        '''
+        Replace the cart's lines with those in a dict from _dump_state.
+
+        Cached line totals are reused only if the cart's store and offers
+        have the same fingerprints as those the totals were priced with, in
+        this process or any other, so only the lines without one are
+        repriced by the next get_total.
+        '''
+        super(IncrementalCart, self)._load_state(state)
+        self._line_totals = {}
+        self._total = Decimal(0)
+        line_totals = state.get('line_totals')
+        if line_totals and self._version is not None and \
+                self._pricing_fingerprints() == (state.get('catalogue'), state.get('offers')):
+            for product, line_total in line_totals.items():
+                if product in self._lines:
+                    line_total = self._line_totals[product] = Decimal(line_total)
+                    self._total += line_total
+        self._dirty = set(self._lines).difference(self._line_totals)
 
 
 class CartItem(object):
 
+    # Carts can hold millions of lines, so items don't carry a __dict__.
+    __slots__ = ('product', 'quantity')
+
     def __init__(self, product, quantity=1):
         self.product = product
         self.quantity = quantity
@@ -68,3 +384,120 @@ class CartItem(object):
     def get_line_total(self, store):
         '''Return total derived from product in store.'''
         return store.get_product_price(self.product) * self.quantity
+
+
+class LineResult(object):
+
+    '''
+    How one cart line was priced: its total without offers (base_total),
+    its total with the cheapest offer (line_total), that offer, or None if
+    no offer was cheaper than the base total, and the saving.
+    '''
+
+    __slots__ = ('product', 'quantity', 'base_total', 'line_total', 'offer')
+
+    def __init__(self, product, quantity, base_total, line_total, offer=None):
+        self.product = product
+        self.quantity = quantity
+        self.base_total = base_total
+        self.line_total = line_total
+        self.offer = offer
+
+    @property
+    def savings(self):
+        '''Return how much the offer took off the line's total.'''
+        return self.base_total - self.line_total
+
+
+class PricingResult(object):
+
+    '''The total of a priced cart, with a LineResult for each of its lines,
+    as returned by Cart.price.'''
+
+    def __init__(self, lines):
+        self.lines = lines
+        self.total = Decimal(sum(line.line_total for line in lines))
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __iter__(self):
+        return iter(self.lines)
+
+    @property
+    def base_total(self):
+        '''Return the total of the cart without offers.'''
+        return Decimal(sum(line.base_total for line in self.lines))
+
+    @property
+    def savings(self):
+        '''Return how much offers took off the total.'''
+        return self.base_total - self.total
+
+
+def carts_from_records(records, store=None, cart_class=Cart, grouped=True,
+                       batch_size=1000, **kwargs):
+    '''
+    Build carts from an iterable of (cart_id, product, quantity) records,
+    yielding (cart_id, cart) pairs.
+
+    Repeated lines for a product are added together. Carts are built with
+    cart_class(store, **kwargs). Products are checked against the store
+    batch_size carts at a time, each product once, and NoSuchProductError
+    is raised for the first cart with a product missing from the store.
+
+    If grouped, each cart's records must be consecutive, and each cart is
+    yielded, in batches, once records for the next begin, so memory is
+    bounded by the batch rather than the input. A cart_id whose records
+    resume after another cart's raises ValueError if its cart is still in
+    the current batch, and is otherwise yielded again as a second cart.
+    If not grouped, every cart is held until the records are exhausted.
+    '''
+    open_carts = {}
+    batch_ids = set()
+    known_products = set()
+    batch = []
+    for cart_id, product, quantity in records:
+        cart = open_carts.get(cart_id)
+        if cart is None:
+            if grouped and open_carts:
+                batch.extend(open_carts.items())
+                open_carts.clear()
+                if len(batch) >= batch_size:
+                    _check_products(batch, store, known_products)
+                    for built in batch:
+                        yield built
+                    batch = []
+                    batch_ids.clear()
+            if grouped:
+                if cart_id in batch_ids:
+                    raise ValueError(
+                        'Records for cart {cart_id} are not consecutive.'.format(cart_id=cart_id))
+                batch_ids.add(cart_id)
+            cart = open_carts[cart_id] = cart_class(store, **kwargs)
+        cart.add(product, quantity)
+    batch.extend(open_carts.items())
+    _check_products(batch, store, known_products)
+    for built in batch:
+        yield built
+
+
+def _check_products(batch, store, known_products):
+    '''Raise NoSuchProductError for the first cart in a batch of
+    (cart_id, cart) pairs with a product missing from store, checking only
+    the products not already in known_products.'''
+    if store is None:
+        return
+    products = set()
+    for _, cart in batch:
+        products.update(cart._lines)
+    products.difference_update(known_products)
+    missing = set(product for product in products if product not in store)
+    if missing:
+        for cart_id, cart in batch:
+            for product in cart._lines:
+                if product in missing:
+                    raise NoSuchProductError(
+                        'No such product "{product_name}" in this store, in cart {cart_id}.'.format(
+                            product_name=product, cart_id=cart_id))
+    known_products.update(products)
@@ -0,0 +1,145 @@
+'''
+Offer sets compiled against a store into a per-product pricing table.
+'''
+from decimal import ROUND_HALF_UP, Decimal
+
+from money import from_minor_units, to_minor_units
+from offers import _MinorUnitPrices, as_offer_book
+
+
+class PricingTable(object):
+
+    '''
+    A set of offers compiled against a store.
+
+    Each product with offers maps to its price and one specialised function
+    per offer, from AbstractOffer.compile, so pricing a cart doesn't look up
+    offers or prices, or read offer attributes. Prices of products without
+    offers are looked up once and remembered.
+
+    A table can be reused across carts. It is recompiled when the store's
+    version changes; compile a new table when the offers change.
+
+    Subclasses change how prices are held through _price and _prices, and
+    how offers are compiled through _compile_offer.
+
+        pricing_table = PricingTable(offers, product_store)
+        total = pricing_table.get_total(cart)
+    '''
+
+    def __init__(self, offers, store):
+        self.offers = as_offer_book(offers or ())
+        self.store = store
+        self.compile()
+
+    def compile(self):
+        '''Compile every offer against the store's current prices.'''
+        self.version = self.store.version
+        self.prices = {}
+        self.rules = {}
+        for offer in self.offers:
+            product = offer.target_product
+            # An offer on a product missing from the store can never apply.
+            if product not in self.store:
+                continue
+            if product not in self.rules:
+                self.prices[product] = self._price(product)
+                self.rules[product] = []
+            self.rules[product].append(self._compile_offer(offer))
+
+    def _price(self, product):
+        '''Return the price of product in the store, as the table holds
+        it.'''
+        return self.store.get_product_price(product)
+
+    def _compile_offer(self, offer):
+        '''Return offer compiled against the store.'''
+        return offer.compile(self.store)
+
+    def prefetch(self, product_names):
+        '''Recompile the table if the store has changed, and look up the
+        prices of product_names not yet known in one batch, if the store
+        supports batched lookups.'''
+        if self.store.version != self.version:
+            self.compile()
+        if getattr(self.store, 'get_product_prices', None) is None:
+            return
+        product_names = set(product_names).difference(self.prices)
+        if product_names:
+            self.prices.update(self._prices(product_names))
+
+    def _prices(self, product_names):
+        '''Return a dict of the prices of product_names in the store, as
+        the table holds them.'''
+        return self.store.get_product_prices(product_names)
+
+    def get_line_total(self, cart_item, cart):
+        '''Return the cheapest total for cart_item under the compiled
+        offers.'''
+        product = cart_item.product
+        try:
+            price = self.prices[product]
+        except KeyError:
+            price = self.prices[product] = self._price(product)
+        line_total = price * cart_item.quantity
+        for rule in self.rules.get(product, ()):
+            offer_total = rule(cart_item, cart)
+            if offer_total < line_total:
+                line_total = offer_total
+        return line_total
+
+    def get_total(self, cart):
+        '''Return sum of cart items as a Decimal, as Cart.get_total would
+        with the compiled offers.'''
+        if self.store.version != self.version:
+            self.compile()
+        return Decimal(sum(
+            self.get_line_total(cart_item, cart) for cart_item in cart.items))
+
+
+class MinorUnitPricingTable(PricingTable):
+
+    '''
+    A PricingTable pricing in integer minor units (eg. pence) throughout,
+    converting to Decimal only for the total.
+
+    Prices are read from the store as minor units with places decimal
+    places, and must be exact to them. Where an offer's line total isn't a
+    whole number of minor units, as with some percentage discounts, it is
+    rounded with rounding, one of the decimal module's rounding modes, before
+    lines are compared and summed. Totals then match Cart.get_total's
+    wherever each line's exact total is a whole number of minor units.
+
+        pricing_table = MinorUnitPricingTable(offers, product_store, rounding=ROUND_HALF_EVEN)
+        total = pricing_table.get_total(cart)
+    '''
+
+    def __init__(self, offers, store, places=2, rounding=ROUND_HALF_UP):
+        self.places = places
+        self.rounding = rounding
+        self._minor_unit_prices = _MinorUnitPrices(store, places)
+        super(MinorUnitPricingTable, self).__init__(offers, store)
+
+    def _price(self, product):
+        return self._minor_unit_prices.get_product_price(product)
+
+    def _compile_offer(self, offer):
+        return offer.compile_minor_units(self.store, self.places, self.rounding)
+
+    def _prices(self, product_names):
+        places = self.places
+        return dict(
+            (product_name, to_minor_units(price, places))
+            for product_name, price in self.store.get_product_prices(product_names).items())
+
+    def get_total_minor_units(self, cart):
+        '''Return the total of cart as an integer number of minor
+        units.'''
+        if self.store.version != self.version:
+            self.compile()
+        get_line_total = self.get_line_total
+        return sum(get_line_total(cart_item, cart) for cart_item in cart.items)
+
+    def get_total(self, cart):
+        '''Return the total of cart as a Decimal.'''
+        return from_minor_units(self.get_total_minor_units(cart), self.places)
@@ -0,0 +1,178 @@
+'''
+Optional instrumentation of the pricing pipeline.
+
+While a Recorder is enabled, Cart.get_total records its own latency, the
+latency of every price lookup made while pricing the cart, and the latency of
+every offer's calculate_line_total, broken down by offer class:
+
+    with instrumentation.recording() as recorder:
+        cart.get_total(offers)
+    print(recorder.to_prometheus())
+
+When no recorder is enabled, pricing only checks the module's recorder
+attribute once per cart and once per offer evaluated.
+'''
+import bisect
+import threading
+from contextlib import contextmanager
+from time import perf_counter
+
+# The enabled Recorder, or None.
+recorder = None
+
+GET_TOTAL = 'get_total'
+GET_PRODUCT_PRICE = 'get_product_price'
+CALCULATE_LINE_TOTAL = 'calculate_line_total'
+
+
+class Recorder(object):
+
+    '''
+    Call counts, cumulative time and latency histograms for each pricing
+    stage, with offer evaluations broken down by offer class.
+    '''
+
+    DEFAULT_BUCKETS = (
+        0.000001, 0.000005, 0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005,
+        0.01, 0.05, 0.1)
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage, seconds, offer_class=None):
+        '''Record one call to stage taking seconds.'''
+        key = (stage, offer_class)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0, 0.0, [0] * (len(self.buckets) + 1)]
+            series[0] += 1
+            series[1] += seconds
+            series[2][bisect.bisect_left(self.buckets, seconds)] += 1
+
+    def time_offer(self, offer, cart_item, store, cart):
+        '''Return offer.calculate_line_total for cart_item, recording how
+        long it took.'''
+        started = perf_counter()
+        try:
+            return offer.calculate_line_total(cart_item, store, cart)
+        finally:
+            self.record(CALCULATE_LINE_TOTAL, perf_counter() - started,
+                        type(offer).__name__)
+
+    def reset(self):
+        '''Discard everything recorded so far.'''
+        with self._lock:
+            self._series.clear()
+
+    def _snapshot(self):
+        '''Return a copy of the recorded series, sorted by stage and offer
+        class.'''
+        with self._lock:
+            return sorted(
+                ((key, (value[0], value[1], list(value[2])))
+                 for key, value in self._series.items()),
+                key=_series_order)
+
+    def _stats(self, series):
+        calls, seconds, counts = series
+        histogram = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), counts):
+            cumulative += count
+            histogram.append((bound, cumulative))
+        return {'calls': calls, 'seconds': seconds, 'histogram': histogram}
+
+    def as_dict(self):
+        '''
+        Return the recorded statistics as a dict.
+
+        Each stage maps to a dict of calls, cumulative seconds and a
+        histogram of (upper bound, cumulative count) pairs. The
+        calculate_line_total stage maps offer class names to those dicts.
+        '''
+        series = self._snapshot()
+        stats = {}
+        for (stage, offer_class), value in series:
+            if offer_class is None:
+                stats[stage] = self._stats(value)
+            else:
+                stats.setdefault(stage, {})[offer_class] = self._stats(value)
+        return stats
+
+    def to_prometheus(self, prefix='cart_pricing'):
+        '''Return the recorded statistics in the Prometheus text format.'''
+        name = '{prefix}_seconds'.format(prefix=prefix)
+        lines = [
+            '# HELP {name} Latency of each pricing stage.'.format(name=name),
+            '# TYPE {name} histogram'.format(name=name),
+        ]
+        series = self._snapshot()
+        for (stage, offer_class), value in series:
+            labels = 'stage="{stage}"'.format(stage=stage)
+            if offer_class is not None:
+                labels += ',offer="{offer_class}"'.format(offer_class=offer_class)
+            stats = self._stats(value)
+            for bound, count in stats['histogram']:
+                lines.append('{name}_bucket{{{labels},le="{bound}"}} {count}'.format(
+                    name=name, labels=labels, bound=bound, count=count))
+            lines.append('{name}_sum{{{labels}}} {seconds!r}'.format(
+                name=name, labels=labels, seconds=stats['seconds']))
+            lines.append('{name}_count{{{labels}}} {calls}'.format(
+                name=name, labels=labels, calls=stats['calls']))
+        return '\n'.join(lines) + '\n'
+
+
+def _series_order(item):
+    (stage, offer_class), _ = item
+    return stage, offer_class or ''
+
+
+class InstrumentedStore(object):
+
+    '''Wraps a store, recording the latency of each get_product_price.'''
+
+    def __init__(self, store, recorder):
+        self.store = store
+        self.recorder = recorder
+
+    def __contains__(self, product_name):
+        return product_name in self.store
+
+    def get_product_price(self, product_name):
+        '''Return the price corresponding with the passed product_name.'''
+        started = perf_counter()
+        try:
+            return self.store.get_product_price(product_name)
+        finally:
+            self.recorder.record(GET_PRODUCT_PRICE, perf_counter() - started)
+
+
+def enable(new_recorder=None):
+    '''Enable recording into new_recorder, or a new Recorder. Return the
+    enabled recorder.'''
+    global recorder
+    recorder = new_recorder if new_recorder is not None else Recorder()
+    return recorder
+
+
+def disable():
+    '''Stop recording.'''
+    global recorder
+    recorder = None
+
+
+@contextmanager
+def recording(new_recorder=None):
+    '''Enable recording for the duration of a with block, yielding the
+    recorder.'''
+    previous = recorder
+    try:
+        yield enable(new_recorder)
+    finally:
+        if previous is None:
+            disable()
+        else:
+            enable(previous)
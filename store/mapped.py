@@ -0,0 +1,179 @@
+'''
+A compiled, memory-mapped catalogue format.
+
+compile_csv_catalogue turns a CSV catalogue into a binary file which
+MappedProductStore opens with mmap. Opening a compiled catalogue reads only
+its header, and the operating system shares the mapped pages between every
+process that opens the same file.
+
+Compile a catalogue from the command line with:
+
+    python mapped.py products.csv products.catalogue
+
+File layout (all integers little-endian):
+
+    header      magic, format version, decimal places, product count
+    records     one (name offset, name length, price in minor units) record
+                per product, sorted by UTF-8 encoded name
+    names       the UTF-8 encoded product names
+'''
+import mmap
+import os
+import struct
+import sys
+
+from money import from_minor_units, to_minor_units
+from product import NoSuchProductError, ProductStore, read_catalogue
+
+MAGIC = b'CATL'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<4sHHQ')
+RECORD = struct.Struct('<QIq')
+
+
+def compile_catalogue(items, filepath, places=2):
+    '''
+    Write (product_name, price) items to filepath as a compiled catalogue.
+
+    Where a product appears more than once, the first price is kept. Every
+    price must be exact to the given number of decimal places. The file is
+    written alongside filepath and moved into place once complete, so
+    processes with the old file open are unaffected.
+    '''
+    prices = {}
+    for product_name, price in items:
+        name = product_name.encode('utf-8')
+        if name not in prices:
+            prices[name] = to_minor_units(price, places)
+    names = sorted(prices)
+
+    temp_filepath = '{filepath}.tmp'.format(filepath=filepath)
+    with open(temp_filepath, 'wb') as catalogue:
+        catalogue.write(HEADER.pack(MAGIC, FORMAT_VERSION, places, len(names)))
+        name_offset = 0
+        for name in names:
+            catalogue.write(RECORD.pack(name_offset, len(name), prices[name]))
+            name_offset += len(name)
+        for name in names:
+            catalogue.write(name)
+    os.replace(temp_filepath, filepath)
+
+
+def compile_csv_catalogue(csv_filepath, filepath, places=2):
+    '''Compile the CSV catalogue at csv_filepath to filepath.'''
+    with open(csv_filepath, newline='') as csvfile:
+        compile_catalogue(read_catalogue(csvfile), filepath, places)
+
+
+class MappedProductStore(ProductStore):
+
+    '''
+    A ProductStore reading prices from a memory-mapped compiled catalogue.
+
+    Lookups binary search the sorted records in the mapped file, so only the
+    pages they touch are read. Instances pickle as their filepath, and map
+    the file again when unpickled in another process.
+    '''
+
+    @classmethod
+    def init_from_filepath(cls, filepath):
+        '''Return an instance opened from a compiled catalogue file.'''
+        return cls(filepath)
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        with open(filepath, 'rb') as catalogue:
+            self._map = mmap.mmap(catalogue.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._map) >= HEADER.size:
+            magic, version, self.places, self._count = HEADER.unpack_from(self._map)
+        else:
+            magic = version = None
+        if magic != MAGIC or version != FORMAT_VERSION:
+            self._map.close()
+            raise ValueError('{filepath} is not a compiled catalogue.'.format(
+                filepath=filepath))
+        self._names_offset = HEADER.size + self._count * RECORD.size
+
+    def __getstate__(self):
+        return {'filepath': self.filepath}
+
+    def __setstate__(self, state):
+        self.__init__(state['filepath'])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        '''Unmap the catalogue file.'''
+        self._map.close()
+
+    def _record(self, index):
+        '''Return (name, minor units price) for the record at index.'''
+        name_offset, name_length, price = RECORD.unpack_from(
+            self._map, HEADER.size + index * RECORD.size)
+        start = self._names_offset + name_offset
+        return self._map[start:start + name_length], price
+
+    def _find(self, product_name):
+        '''Return the price in minor units of product_name, or None.'''
+        key = product_name.encode('utf-8')
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            name, price = self._record(middle)
+            if name < key:
+                low = middle + 1
+            elif name > key:
+                high = middle
+            else:
+                return price
+        return None
+
+    @property
+    def items(self):
+        '''Return a list of (product_name, price) tuples, sorted by name.'''
+        items = []
+        for index in range(self._count):
+            name, price = self._record(index)
+            items.append(
+                (name.decode('utf-8'), from_minor_units(price, self.places)))
+        return items
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, product_name):
+        return self._find(product_name) is not None
+
+    def get_product_price(self, product_name):
+        '''Return the price corresponding with the passed product_name.'''
+        price = self._find(product_name)
+        if price is None:
+            raise NoSuchProductError('No such product "{product_name}" in this store.'.format(product_name=product_name))
+        return from_minor_units(price, self.places)
+
+    def get_minor_unit_price(self, product_name, places=2):
+        '''Return the price of product_name as an integer number of minor
+        units, without converting through Decimal where places matches the
+        catalogue's.'''
+        if places != self.places:
+            return super(MappedProductStore, self).get_minor_unit_price(product_name, places)
+        price = self._find(product_name)
+        if price is None:
+            raise NoSuchProductError('No such product "{product_name}" in this store.'.format(product_name=product_name))
+        return price
+
+    def update(self, prices=(), deletes=()):
+        '''Compiled catalogues are read-only; recompile to change prices.'''
+        raise NotImplementedError('Compiled catalogues are read-only.')
+
+    def snapshot(self):
+        '''Return the store itself, as its prices never change.'''
+        return self
+
+
+if __name__ == '__main__':
+    compile_csv_catalogue(sys.argv[1], sys.argv[2])
@@ -0,0 +1,70 @@
+'''Conversions between Decimal amounts and integer minor units (eg. pence).'''
+from decimal import (ROUND_CEILING, ROUND_DOWN, ROUND_FLOOR, ROUND_HALF_DOWN,
+                     ROUND_HALF_EVEN, ROUND_HALF_UP, ROUND_UP, Decimal)
+
+ROUNDING_MODES = (ROUND_CEILING, ROUND_DOWN, ROUND_FLOOR, ROUND_HALF_DOWN,
+                  ROUND_HALF_EVEN, ROUND_HALF_UP, ROUND_UP)
+
+
+def to_minor_units(amount, places=2):
+    '''Return the Decimal amount as an integer number of minor units.
+
+    Raises ValueError if amount can't be held exactly in minor units with the
+    given number of decimal places.
+    '''
+    minor = amount.scaleb(places)
+    if not minor.is_finite() or minor != minor.to_integral_value():
+        raise ValueError(
+            'Amount {amount} has more than {places} decimal places.'.format(
+                amount=amount, places=places))
+    return int(minor)
+
+
+def from_minor_units(minor, places=2):
+    '''Return an integer number of minor units as a Decimal amount.'''
+    return Decimal(minor).scaleb(-places)
+
+
+def divide(numerator, denominator, rounding=ROUND_HALF_UP):
+    '''
+    Return the integer numerator / denominator, rounded to an integer with
+    one of the decimal module's rounding modes, without going through
+    Decimal.
+
+    Raises ValueError for rounding modes other than those in
+    ROUNDING_MODES.
+    '''
+    if rounding not in ROUNDING_MODES:
+        raise ValueError('Unsupported rounding mode {rounding}.'.format(rounding=rounding))
+    if denominator < 0:
+        numerator, denominator = -numerator, -denominator
+    quotient, remainder = divmod(numerator, denominator)
+    if not remainder:
+        return quotient
+    # The exact result lies between quotient and quotient + 1, and is
+    # negative if quotient is.
+    positive = quotient >= 0
+    if rounding == ROUND_FLOOR:
+        return quotient
+    if rounding == ROUND_CEILING:
+        return quotient + 1
+    if rounding == ROUND_DOWN:
+        return quotient if positive else quotient + 1
+    if rounding == ROUND_UP:
+        return quotient + 1 if positive else quotient
+    twice_remainder = 2 * remainder
+    if twice_remainder < denominator:
+        return quotient
+    if twice_remainder > denominator:
+        return quotient + 1
+    if rounding == ROUND_HALF_UP:
+        return quotient + 1 if positive else quotient
+    if rounding == ROUND_HALF_DOWN:
+        return quotient if positive else quotient + 1
+    return quotient if quotient % 2 == 0 else quotient + 1
+
+
+def round_to_minor_units(amount, places=2, rounding=ROUND_HALF_UP):
+    '''Return the Decimal amount as an integer number of minor units,
+    rounded with one of the decimal module's rounding modes.'''
+    return int(amount.scaleb(places).to_integral_value(rounding=rounding))
@@ -1,25 +1,108 @@
+import hashlib
+import json
+from decimal import ROUND_HALF_UP, Decimal, InvalidOperation
+from fractions import Fraction
+
+from money import divide, round_to_minor_units, to_minor_units
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 class AbstractOffer(object):
 
-    '''An interface for subclassing Offer classes.'''
+    '''
+    An interface for subclassing Offer classes.
+
+    Offers declare __slots__ so that large offer sets don't carry a __dict__
+    per offer. Subclasses that don't declare __slots__ get one as usual.
+    '''
 
-    def __init__(self, target_product):
+    __slots__ = ('target_product', 'start', 'end')
+
+    def __init__(self, target_product, start=None, end=None):
+        '''start and end, if given, limit the offer to the times from start
+        up to but not including end, eg. as datetimes.'''
         self.target_product = target_product
+        self.start = start
+        self.end = end
+
+    def is_active(self, at):
+        '''Return whether the offer applies at the time at.'''
+        # Subclasses that don't call __init__ apply at all times.
+        start = getattr(self, 'start', None)
+        end = getattr(self, 'end', None)
+        return (start is None or start <= at) and (end is None or at < end)
+
+    @property
+    def dependent_products(self):
+        '''Products other than the target whose presence affects this offer.'''
+        return ()
 
     def calculate_line_total(self, cart_item, store, *args):
         '''All subclasses must implement this method, returning a new total
         for the cart_item.'''
         raise NotImplementedError()
 
+    def compile(self, store):
+        '''
+        Return a function of (cart_item, cart) returning the same total as
+        calculate_line_total, with prices read from store now.
+
+        Subclasses may override this to return a function specialised to the
+        offer's attributes and price.
+        '''
+        def line_total(cart_item, cart):
+            return self.calculate_line_total(cart_item, store, cart)
+        return line_total
+
+    def compile_minor_units(self, store, places=2, rounding=ROUND_HALF_UP):
+        '''
+        Return a function of (cart_item, cart) returning the same total as
+        calculate_line_total, as an integer number of minor units rounded
+        with the given decimal rounding mode.
+
+        Subclasses may override this to price in integers throughout.
+        '''
+        def line_total(cart_item, cart):
+            return round_to_minor_units(
+                self.calculate_line_total(cart_item, store, cart), places, rounding)
+        return line_total
+
 
 class NoOffer(AbstractOffer):
 
     '''The simplest offer, is no offer at all.'''
 
+    __slots__ = ()
+
     def calculate_line_total(self, cart_item, store, *args):
         '''Simply return the cart_item.get_line_total.'''
         return cart_item.get_line_total(store)
 
+    def compile(self, store):
+        price = store.get_product_price(self.target_product)
+
+        def line_total(cart_item, cart):
+            return price * cart_item.quantity
+        return line_total
+
+    def compile_minor_units(self, store, places=2, rounding=ROUND_HALF_UP):
+        return self.compile(_MinorUnitPrices(store, places))
+
+    def calculate_line_totals(self, quantities, prices):
+        '''Return line totals, in integer minor units, for sequences of
+        quantities and integer minor unit prices.
+
+        With NumPy installed, a NumPy array is returned, otherwise a list.
+        '''
+        if numpy is not None:
+            return numpy.asarray(quantities, dtype=numpy.int64) * \
+                numpy.asarray(prices, dtype=numpy.int64)
+        return [quantity * price for quantity, price in zip(quantities, prices)]
+
 
 class MultiBuyOffer(AbstractOffer):
 
@@ -32,6 +115,8 @@ class MultiBuyOffer(AbstractOffer):
         multibuy_offer = MultiBuyOffer(2, 1, 'strawberries')
     '''
 
+    __slots__ = ('charge_for_quantity', 'free_quantity')
+
     def __init__(self, target_product, charge_for_quantity, free_quantity, *args, **kwargs):
         self.charge_for_quantity = charge_for_quantity
         self.free_quantity = free_quantity
@@ -47,38 +132,315 @@ class MultiBuyOffer(AbstractOffer):
         charge_quantity = (bundles * self.charge_for_quantity) + remainder
         return store.get_product_price(cart_item.product) * charge_quantity
 
+    def compile(self, store):
+        price = store.get_product_price(self.target_product)
+        charge_for_quantity = self.charge_for_quantity
+        bundle_quantity = charge_for_quantity + self.free_quantity
+
+        def line_total(cart_item, cart):
+            bundles, remainder = divmod(cart_item.quantity, bundle_quantity)
+            if remainder > charge_for_quantity:
+                bundles += 1
+                remainder = 0
+            return price * ((bundles * charge_for_quantity) + remainder)
+        return line_total
+
+    def compile_minor_units(self, store, places=2, rounding=ROUND_HALF_UP):
+        return self.compile(_MinorUnitPrices(store, places))
+
+    def calculate_line_totals(self, quantities, prices):
+        '''Return line totals, in integer minor units, for sequences of
+        quantities and integer minor unit prices.
+
+        With NumPy installed the whole sequence is evaluated with array
+        operations and a NumPy array is returned, otherwise a list.
+        '''
+        bundle_quantity = self.charge_for_quantity + self.free_quantity
+        if numpy is not None:
+            quantities = numpy.asarray(quantities, dtype=numpy.int64)
+            bundles, remainder = numpy.divmod(quantities, bundle_quantity)
+            # A remainder above charge_for_quantity is charged as a bundle.
+            charge_quantity = bundles * self.charge_for_quantity + numpy.minimum(
+                remainder, self.charge_for_quantity)
+            return charge_quantity * numpy.asarray(prices, dtype=numpy.int64)
+        totals = []
+        for quantity, price in zip(quantities, prices):
+            bundles, remainder = divmod(quantity, bundle_quantity)
+            charge_quantity = bundles * self.charge_for_quantity + min(
+                remainder, self.charge_for_quantity)
+            totals.append(charge_quantity * price)
+        return totals
+
 
 class DependentDiscountOffer(AbstractOffer):
 
-    '''A percentage discount is applied to the target_product in the presence
-    of another product.'''
+    '''
+    A percentage discount is applied to the target_product in the presence
+    of another product.
+
+    dependent_product may also be a sequence of products, all of which must
+    be in the cart. As many units of the target are discounted as there are
+    of the least plentiful dependent product, eg. one discounted snickers bar
+    per mars bar and can of cola:
+
+        DependentDiscountOffer('snickers bar', ('mars bar', 'cola'), Decimal('0.2'))
+    '''
+
+    # dependent_products, the dependent products as a tuple, is a slot
+    # rather than the base class property, as pricing reads it per line.
+    __slots__ = ('dependent_product', 'discount', 'dependent_products')
 
     def __init__(self, target_product, dependent_product, discount, *args, **kwargs):
         self.dependent_product = dependent_product
+        if isinstance(dependent_product, str):
+            self.dependent_products = (dependent_product,)
+        else:
+            self.dependent_products = tuple(dependent_product)
         self.discount = discount
         super(DependentDiscountOffer, self).__init__(
             target_product, *args, **kwargs)
 
+    def _dependent_quantity(self, cart, dependent_products):
+        '''Return the quantity in cart of the least plentiful of
+        dependent_products, or None if any is missing.'''
+        dependent_quantity = None
+        for product in dependent_products:
+            dependent_item = cart.get_item(product)
+            if dependent_item is None:
+                return None
+            if dependent_quantity is None or dependent_item.quantity < dependent_quantity:
+                dependent_quantity = dependent_item.quantity
+        return dependent_quantity
+
+    def _compile_dependent_quantity(self):
+        '''Return a function of cart returning the quantity of the least
+        plentiful dependent product, or None if any is missing.'''
+        dependent_products = self.dependent_products
+        if len(dependent_products) == 1:
+            dependent_product, = dependent_products
+
+            def dependent_quantity(cart):
+                dependent_item = cart.get_item(dependent_product)
+                return None if dependent_item is None else dependent_item.quantity
+        else:
+            def dependent_quantity(cart):
+                return self._dependent_quantity(cart, dependent_products)
+        return dependent_quantity
+
     def calculate_line_total(self, cart_item, store, cart, *args):
         '''Return total for cart_item taking into account the eligible
         discount that may apply in the presence of dependent products in the
         cart.'''
-        try:
-            dependent_quantity = cart.get_item(self.dependent_product).quantity
-        except AttributeError:
+        dependent_quantity = self._dependent_quantity(cart, self.dependent_products)
+        if dependent_quantity is None:
             return cart_item.get_line_total(store)
-        else:
-            # Number of target_product eligible for discount
-            eligible_for_discount = min(dependent_quantity, cart_item.quantity)
-            # Full price of a single target_product
-            single_full_price = store.get_product_price(cart_item.product)
-            # Subtotal for eligible target_product before discount.
-            eligible_subtotal = eligible_for_discount * single_full_price
-            # Total for eligible target_product after discount.
-            eligible_total = eligible_subtotal - \
-                (eligible_subtotal * self.discount)
-            # Total for ineligible target_product
-            remainder_total = (
-                cart_item.quantity - eligible_for_discount) * single_full_price
-
-            return eligible_total + remainder_total
+        # Number of target_product eligible for discount
+        eligible_for_discount = min(dependent_quantity, cart_item.quantity)
+        # Full price of a single target_product
+        single_full_price = store.get_product_price(cart_item.product)
+        # Subtotal for eligible target_product before discount.
+        eligible_subtotal = eligible_for_discount * single_full_price
+        # Total for eligible target_product after discount.
+        eligible_total = eligible_subtotal - \
+            (eligible_subtotal * self.discount)
+        # Total for ineligible target_product
+        remainder_total = (
+            cart_item.quantity - eligible_for_discount) * single_full_price
+
+        return eligible_total + remainder_total
+
+    def compile(self, store):
+        price = store.get_product_price(self.target_product)
+        dependent_quantity = self._compile_dependent_quantity()
+        discount = self.discount
+
+        def line_total(cart_item, cart):
+            quantity = dependent_quantity(cart)
+            if quantity is None:
+                return price * cart_item.quantity
+            eligible_for_discount = min(quantity, cart_item.quantity)
+            eligible_subtotal = eligible_for_discount * price
+            return (eligible_subtotal - (eligible_subtotal * discount)) + \
+                (cart_item.quantity - eligible_for_discount) * price
+        return line_total
+
+    def compile_minor_units(self, store, places=2, rounding=ROUND_HALF_UP):
+        '''Return a function pricing lines in integer minor units, where
+        the discounted part of each line is rounded with the given decimal
+        rounding mode.'''
+        price = _MinorUnitPrices(store, places).get_product_price(self.target_product)
+        dependent_quantity = self._compile_dependent_quantity()
+        discount = Fraction(self.discount)
+        # The discounted price is price * keep_numerator / denominator.
+        keep_numerator = discount.denominator - discount.numerator
+        denominator = discount.denominator
+
+        def line_total(cart_item, cart):
+            quantity = dependent_quantity(cart)
+            if quantity is None:
+                return price * cart_item.quantity
+            eligible_for_discount = min(quantity, cart_item.quantity)
+            return divide(
+                eligible_for_discount * price * keep_numerator, denominator, rounding) + \
+                (cart_item.quantity - eligible_for_discount) * price
+        return line_total
+
+
+class OfferBook(object):
+
+    '''
+    A collection of offers indexed by the products they apply to.
+
+    Cart.get_total accepts an OfferBook in place of a list of offers, so that
+    each cart item only evaluates the offers targeting its product. Build the
+    book once and reuse it across carts:
+
+        offer_book = OfferBook([bogof_strawberries, multibuy_apples])
+        total = cart.get_total(offers=offer_book)
+    '''
+
+    def __init__(self, offers=()):
+        self.offers = []
+        self._fingerprint = None
+        self._by_target = {}
+        self._by_dependent = {}
+        # Maps each dependent product to the target products of the offers
+        # depending on it.
+        self._dependent_targets = {}
+        for offer in offers:
+            self.add(offer)
+
+    def __len__(self):
+        return len(self.offers)
+
+    def __iter__(self):
+        return iter(self.offers)
+
+    def add(self, offer):
+        '''Add an offer to the book.'''
+        self.offers.append(offer)
+        self._fingerprint = None
+        self._by_target.setdefault(offer.target_product, []).append(offer)
+        for product in offer.dependent_products:
+            self._by_dependent.setdefault(product, []).append(offer)
+            self._dependent_targets.setdefault(product, set()).add(offer.target_product)
+
+    def for_product(self, product):
+        '''Return the offers targeting product.'''
+        return self._by_target.get(product, ())
+
+    def depending_on(self, product):
+        '''Return the offers whose outcome depends on product being in the
+        cart.'''
+        return self._by_dependent.get(product, ())
+
+    def affected_by(self, product):
+        '''
+        Return the set of products whose line totals may change when the
+        quantity of product in a cart changes, other than product itself.
+
+        Offers read the quantities of their dependent products, never their
+        line totals, so dependencies don't chain: where snickers bars depend
+        on mars bars, which depend on cola, changing the cola only affects
+        the mars bar line.
+        '''
+        return self._dependent_targets.get(product, frozenset())
+
+    def fingerprint(self):
+        '''Return fingerprint_offers for the book's offers, computed once
+        until an offer is added.'''
+        if self._fingerprint is None:
+            self._fingerprint = fingerprint_offers(self.offers)
+        return self._fingerprint
+
+
+class _MinorUnitPrices(object):
+
+    '''Presents a store's prices as integer minor units, so that compile
+    builds functions pricing in integers.'''
+
+    def __init__(self, store, places):
+        self.store = store
+        self.places = places
+
+    def get_product_price(self, product_name):
+        get_minor_unit_price = getattr(self.store, 'get_minor_unit_price', None)
+        if get_minor_unit_price is not None:
+            return get_minor_unit_price(product_name, self.places)
+        return to_minor_units(self.store.get_product_price(product_name), self.places)
+
+
+def fingerprint_offers(offers):
+    '''
+    Return a digest of offers' classes and attributes, in order.
+
+    The same offers have the same fingerprint in every process, as long as
+    their attributes have stable reprs, as strings, numbers, Decimals and
+    datetimes do.
+    '''
+    digest = hashlib.blake2b(digest_size=16)
+    for offer in offers:
+        digest.update(repr(_offer_state(offer)).encode('utf-8'))
+        digest.update(b'\n')
+    return digest.hexdigest()
+
+
+def _offer_state(offer):
+    '''Return the class name and sorted (name, value) attributes of
+    offer.'''
+    names = set()
+    for cls in type(offer).__mro__:
+        slots = getattr(cls, '__slots__', ())
+        names.update((slots,) if isinstance(slots, str) else slots)
+    attributes = dict(getattr(offer, '__dict__', {}))
+    for name in names:
+        if hasattr(offer, name):
+            attributes[name] = getattr(offer, name)
+    cls = type(offer)
+    return ('{0}.{1}'.format(cls.__module__, cls.__qualname__),
+            sorted(attributes.items()))
+
+
+def as_offer_book(offers):
+    '''Return offers as an OfferBook, or None if no offers are given.
+
+    Anything else with the OfferBook lookup methods, such as the active
+    offers of an OfferSchedule, is returned as it is.
+    '''
+    if offers is None or hasattr(offers, 'for_product'):
+        return offers
+    return OfferBook(offers)
+
+
+def read_offers(fileobj):
+    '''
+    Return a list of offers read from a JSON file holding a list of objects,
+    each naming its offer class with "type" and giving the class's arguments
+    by name:
+
+        [{"type": "MultiBuyOffer", "target_product": "strawberries",
+          "charge_for_quantity": 1, "free_quantity": 1},
+         {"type": "DependentDiscountOffer", "target_product": "snickers bar",
+          "dependent_product": "mars bar", "discount": "0.2"}]
+
+    Discounts, and other numbers with a fraction, are read as Decimals, and
+    lists as tuples. Raises ValueError, giving the offer's position, for an
+    unknown type or invalid arguments.
+    '''
+    offer_classes = dict(
+        (offer_class.__name__, offer_class)
+        for offer_class in (NoOffer, MultiBuyOffer, DependentDiscountOffer))
+    offers = []
+    for index, spec in enumerate(json.load(fileobj, parse_float=Decimal)):
+        try:
+            kwargs = dict(spec)
+            offer_class = offer_classes[kwargs.pop('type')]
+            for name, value in kwargs.items():
+                if isinstance(value, list):
+                    kwargs[name] = tuple(value)
+            if 'discount' in kwargs:
+                kwargs['discount'] = Decimal(kwargs['discount'])
+            offers.append(offer_class(**kwargs))
+        except (KeyError, TypeError, ValueError, InvalidOperation) as error:
+            raise ValueError('Offer {index}: {error!r}'.format(index=index, error=error))
+    return offers
@@ -0,0 +1,105 @@
+'''
+Batch pricing for many carts against one set of offers.
+'''
+from concurrent.futures import ProcessPoolExecutor
+from decimal import Decimal
+
+from cart import Cart
+from offers import as_offer_book
+
+
+class ResolvedPriceStore(object):
+
+    '''
+    Wraps a store, remembering each price once it has been looked up.
+
+    Every cart and offer priced through the wrapper shares its prices, so
+    each product is looked up in the underlying store once per batch.
+    '''
+
+    def __init__(self, store):
+        self.store = store
+        self.prices = {}
+
+    def __contains__(self, product_name):
+        return product_name in self.prices or product_name in self.store
+
+    def prefetch(self, product_names):
+        '''Look up the prices of product_names not yet resolved in one
+        batch, if the store supports batched lookups.'''
+        get_product_prices = getattr(self.store, 'get_product_prices', None)
+        if get_product_prices is not None:
+            self.prices.update(get_product_prices(
+                set(product_names).difference(self.prices)))
+
+    def get_product_price(self, product_name):
+        '''Return the price corresponding with the passed product_name.'''
+        try:
+            return self.prices[product_name]
+        except KeyError:
+            price = self.prices[product_name] = self.store.get_product_price(
+                product_name)
+            return price
+
+
+def price_carts(carts, offers=None, processes=None):
+    '''
+    Return a list of Decimal totals for carts, in the same order as carts.
+
+    offers, a list of offers or an OfferBook, is indexed once and applied to
+    every cart. Prices are looked up once per product for the whole batch,
+    in one get_product_prices call per store where the store has one.
+
+    If processes is given, the carts are split into that many shards which
+    are priced in a process pool. Each shard sends its carts' stores and the
+    offers to its worker once; carts are rebuilt there as plain Carts.
+    '''
+    offer_book = as_offer_book(offers)
+    if processes:
+        return _price_carts_in_pool(list(carts), offer_book, processes)
+
+    carts = list(carts)
+    resolved_stores = {}
+    products = {}
+    for cart in carts:
+        if id(cart.product_store) not in resolved_stores:
+            resolved_stores[id(cart.product_store)] = ResolvedPriceStore(
+                cart.product_store)
+        products.setdefault(id(cart.product_store), set()).update(
+            item.product for item in cart.items)
+    for store_id, product_names in products.items():
+        resolved_stores[store_id].prefetch(product_names)
+
+    totals = []
+    for cart in carts:
+        store = resolved_stores[id(cart.product_store)]
+        totals.append(Decimal(sum(
+            cart._get_line_total(item, offer_book, store) for item in cart.items)))
+    return totals
+
+
+def _price_carts_in_pool(carts, offer_book, processes):
+    '''Return totals for carts priced in shards across a process pool.'''
+    shard_size = -(-len(carts) // processes) or 1
+    shards = [
+        [(cart.product_store, [(item.product, item.quantity) for item in cart.items])
+         for cart in carts[start:start + shard_size]]
+        for start in range(0, len(carts), shard_size)
+    ]
+    totals = []
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        for shard_totals in executor.map(
+                _price_shard, [offer_book] * len(shards), shards):
+            totals.extend(shard_totals)
+    return totals
+
+
+def _price_shard(offer_book, shard):
+    '''Rebuild the carts in shard and return their totals.'''
+    carts = []
+    for store, lines in shard:
+        cart = Cart(store)
+        for product, quantity in lines:
+            cart.add(product, quantity)
+        carts.append(cart)
+    return price_carts(carts, offer_book)
@@ -1,24 +1,54 @@
 import csv
-from decimal import Decimal
+import hashlib
+import sys
+import threading
+import weakref
+from array import array
+from decimal import Decimal, InvalidOperation
+
+from money import from_minor_units, to_minor_units
 
 
 class NoSuchProductError(Exception):
     pass
 
 
+class CatalogueFormatError(Exception):
+
+    '''Raised for a malformed row in a CSV catalogue.'''
+
+    def __init__(self, message, line_number):
+        super(CatalogueFormatError, self).__init__(
+            'Line {line_number}: {message}'.format(
+                line_number=line_number, message=message))
+        self.line_number = line_number
+
+
 class ProductStore(object):
 
-    '''A naive store mapping products to prices.'''
+    '''A store mapping products to prices, indexed by product name.
+
+    version increases each time prices are changed, so that anything caching
+    prices from the store can tell when they are out of date.
+
+    Prices can be changed with update while other threads are pricing carts.
+    Each lookup sees either the old or the new price of a product; to price
+    a whole cart against one version of the catalogue, price it against a
+    snapshot().
+    '''
+
+    version = 0
 
     @classmethod
     def init_from_filepath(cls, filepath):
-        '''Return an instance initialized from a CSV file.'''
-        with open(filepath, 'rb') as csvfile:
-            csvreader = csv.reader(csvfile)
-            items = []
-            for row in csvreader:
-                items.append((row[0], Decimal(row[1])))
-        return cls(items)
+        '''Return an instance initialized from a CSV file.
+
+        Rows are read and validated one at a time as they are added to the
+        store, so a large file is never held in memory as a list. Raises
+        CatalogueFormatError for a malformed row.
+        '''
+        with open(filepath, newline='') as csvfile:
+            return cls(read_catalogue(csvfile))
 
     def __init__(self, items):
         '''Expects items in the format:
@@ -30,13 +60,395 @@ class ProductStore(object):
                 ('snickers bar', Decimal(0.70)),
                 ...
             ]
+
+        Where a product appears more than once, the first price is kept.
         '''
-        self.items = items
+        self.prices = {}
+        for product_name, price in items:
+            self.prices.setdefault(product_name, price)
+        self._init_updates()
+
+    def _init_updates(self):
+        self._lock = threading.Lock()
+        self._snapshots = weakref.WeakSet()
+        # While snapshots are open, maps each changed product name to a list
+        # of (version, previous price) pairs, where previous price is the
+        # price before that version, or None if the product wasn't stored.
+        self._history = {}
+
+    def __getstate__(self):
+        return {'prices': self.prices, 'version': self.version}
+
+    def __setstate__(self, state):
+        self.prices = state['prices']
+        self.version = state['version']
+        self._init_updates()
+
+    @property
+    def items(self):
+        '''Return a list of (product_name, price) tuples.'''
+        return list(self.prices.items())
+
+    def __len__(self):
+        return len(self.prices)
+
+    def __contains__(self, product_name):
+        return product_name in self.prices
 
     def get_product_price(self, product_name):
         '''Return the price corresponding with the passed product_name.'''
-        product_price = next((prod[1] for prod in self.items if prod[0] == product_name), None)
-        if product_price is None:
+        try:
+            return self.prices[product_name]
+        except KeyError:
             raise NoSuchProductError('No such product "{product_name}" in this store.'.format(product_name=product_name))
+
+    def get_minor_unit_price(self, product_name, places=2):
+        '''Return the price of product_name as an integer number of minor
+        units. Raises ValueError if the price isn't exact to places decimal
+        places.'''
+        return to_minor_units(self.get_product_price(product_name), places)
+
+    def fingerprint(self):
+        '''
+        Return a digest of the store's products and prices.
+
+        Unlike version, which counts updates within one process, stores
+        holding the same catalogue have the same fingerprint in every
+        process. It is computed once per version.
+        '''
+        cached = getattr(self, '_fingerprint', None)
+        while cached is None or cached[0] != self.version:
+            version = self.version
+            digest = hashlib.blake2b(digest_size=16)
+            for product_name, price in sorted(self.items):
+                digest.update('{0}\t{1}\n'.format(product_name, price).encode('utf-8'))
+            # Retry if the store was updated while it was being read.
+            if self.version == version:
+                cached = self._fingerprint = (version, digest.hexdigest())
+        return cached[1]
+
+    def get_product_prices(self, product_names):
+        '''Return a dict mapping each of product_names in the store to its
+        price. Products not in the store are left out.'''
+        prices = {}
+        for product_name in product_names:
+            try:
+                prices[product_name] = self.get_product_price(product_name)
+            except NoSuchProductError:
+                pass
+        return prices
+
+    def set_product_price(self, product_name, price):
+        '''Set the price of product_name, adding it if it isn't in the
+        store.'''
+        self.update(prices=[(product_name, price)])
+
+    def delete_product(self, product_name):
+        '''Remove product_name from the store, if it is there.'''
+        self.update(deletes=[product_name])
+
+    def update(self, prices=(), deletes=()):
+        '''
+        Set the price of each (product_name, price) in prices, adding any
+        products not in the store, and remove each product_name in deletes.
+
+        The changes are made in place, costing time in proportion to the
+        number of changes, and become one new version of the store. Snapshots
+        taken before the update continue to see the previous prices.
+
+        Every price is checked before any is changed, so an invalid price
+        raises without changing the store. Should an update still fail part
+        way through, the version increases anyway, so that anything caching
+        prices sees the changes already made.
+        '''
+        prices = [(product_name, self._prepare_price(price))
+                  for product_name, price in prices]
+        with self._lock:
+            version = self.version + 1
+            try:
+                record = bool(self._snapshots)
+                if not record:
+                    self._history.clear()
+                for product_name, price in prices:
+                    if record:
+                        self._record(product_name, version)
+                    self._set_price(product_name, price)
+                for product_name in deletes:
+                    if product_name in self:
+                        if record:
+                            self._record(product_name, version)
+                        self._delete_price(product_name)
+            finally:
+                self.version = version
+
+    def _current_price(self, product_name):
+        '''Return the current price of product_name, or None.'''
+        return self.prices.get(product_name)
+
+    def _prepare_price(self, price):
+        '''Return price as update passes it to _set_price, raising if it
+        can't be stored.'''
+        return price
+
+    def _set_price(self, product_name, price):
+        self.prices[product_name] = price
+
+    def _delete_price(self, product_name):
+        del self.prices[product_name]
+
+    def _record(self, product_name, version):
+        '''Remember the price of product_name before version, for open
+        snapshots. The history is appended before the price is changed.'''
+        history = self._history.setdefault(product_name, [])
+        if not history or history[-1][0] != version:
+            history.append((version, self._current_price(product_name)))
+
+    def snapshot(self):
+        '''Return a read-only view of the store's current prices, which
+        later updates don't change.'''
+        with self._lock:
+            snapshot = ProductStoreSnapshot(self, self.version)
+            self._snapshots.add(snapshot)
+        return snapshot
+
+
+class ProductStoreSnapshot(object):
+
+    '''
+    A read-only view of a ProductStore as it was at one version.
+
+    Lookups read the store's current price, then fall back to the price
+    recorded before the first update made after the snapshot was taken.
+    '''
+
+    def __init__(self, store, version):
+        self.store = store
+        self.version = version
+
+    def _lookup(self, product_name):
+        '''Return the price of product_name at this version, or None.'''
+        # Read the current price before the history, as updates record the
+        # history before changing the price.
+        price = self.store._current_price(product_name)
+        history = self.store._history.get(product_name)
+        if history:
+            for version, previous_price in history:
+                if version > self.version:
+                    return previous_price
+        return price
+
+    @property
+    def items(self):
+        '''Return a list of (product_name, price) tuples.'''
+        with self.store._lock:
+            product_names = set(product_name for product_name, _ in self.store.items)
+            product_names.update(self.store._history)
+            items = [(product_name, self._lookup(product_name))
+                     for product_name in product_names]
+        return [(product_name, price) for product_name, price in items
+                if price is not None]
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, product_name):
+        return self._lookup(product_name) is not None
+
+    def get_product_price(self, product_name):
+        '''Return the price corresponding with the passed product_name.'''
+        price = self._lookup(product_name)
+        if price is None:
+            raise NoSuchProductError('No such product "{product_name}" in this store.'.format(product_name=product_name))
+        return price
+
+    def get_minor_unit_price(self, product_name, places=2):
+        '''Return the price of product_name as an integer number of minor
+        units.'''
+        return to_minor_units(self.get_product_price(product_name), places)
+
+
+class CompactProductStore(ProductStore):
+
+    '''
+    A ProductStore holding prices as integer minor units in an array.
+
+    Product names are interned into a single list, and an open-addressed hash
+    table of list positions (itself an array) indexes them, which avoids a
+    Decimal, an int and a dict entry per product. Prices are converted back to
+    Decimal by get_product_price. Every price must be exact to the given
+    number of decimal places.
+
+    Lookups probe the table in Python, so they are slower than a
+    ProductStore's; use this store where memory matters more.
+
+    Updates are made under a lock, and each new name and price is stored
+    before the table points to it, so lookups never need the lock. A deleted
+    product leaves a tombstone in the table, and a gap in the lists, until
+    the table is next rebuilt. The table and lists are held together in one
+    tuple, which a rebuild replaces at once, so a lookup reads them from one
+    version of the index.
+    '''
+
+    _EMPTY = -1
+    _DELETED = -2
+
+    def __init__(self, items, places=2):
+        self.places = places
+        # (hash table, product names, prices), where table positions hold
+        # indexes into the lists.
+        self._index = (array('q', [self._EMPTY]) * 8, [], array('q'))
+        self._count = 0
+        # Table positions holding a product or a tombstone.
+        self._used = 0
+        for product_name, price in items:
+            position, slot = self._find(product_name, self._index)
+            if slot == self._EMPTY:
+                self._insert(position, product_name, to_minor_units(price, places))
+        self._init_updates()
+
+    def _find(self, product_name, index):
+        '''Return (table position, slot) for product_name in index, where
+        slot is _EMPTY if the product is not in the store.'''
+        table, names, _ = index
+        mask = len(table) - 1
+        position = hash(product_name) & mask
+        while True:
+            slot = table[position]
+            if slot == self._EMPTY:
+                return position, slot
+            if slot != self._DELETED and names[slot] == product_name:
+                return position, slot
+            position = (position + 1) & mask
+
+    def _insert(self, position, product_name, minor_units):
+        '''Add product_name at an empty table position.'''
+        table, names, prices = self._index
+        # Store the name and price before publishing their slot in the table.
+        names.append(sys.intern(product_name))
+        prices.append(minor_units)
+        table[position] = len(names) - 1
+        self._count += 1
+        self._used += 1
+        # Keep the table at most half full.
+        if self._used * 2 > len(table):
+            self._rebuild()
+
+    def _rebuild(self):
+        '''Replace the index with one holding only the products in the
+        store, dropping tombstones and the gaps left by deleted products.
+        The table doubles in size if it would be over a quarter full, and
+        halves while it would be under an eighth full.'''
+        table, names, prices = self._index
+        size = len(table)
+        if self._count * 4 > size:
+            size *= 2
+        while size > 8 and self._count * 8 <= size:
+            size //= 2
+        new_table = array('q', [self._EMPTY]) * size
+        new_names = []
+        new_prices = array('q')
+        mask = size - 1
+        for product_name, price in zip(names, prices):
+            if product_name is None:
+                continue
+            position = hash(product_name) & mask
+            while new_table[position] != self._EMPTY:
+                position = (position + 1) & mask
+            new_table[position] = len(new_names)
+            new_names.append(product_name)
+            new_prices.append(price)
+        self._used = self._count
+        self._index = (new_table, new_names, new_prices)
+
+    @property
+    def items(self):
+        '''Return a list of (product_name, price) tuples.'''
+        _, names, prices = self._index
+        return [(product_name, from_minor_units(price, self.places))
+                for product_name, price in zip(names, prices)
+                if product_name is not None]
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, product_name):
+        return self._find(product_name, self._index)[1] != self._EMPTY
+
+    def get_product_price(self, product_name):
+        '''Return the price corresponding with the passed product_name.'''
+        index = self._index
+        slot = self._find(product_name, index)[1]
+        if slot == self._EMPTY:
+            raise NoSuchProductError('No such product "{product_name}" in this store.'.format(product_name=product_name))
+        return from_minor_units(index[2][slot], self.places)
+
+    def get_minor_unit_price(self, product_name, places=2):
+        '''Return the price of product_name as an integer number of minor
+        units, without converting through Decimal where places matches the
+        store's.'''
+        if places != self.places:
+            return super(CompactProductStore, self).get_minor_unit_price(product_name, places)
+        index = self._index
+        slot = self._find(product_name, index)[1]
+        if slot == self._EMPTY:
+            raise NoSuchProductError('No such product "{product_name}" in this store.'.format(product_name=product_name))
+        return index[2][slot]
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        for name in ('_lock', '_snapshots', '_history'):
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_updates()
+
+    def _current_price(self, product_name):
+        index = self._index
+        slot = self._find(product_name, index)[1]
+        if slot == self._EMPTY:
+            return None
+        return from_minor_units(index[2][slot], self.places)
+
+    def _prepare_price(self, price):
+        return to_minor_units(price, self.places)
+
+    def _set_price(self, product_name, minor_units):
+        position, slot = self._find(product_name, self._index)
+        if slot == self._EMPTY:
+            self._insert(position, product_name, minor_units)
         else:
-            return product_price
+            self._index[2][slot] = minor_units
+
+    def _delete_price(self, product_name):
+        table, names, _ = self._index
+        position, slot = self._find(product_name, self._index)
+        table[position] = self._DELETED
+        names[slot] = None
+        self._count -= 1
+
+
+def read_catalogue(csvfile):
+    '''
+    Yield (product_name, price) tuples from the rows of a CSV catalogue.
+
+    Each row must hold a product name and a price. Blank rows are skipped.
+    Raises CatalogueFormatError, with the line number, for any other row.
+    '''
+    csvreader = csv.reader(csvfile)
+    for row in csvreader:
+        if not row:
+            continue
+        if len(row) != 2 or not row[0]:
+            raise CatalogueFormatError(
+                'expected a product name and a price, got {row!r}'.format(row=row),
+                csvreader.line_num)
+        try:
+            price = Decimal(row[1])
+        except InvalidOperation:
+            price = None
+        if price is None or not price.is_finite() or price < 0:
+            raise CatalogueFormatError(
+                'invalid price {price!r}'.format(price=row[1]), csvreader.line_num)
+        yield row[0], price
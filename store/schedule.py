@@ -0,0 +1,204 @@
+'''
+Offers scheduled to apply between start and end times.
+
+An OfferSchedule holds every offer, past, current and future, and indexes
+each product's offers by time, so the offers active for a product at any
+moment are found without testing every offer:
+
+    schedule = OfferSchedule([
+        MultiBuyOffer('strawberries', 1, 1,
+                      start=datetime(2024, 6, 1), end=datetime(2024, 6, 8)),
+        ...
+    ])
+    total = cart.get_total(offers=schedule.active())
+'''
+import bisect
+from datetime import datetime
+from operator import itemgetter
+
+
+class OfferSchedule(object):
+
+    '''
+    A registry of offers with start and end times, indexed by product and
+    time.
+
+    Each product's offers are indexed in an _OfferTimeline, built when the
+    product is first looked up and rebuilt after an offer is added for it.
+
+    Times may be datetimes, timestamps or anything else comparable, as long
+    as one kind is used throughout. clock returns the current time, and
+    defaults to datetime.now.
+    '''
+
+    def __init__(self, offers=(), clock=datetime.now):
+        self.clock = clock
+        self.offers = []
+        self._by_target = {}
+        self._by_dependent = {}
+        # Maps product to its _OfferTimeline, built on demand.
+        self._timelines = {}
+        for offer in offers:
+            self.add(offer)
+
+    def __len__(self):
+        return len(self.offers)
+
+    def __iter__(self):
+        return iter(self.offers)
+
+    def add(self, offer):
+        '''Add an offer to the schedule.'''
+        self.offers.append(offer)
+        self._by_target.setdefault(offer.target_product, []).append(offer)
+        for product in offer.dependent_products:
+            self._by_dependent.setdefault(product, []).append(offer)
+        self._timelines.pop(offer.target_product, None)
+
+    def _timeline(self, product):
+        '''Return the _OfferTimeline of product's offers.'''
+        timeline = self._timelines.get(product)
+        if timeline is None:
+            timeline = self._timelines[product] = _OfferTimeline(
+                self._by_target.get(product, ()))
+        return timeline
+
+    def active_for_product(self, product, at):
+        '''Return the offers targeting product that are active at at, in
+        the order they were added.'''
+        return self._timeline(product).active(at)
+
+    def active(self, at=None):
+        '''Return the offers active at at, or now, which Cart.get_total and
+        the other pricing functions accept in place of an OfferBook.'''
+        return ActiveOffers(self, self.clock() if at is None else at)
+
+
+class _OfferTimeline(object):
+
+    '''
+    Offers indexed by the times they apply, built in O(k log k) time for k
+    offers. Finding the m offers active at a time takes O(log k + m), plus
+    sorting them back into the order they were given.
+
+    Offers without a start or an end always apply, and those missing just
+    one are kept sorted by the other. The rest are held in a centred
+    interval tree. Each node holds the offers active at its centre time,
+    sorted by start and by end. Its left subtree holds the offers ending at
+    or before the centre, and its right subtree those starting after it.
+    '''
+
+    def __init__(self, offers):
+        # Offers are held as (position, offer) entries, so that the offers
+        # found can be put back in order.
+        self._always = []
+        starting = []
+        ending = []
+        bounded = []
+        for entry in enumerate(offers):
+            # Offers not setting start or end apply at all times.
+            start = getattr(entry[1], 'start', None)
+            end = getattr(entry[1], 'end', None)
+            if start is None and end is None:
+                self._always.append(entry)
+            elif end is None:
+                starting.append((start, entry))
+            elif start is None:
+                ending.append((end, entry))
+            elif start < end:
+                bounded.append((start, end, entry))
+        starting.sort(key=itemgetter(0))
+        ending.sort(key=itemgetter(0))
+        self._starts = [start for start, _ in starting]
+        self._starting = [entry for _, entry in starting]
+        self._ends = [end for end, _ in ending]
+        self._ending = [entry for _, entry in ending]
+        self._root = self._build(
+            sorted(bounded, key=itemgetter(0)), sorted(bounded, key=itemgetter(1)))
+
+    def _build(self, by_start, by_end):
+        '''Return the tree node for (start, end, entry) intervals, given
+        sorted by start and by end, or None if there are none.
+
+        Filtering keeps each list sorted, so nothing is sorted again below
+        the root, and centring each node on its median start halves the
+        intervals left for its subtrees.'''
+        if not by_start:
+            return None
+        center = by_start[len(by_start) // 2][0]
+        node_by_start = [interval for interval in by_start
+                         if interval[0] <= center < interval[1]]
+        node_by_end = [interval for interval in by_end
+                       if interval[0] <= center < interval[1]]
+        left = self._build(
+            [interval for interval in by_start if interval[1] <= center],
+            [interval for interval in by_end if interval[1] <= center])
+        right = self._build(
+            [interval for interval in by_start if center < interval[0]],
+            [interval for interval in by_end if center < interval[0]])
+        return (center,
+                [interval[0] for interval in node_by_start],
+                [interval[2] for interval in node_by_start],
+                [interval[1] for interval in node_by_end],
+                [interval[2] for interval in node_by_end],
+                left, right)
+
+    def active(self, at):
+        '''Return a tuple of the offers active at at, in their original
+        order.'''
+        found = list(self._always)
+        found.extend(self._starting[:bisect.bisect_right(self._starts, at)])
+        found.extend(self._ending[bisect.bisect_right(self._ends, at):])
+        node = self._root
+        while node is not None:
+            center, starts, by_start, ends, by_end, left, right = node
+            if at < center:
+                # Every offer here ends after at, so those started apply.
+                found.extend(by_start[:bisect.bisect_right(starts, at)])
+                node = left
+            elif center < at:
+                # Every offer here started before at, so those not ended apply.
+                found.extend(by_end[bisect.bisect_right(ends, at):])
+                node = right
+            else:
+                found.extend(by_start)
+                break
+        found.sort(key=itemgetter(0))
+        return tuple(offer for _, offer in found)
+
+
+class ActiveOffers(object):
+
+    '''
+    The offers of an OfferSchedule active at one time, looked up as from an
+    OfferBook.
+
+    Pricing every cart in a checkout against one ActiveOffers prices them
+    all at the same moment, even if an offer starts or ends part way
+    through.
+    '''
+
+    def __init__(self, schedule, at):
+        self.schedule = schedule
+        self.at = at
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __iter__(self):
+        return (offer for offer in self.schedule if offer.is_active(self.at))
+
+    def for_product(self, product):
+        '''Return the active offers targeting product.'''
+        return self.schedule.active_for_product(product, self.at)
+
+    def depending_on(self, product):
+        '''Return the active offers whose outcome depends on product being
+        in the cart.'''
+        return [offer for offer in self.schedule._by_dependent.get(product, ())
+                if offer.is_active(self.at)]
+
+    def affected_by(self, product):
+        '''Return the set of products whose line totals may change when the
+        quantity of product in a cart changes, other than product itself.'''
+        return set(offer.target_product for offer in self.depending_on(product))
@@ -0,0 +1,256 @@
+'''
+An asyncio pricing service sharing one catalogue and offer set.
+
+Clients connect over a Unix socket (or TCP) and send one JSON request per
+line, each holding the lines of a cart:
+
+    {"id": 1, "lines": [["apple", 2], ["strawberries", 3]]}
+
+and receive one JSON response per line, in the order sent:
+
+    {"id": 1, "total": "6.30"}
+
+Concurrent requests are priced in micro-batches against a PricingTable
+compiled once from the service's offers, read with --offers from a JSON file
+as described by offers.read_offers. Run the service, and a load test against
+it, from the store directory:
+
+    python service.py serve --socket /tmp/pricing.sock --catalogue products.csv --offers offers.json
+    python service.py loadtest --socket /tmp/pricing.sock --catalogue products.csv
+'''
+import argparse
+import asyncio
+import json
+import random
+from time import perf_counter
+
+from cart import Cart
+from compiled import PricingTable
+from offers import read_offers
+from product import NoSuchProductError, ProductStore
+
+
+class PricingService(object):
+
+    '''
+    Prices carts against one store and offer set, batching concurrent
+    requests.
+
+    Requests wait up to max_delay seconds for others to join their batch,
+    and a batch is priced as soon as it holds max_batch requests.
+    '''
+
+    def __init__(self, store, offers=None, max_batch=64, max_delay=0.001):
+        self.store = store
+        self.pricing_table = PricingTable(offers, store)
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.batches = 0
+        self._queue = None
+        self._batcher = None
+
+    async def start(self):
+        '''Start pricing queued requests.'''
+        self._queue = asyncio.Queue()
+        self._batcher = asyncio.ensure_future(self._run_batches())
+
+    async def stop(self):
+        '''Stop pricing queued requests.'''
+        self._batcher.cancel()
+        try:
+            await self._batcher
+        except asyncio.CancelledError:
+            pass
+
+    async def price(self, lines):
+        '''Return the Decimal total for a cart of (product, quantity) lines.'''
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((lines, future))
+        return await future
+
+    async def _run_batches(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_delay
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            self._price_batch(batch)
+
+    def _price_batch(self, batch):
+        '''Price a batch of requests, looking up the prices of every
+        product in the batch that the pricing table hasn't seen at once.'''
+        self.batches += 1
+        carts = []
+        for lines, future in batch:
+            if future.cancelled():
+                continue
+            try:
+                cart = Cart(self.store)
+                for product, quantity in lines:
+                    cart.add(product, quantity)
+            except Exception as error:
+                future.set_exception(error)
+            else:
+                carts.append((cart, future))
+        try:
+            self.pricing_table.prefetch(
+                cart_item.product for cart, _ in carts for cart_item in cart.items)
+        except Exception as error:
+            for _, future in carts:
+                future.set_exception(error)
+            return
+        for cart, future in carts:
+            try:
+                future.set_result(self.pricing_table.get_total(cart))
+            except Exception as error:
+                future.set_exception(error)
+
+    async def handle_connection(self, reader, writer):
+        '''Answer each JSON request line from reader on writer.'''
+        pending = asyncio.Queue()
+        respond = asyncio.ensure_future(self._respond(pending, writer))
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                await pending.put(asyncio.ensure_future(self._answer(line)))
+        finally:
+            await pending.put(None)
+            await respond
+
+    async def _answer(self, line):
+        request_id = None
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                return {'id': None, 'error': 'Bad request: expected a JSON object'}
+            request_id = request.get('id')
+            total = await self.price(request['lines'])
+        except NoSuchProductError as error:
+            return {'id': request_id, 'error': str(error)}
+        except (ValueError, KeyError, TypeError) as error:
+            return {'id': request_id, 'error': 'Bad request: {0}'.format(error)}
+        return {'id': request_id, 'total': str(total)}
+
+    async def _respond(self, pending, writer):
+        '''Write responses in the order their requests arrived.'''
+        try:
+            while True:
+                answer = await pending.get()
+                if answer is None:
+                    break
+                writer.write(json.dumps(await answer).encode('utf-8') + b'\n')
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, path=None, host='127.0.0.1', port=0):
+        '''Start the service and return an asyncio server listening on the
+        Unix socket at path, or else on host and port.'''
+        await self.start()
+        if path is not None:
+            return await asyncio.start_unix_server(self.handle_connection, path)
+        return await asyncio.start_server(self.handle_connection, host, port)
+
+
+async def _open_connection(path=None, host='127.0.0.1', port=None):
+    if path is not None:
+        return await asyncio.open_unix_connection(path)
+    return await asyncio.open_connection(host, port)
+
+
+async def run_load_test(carts, requests=1000, concurrency=50,
+                        path=None, host='127.0.0.1', port=None):
+    '''
+    Send requests pricing requests, cycling through carts (lists of
+    (product, quantity) lines), over concurrency connections.
+
+    Return a dict of the request count, elapsed seconds, throughput in
+    requests per second, and p50 and p99 latency in seconds.
+    '''
+    latencies = []
+    per_connection = [requests // concurrency] * concurrency
+    for index in range(requests % concurrency):
+        per_connection[index] += 1
+
+    async def client(connection_index, count):
+        reader, writer = await _open_connection(path, host, port)
+        try:
+            for request_index in range(count):
+                cart = carts[(connection_index + request_index * concurrency) % len(carts)]
+                started = perf_counter()
+                writer.write(json.dumps({'lines': cart}).encode('utf-8') + b'\n')
+                await writer.drain()
+                await reader.readline()
+                latencies.append(perf_counter() - started)
+        finally:
+            writer.close()
+
+    started = perf_counter()
+    await asyncio.gather(*[
+        client(index, count) for index, count in enumerate(per_connection) if count])
+    elapsed = perf_counter() - started
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'seconds': elapsed,
+        'throughput': len(latencies) / elapsed if elapsed else 0.0,
+        'p50': _percentile(latencies, 0.50),
+        'p99': _percentile(latencies, 0.99),
+    }
+
+
+def _percentile(ordered, fraction):
+    '''Return the value at fraction through the ordered list of values.'''
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('command', choices=['serve', 'loadtest'])
+    parser.add_argument('--socket', help='Unix socket path')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8642)
+    parser.add_argument('--catalogue', required=True, help='CSV catalogue')
+    parser.add_argument('--offers', help='JSON offers to serve with')
+    parser.add_argument('--requests', type=int, default=10000)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--lines', type=int, default=10, help='lines per cart')
+    args = parser.parse_args(argv)
+    store = ProductStore.init_from_filepath(args.catalogue)
+
+    if args.command == 'serve':
+        offers = None
+        if args.offers:
+            with open(args.offers) as offers_file:
+                offers = read_offers(offers_file)
+
+        async def serve():
+            service = PricingService(store, offers)
+            server = await service.serve(args.socket, args.host, args.port)
+            async with server:
+                await server.serve_forever()
+        asyncio.run(serve())
+    else:
+        product_names = [product_name for product_name, _ in store.items]
+        rng = random.Random(0)
+        carts = [[[rng.choice(product_names), rng.randint(1, 5)]
+                  for _ in range(args.lines)] for _ in range(1000)]
+        report = asyncio.run(run_load_test(
+            carts, args.requests, args.concurrency,
+            args.socket, args.host, args.port))
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,277 @@
+'''
+A catalogue partitioned across worker processes.
+
+ShardedProductStore splits products between shards by a hash of their name,
+and each shard is held by its own worker process, so no one process holds
+the whole catalogue. Lookups are routed to the shard holding the product;
+batched lookups with get_product_prices send one request to each shard
+involved, and the shards answer in parallel.
+'''
+import multiprocessing
+import threading
+import zlib
+
+from product import NoSuchProductError, ProductStore
+
+# Products are sent to the workers in chunks of this many while loading.
+LOAD_CHUNK_SIZE = 10000
+
+
+class SnapshotNotSupportedError(NotImplementedError):
+
+    '''Raised by ShardedProductStore.snapshot. Price a batch of carts
+    with price_carts to see one version of a sharded store.'''
+
+
+def shard_for(product_name, shards):
+    '''Return the shard index for product_name. Unlike hash(), this is the
+    same in every process.'''
+    return zlib.crc32(product_name.encode('utf-8')) % shards
+
+
+def _serve_shard(connection, store_class):
+    '''
+    Build a store_class from the products sent over connection, then answer
+    requests against it until told to close.
+
+    Each answer is a pair of (True, result), or (False, exception) where
+    building the store or answering the request raised one, after which the
+    worker carries on serving.
+    '''
+    items = []
+    while True:
+        chunk = connection.recv()
+        if chunk is None:
+            break
+        if chunk == ('close', None):
+            # The store was abandoned while it was being loaded.
+            connection.close()
+            return
+        items.extend(chunk)
+    store = None
+    try:
+        store = store_class(items)
+        answer = (True, len(store))
+    except Exception as error:
+        answer = (False, error)
+    del items
+    _send_answer(connection, answer)
+    while True:
+        command, argument = connection.recv()
+        if command == 'close':
+            connection.close()
+            return
+        try:
+            if command == 'get':
+                result = store.get_product_prices(argument)
+            elif command == 'contains':
+                result = argument in store
+            elif command == 'len':
+                result = len(store)
+            elif command == 'items':
+                result = store.items
+            elif command == 'update':
+                prices, deletes = argument
+                store.update(prices, deletes)
+                result = None
+            else:
+                raise ValueError('Unknown command {command!r}'.format(command=command))
+            answer = (True, result)
+        except Exception as error:
+            answer = (False, error)
+        _send_answer(connection, answer)
+
+
+def _send_answer(connection, answer):
+    '''Send answer over connection, replacing an exception that can't be
+    pickled with a RuntimeError describing it.'''
+    try:
+        connection.send(answer)
+    except Exception:
+        connection.send((False, RuntimeError(repr(answer[1]))))
+
+
+def _result(answer):
+    '''Return the result of a worker's answer, or raise its exception.'''
+    ok, result = answer
+    if not ok:
+        raise result
+    return result
+
+
+class ShardedProductStore(ProductStore):
+
+    '''
+    A ProductStore whose products are held by shards worker processes, each
+    in a store_class.
+
+    Workers are started when the store is created and stop when it is
+    closed, or with the process that created it. Each request is a round
+    trip to a worker, so price carts against it with price_carts, which
+    looks up a batch's prices together, or wrap it in a CachedProductStore.
+
+    Updates are routed to the shards holding each product. A single
+    get_product_prices call, like an update, holds every shard it involves
+    until all have answered, so it sees each update entirely or not at all.
+    price_carts makes one such call per batch, and so prices a batch against
+    one version of the store. snapshot() raises SnapshotNotSupportedError,
+    and the store can't be pickled.
+
+        with ShardedProductStore.init_from_filepath('products.csv') as store:
+            total = cart.get_total()
+    '''
+
+    def __init__(self, items, shards=4, store_class=ProductStore):
+        context = multiprocessing.get_context()
+        self.shards = shards
+        self._connections = []
+        self._locks = []
+        self._workers = []
+        for _ in range(shards):
+            connection, worker_connection = context.Pipe()
+            worker = context.Process(
+                target=_serve_shard, args=(worker_connection, store_class),
+                daemon=True)
+            worker.start()
+            worker_connection.close()
+            self._connections.append(connection)
+            self._locks.append(threading.Lock())
+            self._workers.append(worker)
+        self._lock = threading.Lock()
+
+        chunks = [[] for _ in range(shards)]
+        try:
+            for product_name, price in items:
+                shard = shard_for(product_name, shards)
+                chunks[shard].append((product_name, price))
+                if len(chunks[shard]) >= LOAD_CHUNK_SIZE:
+                    self._connections[shard].send(chunks[shard])
+                    chunks[shard] = []
+            for connection, chunk in zip(self._connections, chunks):
+                if chunk:
+                    connection.send(chunk)
+                connection.send(None)
+        except BaseException:
+            # Reading items failed, eg. on a malformed catalogue row, so stop
+            # the workers, which may still be waiting for products.
+            self.close()
+            raise
+        answers = [connection.recv() for connection in self._connections]
+        try:
+            self._count = sum(_result(answer) for answer in answers)
+        except Exception:
+            self.close()
+            raise
+
+    def __getstate__(self):
+        raise TypeError('A ShardedProductStore cannot be pickled.')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        '''Stop the worker processes.'''
+        for connection, lock, worker in zip(
+                self._connections, self._locks, self._workers):
+            with lock:
+                if not connection.closed:
+                    connection.send(('close', None))
+                    connection.close()
+            worker.join()
+
+    def _request(self, shard, command, argument=None):
+        '''Return the answer of shard to command.'''
+        with self._locks[shard]:
+            self._connections[shard].send((command, argument))
+            answer = self._connections[shard].recv()
+        return _result(answer)
+
+    def _request_all(self, requests):
+        '''Send each shard its (command, argument) in requests, a dict keyed
+        by shard, and return a dict of their answers.
+
+        Every shard's answer is read before the first exception raised by a
+        shard is raised again.'''
+        shards = sorted(requests)
+        for shard in shards:
+            self._locks[shard].acquire()
+        try:
+            for shard in shards:
+                self._connections[shard].send(requests[shard])
+            answers = [(shard, self._connections[shard].recv()) for shard in shards]
+        finally:
+            for shard in shards:
+                self._locks[shard].release()
+        return dict((shard, _result(answer)) for shard, answer in answers)
+
+    @property
+    def items(self):
+        '''Return a list of (product_name, price) tuples.'''
+        items = []
+        for answer in self._request_all(
+                dict((shard, ('items', None)) for shard in range(self.shards))).values():
+            items.extend(answer)
+        return items
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, product_name):
+        return self._request(shard_for(product_name, self.shards), 'contains', product_name)
+
+    def get_product_price(self, product_name):
+        '''Return the price corresponding with the passed product_name.'''
+        prices = self._request(
+            shard_for(product_name, self.shards), 'get', [product_name])
+        try:
+            return prices[product_name]
+        except KeyError:
+            raise NoSuchProductError('No such product "{product_name}" in this store.'.format(product_name=product_name))
+
+    def get_product_prices(self, product_names):
+        '''Return a dict mapping each of product_names in the store to its
+        price. Products not in the store are left out.'''
+        requests = {}
+        for product_name in product_names:
+            requests.setdefault(
+                shard_for(product_name, self.shards), ('get', []))[1].append(product_name)
+        prices = {}
+        for answer in self._request_all(requests).values():
+            prices.update(answer)
+        return prices
+
+    def update(self, prices=(), deletes=()):
+        '''
+        Set the price of each (product_name, price) in prices, adding any
+        products not in the store, and remove each product_name in deletes.
+
+        Each shard applies its part of the changes as one update, and the
+        store's version increases once. If a shard raises an exception it is
+        raised again here, once the store's size and version are brought up
+        to date with the shards that accepted their changes.
+        '''
+        changes = {}
+        for product_name, price in prices:
+            changes.setdefault(
+                shard_for(product_name, self.shards), ([], []))[0].append((product_name, price))
+        for product_name in deletes:
+            changes.setdefault(
+                shard_for(product_name, self.shards), ([], []))[1].append(product_name)
+        with self._lock:
+            try:
+                self._request_all(dict(
+                    (shard, ('update', change)) for shard, change in changes.items()))
+            finally:
+                self._count = sum(self._request_all(dict(
+                    (shard, ('len', None)) for shard in range(self.shards))).values())
+                self.version += 1
+
+    def snapshot(self):
+        '''Raise SnapshotNotSupportedError, as the shards keep no history.
+        price_carts prices a batch against one version of the store.'''
+        raise SnapshotNotSupportedError(
+            'ShardedProductStore does not support snapshots; '
+            'use price_carts to price carts against one version of the store.')
@@ -0,0 +1,175 @@
+'''
+Customer-optimal pricing of carts against competing offers.
+
+Cart.get_total applies the single cheapest offer to the whole of each line.
+OfferSolver may instead split a line's units between the offers targeting it,
+eg. three strawberries priced as a buy one get one free pair plus one
+strawberry at 20% off, with any units left over at full price. Each offer
+prices at most one share of the line, through its calculate_line_total, and
+each unit of a dependent product counts towards at most one
+DependentDiscountOffer's share, so a line never has more units discounted
+than there are of its dependent products.
+
+Offers only read the quantity of other lines, never their totals, so the
+lines of a cart are solved independently.
+'''
+from decimal import Decimal
+from time import perf_counter
+
+from cache import LRUCache
+from cart import CartItem
+from offers import DependentDiscountOffer, MultiBuyOffer, as_offer_book
+
+
+class OfferSolver(object):
+
+    '''
+    Prices each cart line at the cheapest split of its units between the
+    offers targeting it, found by dynamic programming over quantities.
+
+    A line whose solution would take more than max_work steps, counting
+    each offer share evaluated and each extension of a partial solution by a
+    share, falls back to Cart.get_total's cheapest single offer, as does
+    every line once time_budget seconds have been spent on a cart, including
+    a line being solved when the time runs out. Solutions are memoized by
+    offers, quantity, dependent quantities and price in a bounded LRU cache.
+    '''
+
+    def __init__(self, max_work=100000, time_budget=None, cache_size=10000):
+        self.max_work = max_work
+        self.time_budget = time_budget
+        self.cache = LRUCache(cache_size)
+
+    def get_total(self, cart, offers=None):
+        '''Return the lowest total for cart under offers as a Decimal.'''
+        offer_book = as_offer_book(offers)
+        store = cart.product_store
+        deadline = None
+        if self.time_budget is not None:
+            deadline = perf_counter() + self.time_budget
+        totals = []
+        for item in cart.items:
+            line_offers = () if offer_book is None else offer_book.for_product(item.product)
+            line_total = None
+            if line_offers and (deadline is None or perf_counter() < deadline):
+                line_total = self.get_line_total(
+                    item, line_offers, store, cart, deadline)
+            if line_total is None:
+                line_total = cart._get_line_total(item, offer_book, store)
+            totals.append(line_total)
+        return Decimal(sum(totals))
+
+    def get_line_total(self, cart_item, offers, store, cart, deadline=None):
+        '''
+        Return the lowest total for cart_item under offers, all of which
+        target its product.
+
+        Returns None if solving the line would take more than max_work
+        steps, or would carry on past deadline, a perf_counter time.
+        '''
+        quantity = cart_item.quantity
+        if quantity * len(offers) > self.max_work:
+            return None
+        shares = [(offer, self._share_sizes(offer, quantity, cart))
+                  for offer in offers]
+        if quantity * sum(len(sizes) for _, sizes in shares) > self.max_work:
+            return None
+
+        price = store.get_product_price(cart_item.product)
+        key = (tuple(offers), quantity, price, tuple(
+            _quantity_in_cart(cart, product)
+            for offer in offers for product in offer.dependent_products))
+        line_total = self.cache.get(key)
+        if line_total is None:
+            line_total = self._solve(cart_item, shares, price, store, cart, deadline)
+            if line_total is not None:
+                self.cache.put(key, line_total)
+        return line_total
+
+    def _solve(self, cart_item, shares, price, store, cart, deadline=None):
+        '''Return the lowest total for cart_item, where shares pairs each
+        offer with the share sizes worth trying, or None if that would take
+        more than max_work steps or run past deadline.'''
+        quantity = cart_item.quantity
+        dependent_products = []
+        for offer, _ in shares:
+            if isinstance(offer, DependentDiscountOffer):
+                for product in offer.dependent_products:
+                    if product not in dependent_products:
+                        dependent_products.append(product)
+        available = [_quantity_in_cart(cart, product) for product in dependent_products]
+        # best maps (n, claimed) to the lowest total for n units using the
+        # offers so far, with any units not in an offer's share at full
+        # price, where claimed counts the units of each dependent product
+        # already used by DependentDiscountOffer shares.
+        unclaimed = (0,) * len(dependent_products)
+        best = dict(((units, unclaimed), price * units)
+                    for units in range(quantity + 1))
+        # Partial solutions multiply with the dependent quantities, so the
+        # work is counted as it grows, before each offer is tried.
+        work = 0
+        for offer, sizes in shares:
+            work += len(sizes) * (len(best) + 1)
+            if work > self.max_work:
+                return None
+            share_totals = [
+                (size, offer.calculate_line_total(
+                    CartItem(cart_item.product, size), store, cart))
+                for size in sizes]
+            claims = ()
+            if isinstance(offer, DependentDiscountOffer):
+                claims = sorted(set(
+                    dependent_products.index(product)
+                    for product in offer.dependent_products))
+            updated = dict(best)
+            for (units, claimed), total_so_far in best.items():
+                if deadline is not None and perf_counter() >= deadline:
+                    return None
+                for size, share_total in share_totals:
+                    if units + size > quantity:
+                        break
+                    if claims:
+                        claimed_after = list(claimed)
+                        for index in claims:
+                            claimed_after[index] += size
+                        # Sizes ascend, so no larger share fits either.
+                        if any(claimed_after[index] > available[index] for index in claims):
+                            break
+                        claimed_after = tuple(claimed_after)
+                    else:
+                        claimed_after = claimed
+                    key = (units + size, claimed_after)
+                    total = total_so_far + share_total
+                    if key not in updated or total < updated[key]:
+                        updated[key] = total
+            best = updated
+        return min(total for (units, _), total in best.items() if units == quantity)
+
+    def _share_sizes(self, offer, quantity, cart):
+        '''
+        Return, in ascending order, the share sizes worth giving offer on a
+        line of quantity units.
+
+        Other sizes are pruned where they can't beat a smaller share plus
+        units at full price.
+        '''
+        if isinstance(offer, MultiBuyOffer):
+            # A share ending part way through a bundle only helps if it
+            # includes free units.
+            bundle_quantity = offer.charge_for_quantity + offer.free_quantity
+            return [size for size in range(1, quantity + 1)
+                    if size % bundle_quantity == 0 or
+                    size % bundle_quantity > offer.charge_for_quantity]
+        if isinstance(offer, DependentDiscountOffer):
+            # Units beyond the dependent quantity are charged at full price.
+            eligible = min([quantity] + [
+                _quantity_in_cart(cart, product)
+                for product in offer.dependent_products])
+            return list(range(1, eligible + 1))
+        return list(range(1, quantity + 1))
+
+
+def _quantity_in_cart(cart, product):
+    '''Return the quantity of product in cart, or 0.'''
+    cart_item = cart.get_item(product)
+    return 0 if cart_item is None else cart_item.quantity
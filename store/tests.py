@@ -1,10 +1,34 @@
+import asyncio
+import io
+import json
+import multiprocessing
 import os
+import pickle
+import random
+import shutil
+import tempfile
+import threading
 import unittest
-from decimal import Decimal
-
-from cart import Cart, CartItem
-from product import ProductStore, NoSuchProductError
-from offers import NoOffer, MultiBuyOffer, DependentDiscountOffer
+from decimal import ROUND_CEILING, ROUND_FLOOR, ROUND_HALF_EVEN, ROUND_HALF_UP, Decimal
+from time import perf_counter
+
+from benchmarks import benchmark_object_memory, run_suite
+from cache import CachedProductStore, LRUCache, OfferResultCache
+from cart import Cart, CartItem, IncrementalCart, carts_from_records
+from compiled import MinorUnitPricingTable, PricingTable
+import instrumentation
+from mapped import MappedProductStore, compile_catalogue, compile_csv_catalogue
+import money
+from money import from_minor_units, to_minor_units
+from pricing import price_carts
+from service import PricingService, run_load_test
+from schedule import OfferSchedule
+from sharded import ShardedProductStore, SnapshotNotSupportedError
+from solver import OfferSolver
+from product import (ProductStore, CompactProductStore, NoSuchProductError,
+                     CatalogueFormatError, read_catalogue)
+from offers import (AbstractOffer, NoOffer, MultiBuyOffer, DependentDiscountOffer, OfferBook,
+                    fingerprint_offers, read_offers)
 
 
 class CartTest(unittest.TestCase):
@@ -96,6 +120,45 @@ class CartTest(unittest.TestCase):
         cart = Cart()
         self.assertEqual(cart.get_item('apple'), None)
 
+    def test_items_keep_insertion_order(self):
+        '''Cart items are indexed in the order they were first added.'''
+        cart = Cart()
+        cart.add('apple')
+        cart.add('orange')
+        cart.add('apple')
+        self.assertEqual([item.product for item in cart], ['apple', 'orange'])
+        self.assertTrue(cart[1] is cart.get_item('orange'))
+
+    def test_remove_item(self):
+        '''Removing an item without a quantity removes its CartItem.'''
+        cart = Cart()
+        cart.add('apple', 3)
+        cart.add('orange')
+        cart.remove('apple')
+        self.assertEqual(len(cart), 1)
+        self.assertEqual(cart.get_item('apple'), None)
+        self.assertEqual(cart[0].product, 'orange')
+
+    def test_remove_with_quantity(self):
+        '''Removing an item with a quantity reduces the quantity of an
+        existing item.'''
+        cart = Cart()
+        cart.add('apple', 3)
+        cart.remove('apple', 2)
+        self.assertEqual(cart.get_item('apple').quantity, 1)
+
+    def test_remove_all_of_quantity(self):
+        '''Removing an item's whole quantity removes its CartItem.'''
+        cart = Cart()
+        cart.add('apple', 3)
+        cart.remove('apple', 3)
+        self.assertEqual(len(cart), 0)
+
+    def test_remove_item_not_in_cart(self):
+        '''Removing an item that is not in the cart returns None.'''
+        cart = Cart()
+        self.assertEqual(cart.remove('apple'), None)
+
     def test_get_total_one_item(self):
         '''Correct total for one item in cart.'''
         cart = Cart(self._create_product_store())
@@ -155,6 +218,15 @@ class CartItemTest(unittest.TestCase):
         cartitem = CartItem('apple', 3)
         self.assertEqual(cartitem.quantity, 3)
 
+    def test_no_instance_dict(self):
+        '''CartItem and offer instances store their attributes in slots,
+        without a per-instance __dict__.'''
+        for instance in (CartItem('apple', 3),
+                         NoOffer('apple'),
+                         MultiBuyOffer('apple', 2, 1),
+                         DependentDiscountOffer('apple', 'ice cream', Decimal('0.2'))):
+            self.assertFalse(hasattr(instance, '__dict__'))
+
     def test_get_line_total(self):
         '''Cart.get_line_total() returns the correct price for product.'''
         product_store = self._create_product_store()
@@ -194,6 +266,100 @@ class ProductStoreTest(unittest.TestCase):
         product_store = self._create_product_store()
         self.assertRaises(NoSuchProductError, product_store.get_product_price, 'bike')
 
+    def test_duplicate_product_keeps_first_price(self):
+        '''The first price given for a duplicated product is used.'''
+        product_store = ProductStore([
+            ('apple', Decimal('0.15')),
+            ('apple', Decimal('0.20')),
+        ])
+        self.assertEqual(len(product_store), 1)
+        self.assertEqual(
+            product_store.get_product_price('apple'), Decimal('0.15'))
+
+    def test_set_product_price(self):
+        '''Setting a product's price changes the price and the store's
+        version.'''
+        product_store = self._create_product_store()
+        version = product_store.version
+        product_store.set_product_price('apple', Decimal('0.10'))
+        product_store.set_product_price('bike', Decimal('99.00'))
+        self.assertEqual(product_store.get_product_price('apple'), Decimal('0.10'))
+        self.assertEqual(product_store.get_product_price('bike'), Decimal('99.00'))
+        self.assertEqual(product_store.version, version + 2)
+
+    def test_update(self):
+        '''Updating the store upserts and deletes products as one new
+        version.'''
+        product_store = self._create_product_store()
+        product_store.update(
+            prices=[('apple', Decimal('0.10')), ('bike', Decimal('99.00'))],
+            deletes=['ice cream', 'unicycle'])
+        self.assertEqual(product_store.version, 1)
+        self.assertEqual(product_store.get_product_price('apple'), Decimal('0.10'))
+        self.assertEqual(product_store.get_product_price('bike'), Decimal('99.00'))
+        self.assertRaises(
+            NoSuchProductError, product_store.get_product_price, 'ice cream')
+        self.assertEqual(len(product_store), 4)
+
+    def test_snapshot_keeps_prices(self):
+        '''A snapshot keeps the prices of the version it was taken at.'''
+        product_store = self._create_product_store()
+        product_store.set_product_price('apple', Decimal('0.12'))
+        snapshot = product_store.snapshot()
+        product_store.update(
+            prices=[('apple', Decimal('0.10')), ('bike', Decimal('99.00'))],
+            deletes=['ice cream'])
+        product_store.set_product_price('apple', Decimal('0.05'))
+        self.assertEqual(snapshot.get_product_price('apple'), Decimal('0.12'))
+        self.assertEqual(snapshot.get_product_price('ice cream'), Decimal('3.49'))
+        self.assertRaises(NoSuchProductError, snapshot.get_product_price, 'bike')
+        self.assertEqual(sorted(snapshot.items), sorted([
+            ('apple', Decimal('0.12')),
+            ('ice cream', Decimal('3.49')),
+            ('strawberries', Decimal('2.00')),
+            ('snickers bar', Decimal('0.70')),
+        ]))
+        self.assertEqual(product_store.get_product_price('apple'), Decimal('0.05'))
+
+    def test_updates_while_pricing(self):
+        '''Carts priced against a snapshot in other threads see one version
+        of the store while it is updated.'''
+        product_store = ProductStore(
+            [('product-{0}'.format(i), Decimal(1)) for i in range(100)])
+        totals = []
+
+        def price_carts():
+            for _ in range(50):
+                cart = Cart(product_store.snapshot())
+                for i in range(100):
+                    cart.add('product-{0}'.format(i))
+                totals.append(cart.get_total())
+
+        threads = [threading.Thread(target=price_carts) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for price in range(2, 100):
+            product_store.update(prices=[
+                ('product-{0}'.format(i), Decimal(price)) for i in range(100)])
+        for thread in threads:
+            thread.join()
+        for total in totals:
+            self.assertEqual(total % 100, 0)
+
+    def test_pickle(self):
+        '''A pickled ProductStore keeps its prices and version.'''
+        product_store = self._create_product_store()
+        product_store.set_product_price('apple', Decimal('0.10'))
+        unpickled = pickle.loads(pickle.dumps(product_store))
+        self.assertEqual(unpickled.get_product_price('apple'), Decimal('0.10'))
+        self.assertEqual(unpickled.version, 1)
+
+    def test_contains(self):
+        '''ProductStore supports membership tests by product name.'''
+        product_store = self._create_product_store()
+        self.assertTrue('apple' in product_store)
+        self.assertFalse('bike' in product_store)
+
     def test_init_from_filepath(self):
         '''ProductStore object can be created from csv file.'''
         csv_filepath = os.path.abspath('test_products.csv')
@@ -208,6 +374,385 @@ class ProductStoreTest(unittest.TestCase):
         self.assertEqual(
             product_store.get_product_price('apple'), Decimal('0.15'))
 
+    def test_read_catalogue_skips_blank_rows(self):
+        '''Blank rows in a csv catalogue are ignored.'''
+        csvfile = io.StringIO('apple,0.15\n\nice cream,3.49\n')
+        self.assertEqual(list(read_catalogue(csvfile)), [
+            ('apple', Decimal('0.15')), ('ice cream', Decimal('3.49'))])
+
+    def test_read_catalogue_missing_price(self):
+        '''A row without a price raises CatalogueFormatError with its line
+        number.'''
+        csvfile = io.StringIO('apple,0.15\nice cream\n')
+        with self.assertRaises(CatalogueFormatError) as context:
+            list(read_catalogue(csvfile))
+        self.assertEqual(context.exception.line_number, 2)
+
+    def test_read_catalogue_invalid_price(self):
+        '''A row with an unparseable or negative price raises
+        CatalogueFormatError with its line number.'''
+        for price in ('free', '-1.00', 'NaN'):
+            csvfile = io.StringIO('apple,0.15\n\nice cream,{0}\n'.format(price))
+            with self.assertRaises(CatalogueFormatError) as context:
+                list(read_catalogue(csvfile))
+            self.assertEqual(context.exception.line_number, 3)
+
+
+class CompactProductStoreTest(unittest.TestCase):
+
+    '''Tests for the array-backed CompactProductStore.'''
+
+    def _create_product_store(self):
+        '''Helper method to create populated CompactProductStore.'''
+        products = [
+            ('apple', Decimal('0.15')),
+            ('ice cream', Decimal('3.49')),
+            ('strawberries', Decimal('2.00')),
+            ('snickers bar', Decimal('0.70')),
+        ]
+        return CompactProductStore(products)
+
+    def test_get_product_price(self):
+        '''CompactProductStore returns corresponding Decimal price for
+        product.'''
+        product_store = self._create_product_store()
+        price = product_store.get_product_price('strawberries')
+        self.assertTrue(type(price) is Decimal)
+        self.assertEqual(price, Decimal('2.00'))
+
+    def test_get_product_price_no_product(self):
+        '''CompactProductStore raises exception when no product matches.'''
+        product_store = self._create_product_store()
+        self.assertRaises(NoSuchProductError, product_store.get_product_price, 'bike')
+        self.assertFalse('bike' in product_store)
+
+    def test_many_products(self):
+        '''Every product can be found after the index has grown.'''
+        products = [('product-{0}'.format(i), Decimal(i) / 100) for i in range(1000)]
+        product_store = CompactProductStore(products)
+        self.assertEqual(len(product_store), 1000)
+        for product_name, price in products:
+            self.assertEqual(product_store.get_product_price(product_name), price)
+
+    def test_duplicate_product_keeps_first_price(self):
+        '''The first price given for a duplicated product is used.'''
+        product_store = CompactProductStore([
+            ('apple', Decimal('0.15')),
+            ('apple', Decimal('0.20')),
+        ])
+        self.assertEqual(product_store.items, [('apple', Decimal('0.15'))])
+
+    def test_set_product_price(self):
+        '''Setting a product's price updates an existing product or adds a
+        new one.'''
+        product_store = self._create_product_store()
+        product_store.set_product_price('apple', Decimal('0.10'))
+        for i in range(20):
+            product_store.set_product_price('product-{0}'.format(i), Decimal(i))
+        self.assertEqual(product_store.get_product_price('apple'), Decimal('0.10'))
+        self.assertEqual(product_store.get_product_price('product-19'), Decimal('19'))
+        self.assertEqual(len(product_store), 24)
+        self.assertEqual(product_store.version, 21)
+
+    def test_price_with_too_many_places(self):
+        '''A price that isn't a whole number of minor units raises
+        ValueError.'''
+        self.assertRaises(
+            ValueError, CompactProductStore, [('apple', Decimal('0.155'))])
+
+    def test_invalid_update_changes_nothing(self):
+        '''An update with a price that can't be stored raises without
+        changing any price.'''
+        product_store = self._create_product_store()
+        cached_store = CachedProductStore(product_store)
+        self.assertEqual(cached_store.get_product_price('apple'), Decimal('0.15'))
+        with self.assertRaises(ValueError):
+            product_store.update(
+                prices=[('apple', Decimal('0.20')), ('bike', Decimal('0.155'))])
+        self.assertEqual(product_store.get_product_price('apple'), Decimal('0.15'))
+        self.assertFalse('bike' in product_store)
+        product_store.set_product_price('apple', Decimal('0.20'))
+        self.assertEqual(cached_store.get_product_price('apple'), Decimal('0.20'))
+
+    def test_delete_product(self):
+        '''Deleted products are gone, and can be added again, however many
+        tombstones they leave.'''
+        product_store = self._create_product_store()
+        product_store.update(
+            prices=[('bike', Decimal('99.00'))], deletes=['ice cream', 'unicycle'])
+        self.assertRaises(
+            NoSuchProductError, product_store.get_product_price, 'ice cream')
+        self.assertFalse('ice cream' in product_store)
+        self.assertEqual(len(product_store), 4)
+        for i in range(100):
+            product_store.set_product_price('product-{0}'.format(i), Decimal(i))
+            product_store.delete_product('product-{0}'.format(i))
+        product_store.set_product_price('ice cream', Decimal('3.00'))
+        self.assertEqual(product_store.get_product_price('ice cream'), Decimal('3.00'))
+        self.assertEqual(sorted(product_store.items), [
+            ('apple', Decimal('0.15')),
+            ('bike', Decimal('99.00')),
+            ('ice cream', Decimal('3.00')),
+            ('snickers bar', Decimal('0.70')),
+            ('strawberries', Decimal('2.00')),
+        ])
+
+    def test_deleted_products_are_compacted(self):
+        '''Deleting and adding products again doesn't grow the store's
+        lists or table without bound.'''
+        product_store = self._create_product_store()
+        for i in range(10000):
+            product_store.set_product_price('product-{0}'.format(i), Decimal(i))
+            product_store.delete_product('product-{0}'.format(i))
+        table, names, prices = product_store._index
+        self.assertLessEqual(len(names), 32)
+        self.assertLessEqual(len(prices), 32)
+        self.assertLessEqual(len(table), 64)
+        self.assertEqual(len(product_store), 4)
+        self.assertEqual(product_store.get_product_price('apple'), Decimal('0.15'))
+
+    def test_snapshot_keeps_prices(self):
+        '''A snapshot keeps the prices of the version it was taken at.'''
+        product_store = self._create_product_store()
+        snapshot = product_store.snapshot()
+        product_store.update(
+            prices=[('apple', Decimal('0.10')), ('bike', Decimal('99.00'))],
+            deletes=['ice cream'])
+        self.assertEqual(snapshot.get_product_price('apple'), Decimal('0.15'))
+        self.assertEqual(snapshot.get_product_price('ice cream'), Decimal('3.49'))
+        self.assertRaises(NoSuchProductError, snapshot.get_product_price, 'bike')
+        self.assertEqual(len(snapshot), 4)
+
+    def test_pickle(self):
+        '''A pickled store keeps its prices and can still be updated.'''
+        product_store = pickle.loads(pickle.dumps(self._create_product_store()))
+        product_store.delete_product('apple')
+        self.assertEqual(len(product_store), 3)
+        self.assertEqual(
+            product_store.get_product_price('strawberries'), Decimal('2.00'))
+
+    def test_lookups_while_updating(self):
+        '''Lookups in other threads find every product while products are
+        added and deleted.'''
+        product_store = self._create_product_store()
+        errors = []
+        done = threading.Event()
+
+        def look_up():
+            while not done.is_set():
+                try:
+                    'product-7' in product_store
+                    self.assertEqual(
+                        product_store.get_product_price('apple'), Decimal('0.15'))
+                    self.assertEqual(
+                        product_store.get_product_price('strawberries'), Decimal('2.00'))
+                except Exception as error:
+                    errors.append(error)
+                    return
+
+        threads = [threading.Thread(target=look_up) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for i in range(2000):
+            product_store.set_product_price('product-{0}'.format(i), Decimal(i))
+            if i % 3:
+                product_store.delete_product('product-{0}'.format(i - 1))
+        done.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def test_init_from_filepath(self):
+        '''CompactProductStore object can be created from csv file.'''
+        csv_filepath = os.path.abspath('test_products.csv')
+        product_store = CompactProductStore.init_from_filepath(csv_filepath)
+        self.assertEqual(len(product_store), 5)
+        self.assertEqual(
+            product_store.get_product_price('mars bar'), Decimal('0.65'))
+
+
+class MappedProductStoreTest(unittest.TestCase):
+
+    '''Tests for compiled, memory-mapped catalogues.'''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.directory, 'products.catalogue')
+        compile_csv_catalogue(os.path.abspath('test_products.csv'), self.filepath)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_get_product_price(self):
+        '''MappedProductStore returns corresponding price for every product
+        in the compiled csv file.'''
+        with MappedProductStore(self.filepath) as product_store:
+            self.assertEqual(len(product_store), 5)
+            for product_name, price in ProductStore.init_from_filepath(
+                    os.path.abspath('test_products.csv')).items:
+                self.assertEqual(
+                    product_store.get_product_price(product_name), price)
+
+    def test_get_product_price_no_product(self):
+        '''MappedProductStore raises exception when no product matches.'''
+        with MappedProductStore(self.filepath) as product_store:
+            self.assertRaises(
+                NoSuchProductError, product_store.get_product_price, 'bike')
+            self.assertFalse('bike' in product_store)
+            self.assertFalse('zzz' in product_store)
+
+    def test_unicode_product_names(self):
+        '''Product names are not limited to ASCII.'''
+        compile_catalogue([
+            ('crème brûlée', Decimal('2.50')), ('apple', Decimal('0.15')),
+        ], self.filepath)
+        with MappedProductStore(self.filepath) as product_store:
+            self.assertEqual(
+                product_store.get_product_price('crème brûlée'), Decimal('2.50'))
+            self.assertEqual(product_store.items[0], ('apple', Decimal('0.15')))
+
+    def test_not_a_catalogue(self):
+        '''Opening a file that isn't a compiled catalogue raises ValueError.'''
+        self.assertRaises(
+            ValueError, MappedProductStore, os.path.abspath('test_products.csv'))
+
+    def test_pickle(self):
+        '''A pickled MappedProductStore maps the same file when unpickled.'''
+        with MappedProductStore(self.filepath) as product_store:
+            with pickle.loads(pickle.dumps(product_store)) as unpickled:
+                self.assertEqual(
+                    unpickled.get_product_price('apple'), Decimal('0.15'))
+
+    def test_cart_total(self):
+        '''A Cart can be priced from a MappedProductStore.'''
+        with MappedProductStore(self.filepath) as product_store:
+            cart = Cart(product_store)
+            cart.add('strawberries', 2)
+            cart.add('apple')
+            self.assertEqual(cart.get_total(
+                offers=[MultiBuyOffer('strawberries', 1, 1)]), Decimal('2.15'))
+
+
+class ShardedProductStoreTest(unittest.TestCase):
+
+    '''Tests for a catalogue sharded across worker processes.'''
+
+    def setUp(self):
+        self.product_store = ShardedProductStore.init_from_filepath(
+            os.path.abspath('test_products.csv'))
+
+    def tearDown(self):
+        self.product_store.close()
+
+    def test_get_product_price(self):
+        '''ShardedProductStore returns corresponding price for every product
+        in the csv file.'''
+        expected = ProductStore.init_from_filepath(
+            os.path.abspath('test_products.csv')).items
+        self.assertEqual(len(self.product_store), len(expected))
+        self.assertEqual(sorted(self.product_store.items), sorted(expected))
+        for product_name, price in expected:
+            self.assertTrue(product_name in self.product_store)
+            self.assertEqual(self.product_store.get_product_price(product_name), price)
+        self.assertRaises(
+            NoSuchProductError, self.product_store.get_product_price, 'bike')
+
+    def test_get_product_prices(self):
+        '''Batched lookups return the prices of the products in the store
+        and leave out the rest.'''
+        self.assertEqual(
+            self.product_store.get_product_prices(['apple', 'bike', 'strawberries']),
+            {'apple': Decimal('0.15'), 'strawberries': Decimal('2.00')})
+
+    def test_cart_and_update(self):
+        '''Carts price against a sharded store, which routes updates to the
+        right shards.'''
+        cart = Cart(self.product_store)
+        cart.add('strawberries', 2)
+        cart.add('apple')
+        offers = [MultiBuyOffer('strawberries', 1, 1)]
+        self.assertEqual(cart.get_total(offers), Decimal('2.15'))
+        self.product_store.update(
+            prices=[('strawberries', Decimal('1.50')), ('bike', Decimal('99.00'))],
+            deletes=['apple'])
+        self.assertEqual(self.product_store.version, 1)
+        self.assertEqual(len(self.product_store), 5)
+        self.assertEqual(self.product_store.get_product_price('bike'), Decimal('99.00'))
+        self.assertFalse('apple' in self.product_store)
+        cart.remove('apple')
+        self.assertEqual(price_carts([cart], offers), [Decimal('1.50')])
+
+    def test_shard_errors_are_raised(self):
+        '''An exception in a shard is raised by the request that caused it,
+        and the shard carries on serving.'''
+        with ShardedProductStore(
+                [('apple', Decimal('0.15')), ('strawberries', Decimal('2.00'))],
+                shards=2, store_class=CompactProductStore) as product_store:
+            with self.assertRaises(ValueError):
+                product_store.update(prices=[('apple', Decimal('0.155'))])
+            self.assertEqual(product_store.version, 1)
+            self.assertEqual(product_store.get_product_price('apple'), Decimal('0.15'))
+            product_store.update(prices=[('bike', Decimal('99.00'))])
+            self.assertEqual(len(product_store), 3)
+
+    def test_malformed_catalogue_stops_workers(self):
+        '''Workers are stopped when reading the catalogue fails.'''
+        workers = set(multiprocessing.active_children())
+        directory = tempfile.mkdtemp()
+        try:
+            csv_filepath = os.path.join(directory, 'products.csv')
+            with open(csv_filepath, 'w') as csvfile:
+                csvfile.write('apple,0.15\nstrawberries\n')
+            with self.assertRaises(CatalogueFormatError):
+                ShardedProductStore.init_from_filepath(csv_filepath)
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual(set(multiprocessing.active_children()), workers)
+
+    def test_snapshot_not_supported(self):
+        '''Taking a snapshot raises SnapshotNotSupportedError.'''
+        self.assertRaises(SnapshotNotSupportedError, self.product_store.snapshot)
+
+    def test_store_class_error(self):
+        '''An exception building a shard's store is raised by the
+        constructor.'''
+        with self.assertRaises(ValueError):
+            ShardedProductStore(
+                [('apple', Decimal('0.155'))], shards=2, store_class=CompactProductStore)
+
+
+class MoneyTest(unittest.TestCase):
+
+    '''Tests for converting to and from minor units.'''
+
+    def test_to_minor_units(self):
+        '''Decimal amounts convert to whole minor units.'''
+        self.assertEqual(to_minor_units(Decimal('3.49')), 349)
+        self.assertEqual(to_minor_units(Decimal('2')), 200)
+        self.assertEqual(to_minor_units(Decimal('0.125'), places=3), 125)
+
+    def test_to_minor_units_inexact(self):
+        '''Amounts with more decimal places than minor units raise
+        ValueError.'''
+        self.assertRaises(ValueError, to_minor_units, Decimal('0.125'))
+
+    def test_from_minor_units(self):
+        '''Minor units convert back to the same Decimal amount.'''
+        self.assertEqual(from_minor_units(349), Decimal('3.49'))
+        self.assertEqual(str(from_minor_units(200)), '2.00')
+
+    def test_divide_matches_decimal_rounding(self):
+        '''Integer division rounds as Decimal does in every supported
+        mode.'''
+        for rounding in money.ROUNDING_MODES:
+            for numerator in range(-25, 26):
+                for denominator in (1, 2, 4, 5, -10):
+                    expected = int((Decimal(numerator) / Decimal(denominator)).to_integral_value(
+                        rounding=rounding))
+                    self.assertEqual(
+                        money.divide(numerator, denominator, rounding), expected)
+        self.assertRaises(ValueError, money.divide, 1, 2, 'ROUND_05UP')
+
 
 class NoOfferTest(unittest.TestCase):
 
@@ -505,6 +1050,33 @@ class DependentDiscountOfferTest(unittest.TestCase):
         self.assertEqual(mars_snickers_20_discount.calculate_line_total(
             mars_cartitem, product_store, cart), Decimal('1.17'))
 
+    def test_dependent_products_normalised_once(self):
+        '''dependent_products is a tuple built when the offer is
+        created.'''
+        for dependent_product in ('snickers bar', ['snickers bar', 'apple']):
+            offer = DependentDiscountOffer('mars bar', dependent_product, Decimal('0.2'))
+            self.assertTrue(type(offer.dependent_products) is tuple)
+            self.assertTrue(offer.dependent_products is offer.dependent_products)
+        self.assertEqual(offer.dependent_products, ('snickers bar', 'apple'))
+
+    def test_multiple_dependents(self):
+        '''With several dependent products, all must be present, and as many
+        targets are discounted as there are of the least plentiful.'''
+        product_store = self._create_product_store()
+        mars_snickers_apple_20_discount = DependentDiscountOffer(
+            'mars bar', ('snickers bar', 'apple'), Decimal('0.2'))
+        cart = Cart(product_store)
+        mars_cartitem = cart.add('mars bar', 3)
+        cart.add('snickers bar', 2)
+        self.assertEqual(mars_snickers_apple_20_discount.calculate_line_total(
+            mars_cartitem, product_store, cart), Decimal('1.95'))
+        cart.add('apple')
+        self.assertEqual(mars_snickers_apple_20_discount.calculate_line_total(
+            mars_cartitem, product_store, cart), Decimal('1.82'))
+        self.assertEqual(
+            mars_snickers_apple_20_discount.compile(product_store)(mars_cartitem, cart),
+            Decimal('1.82'))
+
 
 class CartOffersTest(unittest.TestCase):
 
@@ -555,3 +1127,1439 @@ class CartOffersTest(unittest.TestCase):
         cart.add('apple')
         self.assertEqual(cart.get_total(
             offers=[bogof_strawberries, strawberries_apple_20_discount]), Decimal('2.15'))
+
+    def test_get_total_with_offer_book(self):
+        '''Cart get_total accepts an OfferBook and returns the same total as
+        for a list of offers.'''
+        product_store = self._create_product_store()
+        offers = [
+            MultiBuyOffer('strawberries', 1, 1),
+            DependentDiscountOffer('strawberries', 'apple', Decimal('0.2')),
+            MultiBuyOffer('mars bar', 2, 1),
+        ]
+        cart = Cart(product_store)
+        cart.add('strawberries', 2)
+        cart.add('apple')
+        self.assertEqual(
+            cart.get_total(offers=OfferBook(offers)), cart.get_total(offers=offers))
+
+
+class OfferBookTest(unittest.TestCase):
+
+    '''Tests for indexing offers with OfferBook.'''
+
+    def test_for_product(self):
+        '''OfferBook returns only the offers targeting a product.'''
+        bogof_strawberries = MultiBuyOffer('strawberries', 1, 1)
+        multibuy_apples = MultiBuyOffer('apple', 2, 1)
+        offer_book = OfferBook([bogof_strawberries, multibuy_apples])
+        self.assertEqual(
+            list(offer_book.for_product('strawberries')), [bogof_strawberries])
+        self.assertEqual(list(offer_book.for_product('bike')), [])
+
+    def test_depending_on(self):
+        '''OfferBook returns the dependent discount offers that depend on a
+        product.'''
+        mars_snickers_20_discount = DependentDiscountOffer(
+            'mars bar', 'snickers bar', Decimal('0.2'))
+        offer_book = OfferBook(
+            [mars_snickers_20_discount, MultiBuyOffer('snickers bar', 1, 1)])
+        self.assertEqual(
+            list(offer_book.depending_on('snickers bar')), [mars_snickers_20_discount])
+        self.assertEqual(list(offer_book.depending_on('mars bar')), [])
+
+    def test_affected_by(self):
+        '''OfferBook returns the targets of the offers depending on a
+        product, without following chains of dependencies.'''
+        offer_book = OfferBook([
+            DependentDiscountOffer('mars bar', 'snickers bar', Decimal('0.2')),
+            DependentDiscountOffer('ice cream', ('snickers bar', 'apple'), Decimal('0.1')),
+            DependentDiscountOffer('snickers bar', 'apple', Decimal('0.2')),
+        ])
+        self.assertEqual(offer_book.affected_by('snickers bar'), {'mars bar', 'ice cream'})
+        self.assertEqual(offer_book.affected_by('apple'), {'ice cream', 'snickers bar'})
+        self.assertEqual(offer_book.affected_by('mars bar'), set())
+
+
+class ReadOffersTest(unittest.TestCase):
+
+    '''Tests for reading offers from JSON.'''
+
+    def test_read_offers(self):
+        '''Offers are built from their type and named arguments.'''
+        offers = read_offers(io.StringIO(json.dumps([
+            {'type': 'MultiBuyOffer', 'target_product': 'strawberries',
+             'charge_for_quantity': 1, 'free_quantity': 1},
+            {'type': 'DependentDiscountOffer', 'target_product': 'snickers bar',
+             'dependent_product': ['mars bar', 'apple'], 'discount': '0.2'},
+        ])))
+        self.assertEqual(fingerprint_offers(offers), fingerprint_offers([
+            MultiBuyOffer('strawberries', 1, 1),
+            DependentDiscountOffer('snickers bar', ('mars bar', 'apple'), Decimal('0.2')),
+        ]))
+        self.assertTrue(type(offers[1].discount) is Decimal)
+
+    def test_invalid_offers(self):
+        '''Unknown types and invalid arguments raise ValueError giving the
+        offer's position.'''
+        for spec in ({'type': 'FreeLunchOffer', 'target_product': 'apple'},
+                     {'type': 'MultiBuyOffer', 'target_product': 'apple'},
+                     {'type': 'DependentDiscountOffer', 'target_product': 'apple',
+                      'dependent_product': 'mars bar', 'discount': 'lots'},
+                     ['MultiBuyOffer']):
+            with self.assertRaisesRegex(ValueError, 'Offer 1'):
+                read_offers(io.StringIO(json.dumps([{'type': 'NoOffer', 'target_product': 'apple'}, spec])))
+
+
+class CountingOffer(MultiBuyOffer):
+
+    '''A MultiBuyOffer that counts calls to calculate_line_total.'''
+
+    calls = 0
+
+    def calculate_line_total(self, cart_item, store, *args):
+        self.calls += 1
+        return super(CountingOffer, self).calculate_line_total(
+            cart_item, store, *args)
+
+
+class OfferScheduleTest(unittest.TestCase):
+
+    '''Tests for offers with start and end times.'''
+
+    def _create_product_store(self):
+        '''Helper method to create populated ProductStore.'''
+        products = [
+            ('apple', Decimal('0.15')),
+            ('strawberries', Decimal('2.00')),
+            ('snickers bar', Decimal('0.70')),
+            ('mars bar', Decimal('0.65'))
+        ]
+        return ProductStore(products)
+
+    def test_is_active(self):
+        '''An offer is active from its start up to but not including its
+        end.'''
+        offer = MultiBuyOffer('strawberries', 1, 1, start=10, end=20)
+        self.assertEqual(
+            [offer.is_active(at) for at in (9, 10, 19, 20)],
+            [False, True, True, False])
+        self.assertTrue(NoOffer('apple').is_active(0))
+        self.assertTrue(DependentDiscountOffer(
+            'mars bar', 'snickers bar', Decimal('0.2'), end=5).is_active(4))
+
+    def test_offer_without_times(self):
+        '''An offer subclass that doesn't call AbstractOffer.__init__ is
+        always active.'''
+
+        class OwnInitOffer(MultiBuyOffer):
+
+            def __init__(self, target_product):
+                self.target_product = target_product
+                self.charge_for_quantity = 1
+                self.free_quantity = 1
+
+        offer = OwnInitOffer('strawberries')
+        self.assertTrue(offer.is_active(10))
+        schedule = OfferSchedule([offer, MultiBuyOffer('strawberries', 2, 1, start=20)])
+        self.assertEqual(schedule.active_for_product('strawberries', 10), (offer,))
+        self.assertEqual(len(schedule.active(10)), 1)
+
+    def test_active_for_product(self):
+        '''The schedule returns the offers on a product active at a
+        time.'''
+        always = MultiBuyOffer('strawberries', 2, 1)
+        june = MultiBuyOffer('strawberries', 1, 1, start=10, end=20)
+        late_june = NoOffer('strawberries', start=15, end=30)
+        from_july = MultiBuyOffer('strawberries', 3, 1, start=20)
+        schedule = OfferSchedule([always, june, late_june, from_july])
+        self.assertEqual(schedule.active_for_product('strawberries', 5), (always,))
+        self.assertEqual(schedule.active_for_product('strawberries', 15),
+                         (always, june, late_june))
+        self.assertEqual(schedule.active_for_product('strawberries', 20),
+                         (always, late_june, from_july))
+        self.assertEqual(schedule.active_for_product('strawberries', 30),
+                         (always, from_july))
+        self.assertEqual(schedule.active_for_product('apple', 15), ())
+
+    def test_matches_linear_filter(self):
+        '''Lookups agree with testing every offer, as offers are added.'''
+        rng = random.Random(0)
+        schedule = OfferSchedule()
+        for _ in range(200):
+            start = rng.choice([None, rng.randint(0, 100)])
+            end = rng.choice([None, rng.randint(0, 100)])
+            schedule.add(NoOffer(rng.choice(['apple', 'strawberries']), start, end))
+            at = rng.randint(-5, 105)
+            for product in ('apple', 'strawberries'):
+                self.assertEqual(
+                    list(schedule.active_for_product(product, at)),
+                    [offer for offer in schedule
+                     if offer.target_product == product and offer.is_active(at)])
+
+    def test_many_overlapping_offers(self):
+        '''Tens of thousands of overlapping offers on one product are
+        indexed in well under a second, and lookups agree with testing every
+        offer.'''
+        rng = random.Random(0)
+        offers = []
+        for _ in range(20000):
+            start = rng.randint(0, 10000)
+            offers.append(NoOffer('apple', start, start + rng.randint(1, 5000)))
+        schedule = OfferSchedule(offers)
+        started = perf_counter()
+        schedule.active_for_product('apple', 0)
+        self.assertLess(perf_counter() - started, 2)
+        for at in (-1, 0, 2500, 5000, 10000, 15000):
+            self.assertEqual(
+                list(schedule.active_for_product('apple', at)),
+                [offer for offer in offers if offer.is_active(at)])
+
+    def test_get_total(self):
+        '''Carts are priced against the offers active at a time, by default
+        the schedule's clock.'''
+        product_store = self._create_product_store()
+        now = [0]
+        schedule = OfferSchedule([
+            MultiBuyOffer('strawberries', 1, 1, start=10, end=20),
+            DependentDiscountOffer('mars bar', 'snickers bar', Decimal('0.2'), start=15),
+        ], clock=lambda: now[0])
+        cart = Cart(product_store)
+        cart.add('strawberries', 2)
+        cart.add('mars bar')
+        cart.add('snickers bar')
+        self.assertEqual(cart.get_total(schedule.active()), Decimal('5.35'))
+        self.assertEqual(cart.get_total(schedule.active(10)), Decimal('3.35'))
+        now[0] = 15
+        self.assertEqual(cart.get_total(schedule.active()), Decimal('3.22'))
+        active = schedule.active(25)
+        self.assertEqual(len(active), 1)
+        self.assertEqual(active.affected_by('snickers bar'), {'mars bar'})
+        self.assertEqual(
+            PricingTable(active, product_store).get_total(cart), Decimal('5.22'))
+
+
+class IncrementalCartTest(unittest.TestCase):
+
+    '''Test IncrementalCart reprices only the lines affected by a
+    change.'''
+
+    def _create_product_store(self):
+        '''Helper method to create populated ProductStore.'''
+        products = [
+            ('apple', Decimal('0.15')),
+            ('ice cream', Decimal('3.49')),
+            ('strawberries', Decimal('2.00')),
+            ('snickers bar', Decimal('0.70')),
+            ('mars bar', Decimal('0.65'))
+        ]
+        return ProductStore(products)
+
+    def _create_offers(self):
+        '''Helper method to create a list of offers.'''
+        return [
+            MultiBuyOffer('strawberries', 1, 1),
+            DependentDiscountOffer('mars bar', 'snickers bar', Decimal('0.2')),
+            MultiBuyOffer('apple', 2, 1),
+        ]
+
+    def test_total_matches_cart(self):
+        '''IncrementalCart totals match Cart totals after each change.'''
+        product_store = self._create_product_store()
+        offers = self._create_offers()
+        cart = Cart(product_store)
+        incremental_cart = IncrementalCart(product_store, offers)
+        changes = [
+            ('add', 'strawberries', 3),
+            ('add', 'mars bar', 2),
+            ('add', 'snickers bar', 1),
+            ('add', 'apple', 4),
+            ('remove', 'snickers bar', None),
+            ('add', 'snickers bar', 2),
+            ('remove', 'apple', 1),
+        ]
+        for method, product, quantity in changes:
+            for each_cart in (cart, incremental_cart):
+                if quantity is None:
+                    getattr(each_cart, method)(product)
+                else:
+                    getattr(each_cart, method)(product, quantity)
+            self.assertEqual(
+                incremental_cart.get_total(), cart.get_total(offers))
+
+    def test_add_reprices_only_changed_line(self):
+        '''Adding an item only reprices that item's line.'''
+        product_store = self._create_product_store()
+        bogof_strawberries = CountingOffer('strawberries', 1, 1)
+        cart = IncrementalCart(product_store, [bogof_strawberries])
+        cart.add('strawberries', 2)
+        cart.add('apple')
+        cart.get_total()
+        cart.add('apple')
+        cart.get_total()
+        self.assertEqual(bogof_strawberries.calls, 1)
+
+    def test_add_dependent_reprices_target_line(self):
+        '''Adding a dependent product reprices the target line.'''
+        product_store = self._create_product_store()
+        cart = IncrementalCart(product_store, self._create_offers())
+        cart.add('mars bar')
+        self.assertEqual(cart.get_total(), Decimal('0.65'))
+        cart.add('snickers bar')
+        self.assertEqual(cart.get_total(), Decimal('1.22'))
+
+    def test_chained_dependency_reprices_only_direct_targets(self):
+        '''Changing a product only reprices the lines whose offers depend on
+        it directly.'''
+        product_store = CountingProductStore([
+            ('apple', Decimal('0.15')),
+            ('snickers bar', Decimal('0.70')),
+            ('mars bar', Decimal('0.65')),
+            ('ice cream', Decimal('3.49'))])
+        offers = [
+            DependentDiscountOffer('snickers bar', 'mars bar', Decimal('0.2')),
+            DependentDiscountOffer('apple', 'snickers bar', Decimal('0.5')),
+        ]
+        cart = IncrementalCart(product_store, offers)
+        for product in ('apple', 'snickers bar', 'mars bar', 'ice cream'):
+            cart.add(product, 2)
+        cart.get_total()
+        product_store.calls = 0
+        cart.add('mars bar')
+        total = cart.get_total()
+        # One lookup for the mars bar line, two for the snickers bar line and
+        # its offer. The apple line only depends on the snickers bar quantity.
+        self.assertEqual(product_store.calls, 3)
+        self.assertEqual(total, Cart.from_json(cart.to_json(), product_store).get_total(offers))
+
+    def test_price_update_reprices_lines(self):
+        '''Changing a price in the store reprices every line.'''
+        product_store = self._create_product_store()
+        cart = IncrementalCart(product_store, self._create_offers())
+        cart.add('strawberries', 2)
+        cart.add('apple')
+        self.assertEqual(cart.get_total(), Decimal('2.15'))
+        product_store.update(prices=[('strawberries', Decimal('1.50'))])
+        self.assertEqual(cart.get_total(), Decimal('1.65'))
+
+    def test_get_total_with_other_offers(self):
+        '''Passing other offers to get_total prices the whole cart against
+        them.'''
+        product_store = self._create_product_store()
+        cart = IncrementalCart(product_store, self._create_offers())
+        cart.add('strawberries', 2)
+        self.assertEqual(cart.get_total(), Decimal('2.00'))
+        self.assertEqual(cart.get_total([NoOffer('strawberries')]), Decimal('4.00'))
+        self.assertEqual(cart.get_total(), Decimal('2.00'))
+
+
+class CountingProductStore(ProductStore):
+
+    '''A ProductStore that counts calls to get_product_price.'''
+
+    calls = 0
+
+    def get_product_price(self, product_name):
+        self.calls += 1
+        return super(CountingProductStore, self).get_product_price(product_name)
+
+
+class MembershipCountingProductStore(ProductStore):
+
+    '''A ProductStore that records the products checked with in.'''
+
+    def __init__(self, items):
+        super(MembershipCountingProductStore, self).__init__(items)
+        self.checked = []
+
+    def __contains__(self, product_name):
+        self.checked.append(product_name)
+        return super(MembershipCountingProductStore, self).__contains__(product_name)
+
+
+class SlowProductStore(ProductStore):
+
+    '''A ProductStore whose get_product_price waits for resume after
+    reading a price, once paused is set.'''
+
+    def __init__(self, *args, **kwargs):
+        super(SlowProductStore, self).__init__(*args, **kwargs)
+        self.paused = threading.Event()
+        self.resume = threading.Event()
+        self.pause_next = False
+
+    def get_product_price(self, product_name):
+        price = super(SlowProductStore, self).get_product_price(product_name)
+        if self.pause_next:
+            self.pause_next = False
+            self.paused.set()
+            self.resume.wait(5)
+        return price
+
+
+class BatchCountingProductStore(ProductStore):
+
+    '''A ProductStore that records the product names passed to each call
+    to get_product_prices.'''
+
+    def __init__(self, *args, **kwargs):
+        super(BatchCountingProductStore, self).__init__(*args, **kwargs)
+        self.batches = []
+
+    def get_product_prices(self, product_names):
+        product_names = set(product_names)
+        self.batches.append(product_names)
+        return super(BatchCountingProductStore, self).get_product_prices(product_names)
+
+
+class PricingResultTest(unittest.TestCase):
+
+    '''Test Cart.price explains how each line was priced.'''
+
+    def _create_product_store(self):
+        '''Helper method to create populated ProductStore.'''
+        products = [
+            ('apple', Decimal('0.15')),
+            ('ice cream', Decimal('3.49')),
+            ('strawberries', Decimal('2.00')),
+            ('snickers bar', Decimal('0.70')),
+            ('mars bar', Decimal('0.65'))
+        ]
+        return ProductStore(products)
+
+    def test_lines(self):
+        '''Each line holds its base total, the offer applied and the
+        saving.'''
+        product_store = self._create_product_store()
+        bogof_strawberries = MultiBuyOffer('strawberries', 1, 1)
+        mars_snickers_20_discount = DependentDiscountOffer(
+            'mars bar', 'snickers bar', Decimal('0.2'))
+        offers = [MultiBuyOffer('strawberries', 2, 1), bogof_strawberries,
+                  mars_snickers_20_discount, MultiBuyOffer('apple', 2, 1)]
+        cart = Cart(product_store)
+        cart.add('strawberries', 4)
+        cart.add('mars bar')
+        cart.add('snickers bar')
+        cart.add('apple')
+        result = cart.price(offers)
+        self.assertEqual(result.total, cart.get_total(offers))
+        self.assertEqual(
+            [(line.product, line.base_total, line.line_total, line.offer, line.savings)
+             for line in result],
+            [('strawberries', Decimal('8.00'), Decimal('4.00'), bogof_strawberries, Decimal('4.00')),
+             ('mars bar', Decimal('0.65'), Decimal('0.52'), mars_snickers_20_discount, Decimal('0.13')),
+             ('snickers bar', Decimal('0.70'), Decimal('0.70'), None, Decimal('0')),
+             ('apple', Decimal('0.15'), Decimal('0.15'), None, Decimal('0'))])
+        self.assertEqual(result.base_total, Decimal('9.50'))
+        self.assertEqual(result.savings, Decimal('4.13'))
+
+    def test_single_pass(self):
+        '''Each offer is evaluated once.'''
+        product_store = self._create_product_store()
+        bogof_strawberries = CountingOffer('strawberries', 1, 1)
+        cart = Cart(product_store)
+        cart.add('strawberries', 2)
+        self.assertEqual(cart.price([bogof_strawberries]).total, Decimal('2.00'))
+        self.assertEqual(bogof_strawberries.calls, 1)
+
+    def test_incremental_cart(self):
+        '''An IncrementalCart is priced with its own offers.'''
+        product_store = self._create_product_store()
+        cart = IncrementalCart(product_store, [MultiBuyOffer('strawberries', 1, 1)])
+        cart.add('strawberries', 2)
+        result = cart.price()
+        self.assertEqual(result.total, cart.get_total())
+        self.assertEqual(result.savings, Decimal('2.00'))
+
+
+class CartsFromRecordsTest(unittest.TestCase):
+
+    '''Test carts built in bulk from (cart_id, product, quantity)
+    records.'''
+
+    def _create_product_store(self):
+        '''Helper method to create populated ProductStore.'''
+        products = [
+            ('apple', Decimal('0.15')),
+            ('ice cream', Decimal('3.49')),
+            ('strawberries', Decimal('2.00')),
+            ('snickers bar', Decimal('0.70')),
+            ('mars bar', Decimal('0.65'))
+        ]
+        return ProductStore(products)
+
+    def test_aggregates_lines(self):
+        '''Repeated lines for a product are added together, in the order
+        products first appear.'''
+        records = [
+            (1, 'apple', 2), (1, 'strawberries', 1), (1, 'apple', 3),
+            (2, 'ice cream', 1),
+        ]
+        carts = list(carts_from_records(records, self._create_product_store()))
+        self.assertEqual([cart_id for cart_id, _ in carts], [1, 2])
+        self.assertEqual(
+            [(item.product, item.quantity) for item in carts[0][1]],
+            [('apple', 5), ('strawberries', 1)])
+        self.assertEqual(carts[0][1].get_total(), Decimal('2.75'))
+
+    def test_streams_grouped_records(self):
+        '''Grouped carts are yielded before the records are exhausted.'''
+        consumed = []
+
+        def records():
+            for cart_id in range(10):
+                consumed.append(cart_id)
+                yield cart_id, 'apple', 1
+
+        carts = carts_from_records(records(), batch_size=2)
+        self.assertEqual(next(carts)[0], 0)
+        self.assertLess(len(consumed), 10)
+        self.assertEqual([cart_id for cart_id, _ in carts], list(range(1, 10)))
+
+    def test_ungrouped_records(self):
+        '''Interleaved records are gathered into their carts.'''
+        records = [('a', 'apple', 1), ('b', 'apple', 2), ('a', 'apple', 3)]
+        carts = dict(carts_from_records(records, grouped=False))
+        self.assertEqual(carts['a'].get_item('apple').quantity, 4)
+        self.assertEqual(carts['b'].get_item('apple').quantity, 2)
+
+    def test_validates_in_batch(self):
+        '''Each product is checked against the store once, and a missing
+        product raises NoSuchProductError.'''
+        product_store = MembershipCountingProductStore([('apple', Decimal('0.15'))])
+        records = [(cart_id, 'apple', 1) for cart_id in range(5)]
+        self.assertEqual(len(list(carts_from_records(records, product_store, batch_size=2))), 5)
+        self.assertEqual(product_store.checked, ['apple'])
+        with self.assertRaises(NoSuchProductError):
+            list(carts_from_records(records + [(5, 'bike', 1)], product_store))
+
+    def test_grouped_cart_id_reappears(self):
+        '''A cart_id whose records resume after another cart's, within a
+        batch, raises ValueError rather than yielding a second cart.'''
+        records = [(1, 'apple', 1), (2, 'strawberries', 1), (1, 'apple', 2)]
+        with self.assertRaises(ValueError):
+            list(carts_from_records(records, self._create_product_store()))
+        carts = dict(carts_from_records(records, grouped=False))
+        self.assertEqual(carts[1].get_item('apple').quantity, 3)
+
+    def test_cart_class(self):
+        '''Other cart classes are built with the extra arguments.'''
+        offers = [MultiBuyOffer('strawberries', 1, 1)]
+        records = [(1, 'strawberries', 1), (1, 'strawberries', 1)]
+        (_, cart), = carts_from_records(
+            records, self._create_product_store(), IncrementalCart, offers=offers)
+        self.assertTrue(isinstance(cart, IncrementalCart))
+        self.assertEqual(cart.get_total(), Decimal('2.00'))
+
+
+class CartSerializationTest(unittest.TestCase):
+
+    '''Test carts saved as JSON or packed bytes are restored intact.'''
+
+    def _create_product_store(self):
+        '''Helper method to create populated ProductStore.'''
+        products = [
+            ('apple', Decimal('0.15')),
+            ('ice cream', Decimal('3.49')),
+            ('strawberries', Decimal('2.00')),
+            ('snickers bar', Decimal('0.70')),
+            ('mars bar', Decimal('0.65'))
+        ]
+        return ProductStore(products)
+
+    def _create_offers(self):
+        '''Helper method to create a list of offers.'''
+        return [
+            MultiBuyOffer('strawberries', 1, 1),
+            DependentDiscountOffer('mars bar', 'snickers bar', Decimal('0.2')),
+        ]
+
+    def test_round_trip(self):
+        '''A restored cart has the same lines, in order, and total.'''
+        product_store = self._create_product_store()
+        cart = Cart(product_store)
+        cart.add('strawberries', 3)
+        cart.add('ice cream')
+        cart.add('apple', 12)
+        for restored in (Cart.from_json(cart.to_json(), product_store),
+                         Cart.from_bytes(cart.to_bytes(), product_store)):
+            self.assertEqual(
+                [(item.product, item.quantity) for item in restored],
+                [('strawberries', 3), ('ice cream', 1), ('apple', 12)])
+            self.assertEqual(restored.get_total(), cart.get_total())
+            self.assertEqual(restored.get_item('apple').quantity, 12)
+
+    def test_unicode_product_names(self):
+        '''Product names outside ASCII survive packing.'''
+        cart = Cart()
+        cart.add('cr\u00e8me br\u00fbl\u00e9e', 2)
+        self.assertEqual(
+            Cart.from_bytes(cart.to_bytes()).get_item('cr\u00e8me br\u00fbl\u00e9e').quantity, 2)
+
+    def test_not_a_packed_cart(self):
+        '''Restoring bytes that aren't a packed cart raises ValueError.'''
+        with self.assertRaises(ValueError):
+            Cart.from_bytes(b'CATL' + bytes(16))
+
+    def test_restore_reuses_line_totals(self):
+        '''An IncrementalCart restored against the same store version
+        reprices only the lines changed since it was last priced.'''
+        product_store = CountingProductStore([
+            ('strawberries', Decimal('2.00')),
+            ('snickers bar', Decimal('0.70')),
+            ('mars bar', Decimal('0.65'))])
+        offers = self._create_offers()
+        cart = IncrementalCart(product_store, offers)
+        cart.add('strawberries', 3)
+        cart.add('mars bar', 2)
+        cart.get_total()
+        cart.add('snickers bar', 1)
+        for data, restore in ((cart.to_json(), IncrementalCart.from_json),
+                              (cart.to_bytes(), IncrementalCart.from_bytes)):
+            restored = restore(data, product_store, offers)
+            product_store.calls = 0
+            self.assertEqual(restored.get_total(), Decimal('5.87'))
+            # Only snickers bar, and mars bar which depends on it, are
+            # repriced: one lookup for snickers bar, two for mars bar and
+            # its offer.
+            self.assertEqual(product_store.calls, 3)
+
+    def test_restore_against_reloaded_catalogue(self):
+        '''Cached line totals are reused against another store holding the
+        same catalogue, as after a restart, but not against one with other
+        prices, though both are at version 0.'''
+        offers = [MultiBuyOffer('apple', 1, 1)]
+        cart = IncrementalCart(ProductStore([('apple', Decimal('1.00'))]), offers)
+        cart.add('apple', 3)
+        self.assertEqual(cart.get_total(), Decimal('2.00'))
+        for data, restore in ((cart.to_json(), IncrementalCart.from_json),
+                              (cart.to_bytes(), IncrementalCart.from_bytes)):
+            same_store = CountingProductStore([('apple', Decimal('1.00'))])
+            restored = restore(data, same_store, [MultiBuyOffer('apple', 1, 1)])
+            self.assertEqual(restored.get_total(), Decimal('2.00'))
+            self.assertEqual(same_store.calls, 0)
+
+            repriced_store = ProductStore([('apple', Decimal('5.00'))])
+            self.assertEqual(repriced_store.version, 0)
+            restored = restore(data, repriced_store, offers)
+            self.assertEqual(restored.get_total(), Decimal('10.00'))
+
+    def test_restore_with_other_offers_reprices(self):
+        '''Cached line totals are discarded when the offers differ.'''
+        product_store = self._create_product_store()
+        cart = IncrementalCart(product_store, [MultiBuyOffer('strawberries', 1, 1)])
+        cart.add('strawberries', 3)
+        cart.get_total()
+        restored = IncrementalCart.from_bytes(
+            cart.to_bytes(), product_store, [MultiBuyOffer('strawberries', 2, 1)])
+        self.assertEqual(restored.get_total(), Decimal('4.00'))
+        restored = IncrementalCart.from_json(cart.to_json(), product_store)
+        self.assertEqual(restored.get_total(), Decimal('6.00'))
+
+    def test_offer_book_fingerprint(self):
+        '''An OfferBook's fingerprint matches its offers' and changes when
+        an offer is added.'''
+        offers = self._create_offers()
+        offer_book = OfferBook(offers)
+        self.assertEqual(offer_book.fingerprint(), fingerprint_offers(offers))
+        offer_book.add(MultiBuyOffer('apple', 2, 1))
+        self.assertNotEqual(offer_book.fingerprint(), fingerprint_offers(offers))
+
+    def test_restore_after_price_change_reprices(self):
+        '''Cached line totals from an older store version are discarded.'''
+        product_store = self._create_product_store()
+        offers = self._create_offers()
+        cart = IncrementalCart(product_store, offers)
+        cart.add('strawberries', 3)
+        cart.get_total()
+        data = cart.to_bytes()
+        product_store.set_product_price('strawberries', Decimal('1.00'))
+        restored = IncrementalCart.from_bytes(data, product_store, offers)
+        self.assertEqual(restored.get_total(), Decimal('2.00'))
+
+
+class PriceCartsTest(unittest.TestCase):
+
+    '''Tests for pricing a batch of carts.'''
+
+    def _create_product_store(self):
+        '''Helper method to create populated ProductStore.'''
+        products = [
+            ('apple', Decimal('0.15')),
+            ('ice cream', Decimal('3.49')),
+            ('strawberries', Decimal('2.00')),
+            ('snickers bar', Decimal('0.70')),
+            ('mars bar', Decimal('0.65'))
+        ]
+        return CountingProductStore(products)
+
+    def _create_carts(self, product_store):
+        '''Helper method to create a list of carts.'''
+        carts = []
+        for quantity in range(1, 8):
+            cart = Cart(product_store)
+            cart.add('strawberries', quantity)
+            cart.add('mars bar', quantity % 3 + 1)
+            if quantity % 2:
+                cart.add('snickers bar')
+            carts.append(cart)
+        return carts
+
+    def _create_offers(self):
+        '''Helper method to create a list of offers.'''
+        return [
+            MultiBuyOffer('strawberries', 1, 1),
+            DependentDiscountOffer('mars bar', 'snickers bar', Decimal('0.2')),
+        ]
+
+    def test_totals_match_get_total(self):
+        '''price_carts returns each cart's get_total, in order.'''
+        offers = self._create_offers()
+        carts = self._create_carts(self._create_product_store())
+        self.assertEqual(
+            price_carts(carts, offers), [cart.get_total(offers) for cart in carts])
+
+    def test_prices_resolved_once_per_product(self):
+        '''Each product's price is looked up in the store once per batch.'''
+        product_store = self._create_product_store()
+        price_carts(self._create_carts(product_store), self._create_offers())
+        self.assertEqual(product_store.calls, 3)
+
+    def test_process_pool(self):
+        '''Pricing carts in a process pool returns the same totals, in
+        order.'''
+        offers = self._create_offers()
+        carts = self._create_carts(self._create_product_store())
+        self.assertEqual(
+            price_carts(carts, offers, processes=3),
+            [cart.get_total(offers) for cart in carts])
+
+
+class VectorizedOfferTest(unittest.TestCase):
+
+    '''Test evaluating offers over sequences of quantities matches
+    calculate_line_total.'''
+
+    def _create_product_store(self):
+        '''Helper method to create populated ProductStore.'''
+        products = [
+            ('apple', Decimal('0.15')),
+            ('ice cream', Decimal('3.49')),
+            ('strawberries', Decimal('2.00')),
+            ('snickers bar', Decimal('0.70')),
+        ]
+        return ProductStore(products)
+
+    def _assert_matches_scalar(self, offer):
+        product_store = self._create_product_store()
+        quantities = list(range(0, 30))
+        price = to_minor_units(product_store.get_product_price(offer.target_product))
+        expected = [
+            to_minor_units(offer.calculate_line_total(
+                CartItem(offer.target_product, quantity), product_store))
+            for quantity in quantities]
+        totals = offer.calculate_line_totals(quantities, [price] * len(quantities))
+        self.assertEqual([int(total) for total in totals], expected)
+
+    def test_nooffer(self):
+        '''NoOffer line totals match the scalar path.'''
+        self._assert_matches_scalar(NoOffer('ice cream'))
+
+    def test_bogof(self):
+        '''Buy one get one free line totals match the scalar path.'''
+        self._assert_matches_scalar(MultiBuyOffer('apple', 1, 1))
+
+    def test_buy_2_1_free(self):
+        '''Buy two get one free line totals match the scalar path.'''
+        self._assert_matches_scalar(MultiBuyOffer('apple', 2, 1))
+
+    def test_buy_5_2_free(self):
+        '''Buy five get two free line totals match the scalar path.'''
+        self._assert_matches_scalar(MultiBuyOffer('apple', 5, 2))
+
+    def test_mixed_prices(self):
+        '''Each quantity is charged at its own price.'''
+        bogof = MultiBuyOffer('apple', 1, 1)
+        totals = bogof.calculate_line_totals([2, 3, 4], [15, 349, 200])
+        self.assertEqual([int(total) for total in totals], [15, 698, 400])
+
+
+class BenchmarkSuiteTest(unittest.TestCase):
+
+    '''Smoke test for the benchmark suite.'''
+
+    def test_run_suite(self):
+        '''The benchmark suite times each stage at a small scale.'''
+        results = run_suite(products=50, carts=5, lines=3, offers=30, repeat=1)
+        names = [result['name'] for result in results]
+        self.assertTrue('Cart.add' in names)
+        self.assertTrue('DependentDiscountOffer.calculate_line_total' in names)
+        for result in results:
+            self.assertTrue(result['seconds'] >= 0)
+
+    def test_object_memory(self):
+        '''Slotted cart lines and offers use less memory than those with a
+        __dict__.'''
+        memory = dict(benchmark_object_memory(1000))
+        self.assertLess(memory['CartItem'], memory['_DictCartItem'])
+        self.assertLess(memory['MultiBuyOffer'], memory['_DictMultiBuyOffer'])
+
+
+class InstrumentationTest(unittest.TestCase):
+
+    '''Tests for recording pricing latencies.'''
+
+    def _create_cart(self):
+        '''Helper method to create a populated Cart.'''
+        product_store = ProductStore([
+            ('apple', Decimal('0.15')),
+            ('strawberries', Decimal('2.00')),
+            ('snickers bar', Decimal('0.70')),
+            ('mars bar', Decimal('0.65'))
+        ])
+        cart = Cart(product_store)
+        cart.add('strawberries', 2)
+        cart.add('mars bar')
+        cart.add('snickers bar')
+        return cart
+
+    def _create_offers(self):
+        '''Helper method to create a list of offers.'''
+        return [
+            MultiBuyOffer('strawberries', 1, 1),
+            DependentDiscountOffer('mars bar', 'snickers bar', Decimal('0.2')),
+        ]
+
+    def test_records_stages(self):
+        '''Calls to each stage are counted, with offers broken down by
+        class.'''
+        cart = self._create_cart()
+        with instrumentation.recording() as recorder:
+            total = cart.get_total(self._create_offers())
+        self.assertEqual(total, Decimal('3.22'))
+        stats = recorder.as_dict()
+        self.assertEqual(stats['get_total']['calls'], 1)
+        # One lookup per line, plus one inside each offer.
+        self.assertEqual(stats['get_product_price']['calls'], 5)
+        self.assertEqual(
+            stats['calculate_line_total']['MultiBuyOffer']['calls'], 1)
+        self.assertEqual(
+            stats['calculate_line_total']['DependentDiscountOffer']['calls'], 1)
+        histogram = stats['get_total']['histogram']
+        self.assertEqual(histogram[-1], ('+Inf', 1))
+
+    def test_disabled_after_recording(self):
+        '''Nothing is recorded outside of a recording block.'''
+        cart = self._create_cart()
+        with instrumentation.recording() as recorder:
+            pass
+        cart.get_total(self._create_offers())
+        self.assertEqual(instrumentation.recorder, None)
+        self.assertEqual(recorder.as_dict(), {})
+
+    def test_to_prometheus(self):
+        '''Recorded statistics export as Prometheus histograms.'''
+        recorder = instrumentation.Recorder(buckets=(0.001, 0.01))
+        recorder.record('get_total', 0.005)
+        recorder.record('calculate_line_total', 0.0001, 'MultiBuyOffer')
+        self.assertEqual(recorder.to_prometheus().splitlines(), [
+            '# HELP cart_pricing_seconds Latency of each pricing stage.',
+            '# TYPE cart_pricing_seconds histogram',
+            'cart_pricing_seconds_bucket{stage="calculate_line_total",offer="MultiBuyOffer",le="0.001"} 1',
+            'cart_pricing_seconds_bucket{stage="calculate_line_total",offer="MultiBuyOffer",le="0.01"} 1',
+            'cart_pricing_seconds_bucket{stage="calculate_line_total",offer="MultiBuyOffer",le="+Inf"} 1',
+            'cart_pricing_seconds_sum{stage="calculate_line_total",offer="MultiBuyOffer"} 0.0001',
+            'cart_pricing_seconds_count{stage="calculate_line_total",offer="MultiBuyOffer"} 1',
+            'cart_pricing_seconds_bucket{stage="get_total",le="0.001"} 0',
+            'cart_pricing_seconds_bucket{stage="get_total",le="0.01"} 1',
+            'cart_pricing_seconds_bucket{stage="get_total",le="+Inf"} 1',
+            'cart_pricing_seconds_sum{stage="get_total"} 0.005',
+            'cart_pricing_seconds_count{stage="get_total"} 1',
+        ])
+
+
+class LRUCacheTest(unittest.TestCase):
+
+    '''Tests for the LRUCache.'''
+
+    def test_evicts_least_recently_used(self):
+        '''The least recently used entry is evicted when the cache is
+        full.'''
+        cache = LRUCache(maxsize=2)
+        cache.put('apple', 1)
+        cache.put('orange', 2)
+        cache.get('apple')
+        cache.put('pear', 3)
+        self.assertEqual(cache.get('orange'), None)
+        self.assertEqual(cache.get('apple'), 1)
+        self.assertEqual(cache.get('pear'), 3)
+        self.assertEqual(cache.evictions, 1)
+
+    def test_stats(self):
+        '''Hits and misses are counted.'''
+        cache = LRUCache()
+        cache.get('apple')
+        cache.put('apple', 1)
+        cache.get('apple')
+        cache.get('apple')
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['size']), (2, 1, 1))
+        self.assertAlmostEqual(stats['hit_rate'], 2 / 3)
+
+
+class CachedProductStoreTest(unittest.TestCase):
+
+    '''Tests for caching prices in front of a store.'''
+
+    def _create_product_store(self):
+        '''Helper method to create populated ProductStore.'''
+        products = [
+            ('apple', Decimal('0.15')),
+            ('ice cream', Decimal('3.49')),
+            ('strawberries', Decimal('2.00')),
+            ('snickers bar', Decimal('0.70')),
+        ]
+        return CountingProductStore(products)
+
+    def test_repeated_lookups_are_cached(self):
+        '''Repeated lookups of a product only reach the store once.'''
+        product_store = self._create_product_store()
+        cached_store = CachedProductStore(product_store)
+        cart = Cart(cached_store)
+        cart.add('strawberries', 2)
+        cart.add('apple')
+        cart.get_total(offers=[MultiBuyOffer('strawberries', 1, 1)])
+        self.assertEqual(cart.get_total(), Decimal('4.15'))
+        self.assertEqual(product_store.calls, 2)
+        self.assertEqual(cached_store.stats()['hits'], 3)
+
+    def test_no_such_product(self):
+        '''Missing products raise NoSuchProductError and aren't cached.'''
+        cached_store = CachedProductStore(self._create_product_store())
+        self.assertRaises(NoSuchProductError, cached_store.get_product_price, 'bike')
+        self.assertEqual(len(cached_store.cache), 0)
+
+    def test_price_update_invalidates_cache(self):
+        '''Updating a price in the store is seen through the cache.'''
+        product_store = self._create_product_store()
+        cached_store = CachedProductStore(product_store)
+        self.assertEqual(cached_store.get_product_price('apple'), Decimal('0.15'))
+        product_store.set_product_price('apple', Decimal('0.10'))
+        self.assertEqual(cached_store.get_product_price('apple'), Decimal('0.10'))
+
+    def test_lookup_racing_update_is_not_cached(self):
+        '''A price fetched before an update isn't cached after it.'''
+        product_store = SlowProductStore([
+            ('apple', Decimal('0.15')),
+            ('strawberries', Decimal('2.00')),
+        ])
+        cached_store = CachedProductStore(product_store)
+        product_store.pause_next = True
+        prices = []
+        lookup = threading.Thread(
+            target=lambda: prices.append(cached_store.get_product_price('apple')))
+        lookup.start()
+        self.assertTrue(product_store.paused.wait(5))
+        product_store.set_product_price('apple', Decimal('0.10'))
+        self.assertEqual(cached_store.get_product_price('strawberries'), Decimal('2.00'))
+        product_store.resume.set()
+        lookup.join(5)
+        self.assertEqual(prices, [Decimal('0.15')])
+        self.assertEqual(cached_store.get_product_price('apple'), Decimal('0.10'))
+
+
+class OfferResultCacheTest(unittest.TestCase):
+
+    '''Tests for memoized offer results.'''
+
+    def _create_product_store(self):
+        '''Helper method to create populated ProductStore.'''
+        products = [
+            ('apple', Decimal('0.15')),
+            ('ice cream', Decimal('3.49')),
+            ('strawberries', Decimal('2.00')),
+            ('snickers bar', Decimal('0.70')),
+            ('mars bar', Decimal('0.65'))
+        ]
+        return ProductStore(products)
+
+    def _create_offers(self):
+        '''Helper method to create a list of offers.'''
+        return [
+            MultiBuyOffer('strawberries', 1, 1),
+            DependentDiscountOffer('strawberries', 'apple', Decimal('0.2')),
+            MultiBuyOffer('mars bar', 2, 1),
+            DependentDiscountOffer('mars bar', 'snickers bar', Decimal('0.2')),
+            MultiBuyOffer('apple', 2, 1),
+        ]
+
+    def test_totals_match_get_total(self):
+        '''Memoized offers price carts as the offers themselves do, and
+        repeated lines are answered from the cache.'''
+        product_store = self._create_product_store()
+        offers = self._create_offers()
+        offer_results = OfferResultCache(product_store)
+        offer_book = offer_results.memoize(offers)
+        for quantity in list(range(1, 8)) * 2:
+            cart = Cart(product_store)
+            cart.add('strawberries', quantity)
+            cart.add('apple', quantity % 3)
+            cart.add('mars bar', quantity)
+            cart.add('snickers bar', quantity % 4)
+            self.assertEqual(cart.get_total(offer_book), cart.get_total(offers))
+        stats = offer_results.stats()
+        self.assertEqual(stats['misses'], 14)
+        self.assertEqual(stats['hits'], 14)
+        self.assertEqual(offer_results.cache.hit_rate, 0.5)
+
+    def test_single_offer_not_memoized(self):
+        '''A product's only offer is evaluated directly.'''
+        offers = self._create_offers()
+        offer_book = OfferResultCache(self._create_product_store()).memoize(offers)
+        self.assertEqual(list(offer_book.for_product('apple')), [offers[4]])
+        self.assertEqual(list(offer_book), offers)
+
+    def test_price_update(self):
+        '''Results from an earlier version of the store aren't reused.'''
+        product_store = self._create_product_store()
+        offer_book = OfferResultCache(product_store).memoize(self._create_offers())
+        cart = Cart(product_store)
+        cart.add('strawberries', 2)
+        self.assertEqual(cart.get_total(offer_book), Decimal('2.00'))
+        product_store.set_product_price('strawberries', Decimal('1.50'))
+        self.assertEqual(cart.get_total(offer_book), Decimal('1.50'))
+
+    def test_eviction(self):
+        '''The cache holds at most maxsize results.'''
+        product_store = self._create_product_store()
+        offer_results = OfferResultCache(product_store, maxsize=2)
+        offer_book = offer_results.memoize(self._create_offers())
+        for quantity in range(1, 5):
+            cart = Cart(product_store)
+            cart.add('strawberries', quantity)
+            cart.get_total(offer_book)
+        self.assertEqual(len(offer_results.cache), 2)
+        self.assertEqual(offer_results.stats()['evictions'], 2)
+
+    def test_incremental_cart(self):
+        '''An IncrementalCart reprices dependent lines against memoized
+        offers.'''
+        product_store = self._create_product_store()
+        offer_book = OfferResultCache(product_store).memoize(self._create_offers())
+        cart = IncrementalCart(product_store, offer_book)
+        cart.add('mars bar')
+        self.assertEqual(cart.get_total(), Decimal('0.65'))
+        cart.add('snickers bar')
+        self.assertEqual(cart.get_total(), Decimal('1.22'))
+
+    def test_price_reports_offer_applied(self):
+        '''Cart.price with memoized offers reports the offer that priced
+        each line, whether or not its result was cached.'''
+        product_store = self._create_product_store()
+        offers = self._create_offers()
+        offer_book = OfferResultCache(product_store).memoize(offers)
+        for _ in range(2):
+            cart = Cart(product_store)
+            cart.add('strawberries', 2)
+            cart.add('mars bar', 3)
+            cart.add('snickers bar', 3)
+            result = cart.price(offer_book)
+            self.assertEqual(result.total, cart.get_total(offers))
+            self.assertEqual([line.offer for line in result],
+                             [offers[0], offers[2], None])
+
+    def test_instrumentation_records_offer_classes(self):
+        '''Offers evaluated through the cache are recorded by their own
+        class.'''
+        product_store = self._create_product_store()
+        offer_book = OfferResultCache(product_store).memoize(self._create_offers())
+        cart = Cart(product_store)
+        cart.add('strawberries', 2)
+        with instrumentation.recording() as recorder:
+            cart.price(offer_book)
+            cart.get_total(offer_book)
+        stats = recorder.as_dict()['calculate_line_total']
+        self.assertEqual(sorted(stats), ['DependentDiscountOffer', 'MultiBuyOffer'])
+        self.assertEqual(stats['MultiBuyOffer']['calls'], 1)
+
+
+class OfferSolverTest(unittest.TestCase):
+
+    '''Tests for splitting cart lines between competing offers.'''
+
+    def _create_product_store(self):
+        '''Helper method to create populated ProductStore.'''
+        products = [
+            ('apple', Decimal('0.15')),
+            ('ice cream', Decimal('3.49')),
+            ('strawberries', Decimal('2.00')),
+            ('snickers bar', Decimal('0.70')),
+            ('mars bar', Decimal('0.65'))
+        ]
+        return ProductStore(products)
+
+    def _create_offers(self):
+        '''Helper method to create a list of offers.'''
+        return [
+            MultiBuyOffer('strawberries', 1, 1),
+            DependentDiscountOffer('strawberries', 'apple', Decimal('0.2')),
+            MultiBuyOffer('mars bar', 2, 1),
+            DependentDiscountOffer('mars bar', 'snickers bar', Decimal('0.5')),
+        ]
+
+    def test_splits_line_between_offers(self):
+        '''A line's units are split between offers where that is
+        cheapest.'''
+        cart = Cart(self._create_product_store())
+        cart.add('strawberries', 3)
+        cart.add('apple', 3)
+        offers = self._create_offers()
+        # bogof on all three strawberries is the cheapest single offer.
+        self.assertEqual(cart.get_total(offers), Decimal('4.45'))
+        # bogof on two strawberries and 20% off the third.
+        self.assertEqual(OfferSolver().get_total(cart, offers), Decimal('4.05'))
+
+    def test_dependent_discount_limited_to_dependent_quantity(self):
+        '''No more units are discounted than there are dependent
+        products.'''
+        cart = Cart(self._create_product_store())
+        cart.add('mars bar', 4)
+        cart.add('snickers bar', 1)
+        offers = self._create_offers()
+        # buy two get one free on three mars bars, half price on the fourth.
+        self.assertEqual(OfferSolver().get_total(cart, offers), Decimal('2.325'))
+
+    def test_dependent_units_discount_one_share(self):
+        '''Each dependent product unit counts towards only one dependent
+        discount offer's share.'''
+        cart = Cart(self._create_product_store())
+        cart.add('snickers bar', 2)
+        cart.add('mars bar', 1)
+        offers = [
+            DependentDiscountOffer('snickers bar', 'mars bar', Decimal('0.2')),
+            DependentDiscountOffer('snickers bar', 'mars bar', Decimal('0.1')),
+        ]
+        # One snickers bar at 20% off, the other at full price.
+        self.assertEqual(OfferSolver().get_total(cart, offers), Decimal('1.91'))
+        cart.add('mars bar', 1)
+        # With two mars bars, both snickers bars are discounted.
+        self.assertEqual(OfferSolver().get_total(cart, offers), Decimal('2.42'))
+
+    def test_never_worse_than_cheapest_single_offer(self):
+        '''The solver's total is never more than Cart.get_total's.'''
+        offers = self._create_offers()
+        solver = OfferSolver()
+        for strawberries in range(0, 8):
+            for apples in range(0, 5):
+                cart = Cart(self._create_product_store())
+                if strawberries:
+                    cart.add('strawberries', strawberries)
+                if apples:
+                    cart.add('apple', apples)
+                self.assertTrue(
+                    solver.get_total(cart, offers) <= cart.get_total(offers))
+
+    def test_falls_back_to_cheapest_single_offer(self):
+        '''Lines too large to solve are priced as by Cart.get_total.'''
+        cart = Cart(self._create_product_store())
+        cart.add('strawberries', 3)
+        cart.add('apple', 3)
+        offers = self._create_offers()
+        self.assertEqual(
+            OfferSolver(max_work=5).get_total(cart, offers), cart.get_total(offers))
+        self.assertEqual(
+            OfferSolver(time_budget=0).get_total(cart, offers), cart.get_total(offers))
+
+    def test_large_dependent_lines_fall_back(self):
+        '''Lines whose dependent quantities would make them too slow to
+        solve, or that run out of time, are priced as by Cart.get_total.'''
+        product_store = self._create_product_store()
+        product_store.set_product_price('cola', Decimal('1.00'))
+        cart = Cart(product_store)
+        for product in ('snickers bar', 'mars bar', 'cola'):
+            cart.add(product, 100)
+        offers = [
+            DependentDiscountOffer('snickers bar', 'mars bar', Decimal('0.2')),
+            DependentDiscountOffer('snickers bar', 'cola', Decimal('0.1')),
+            MultiBuyOffer('snickers bar', 2, 1),
+        ]
+        solver = OfferSolver()
+        self.assertEqual(solver.get_line_total(
+            cart.get_item('snickers bar'), offers, product_store, cart), None)
+        self.assertEqual(solver.get_total(cart, offers), cart.get_total(offers))
+        cart.remove('snickers bar', 95)
+        self.assertEqual(solver.get_line_total(
+            cart.get_item('snickers bar'), offers, product_store, cart,
+            deadline=perf_counter()), None)
+        self.assertEqual(len(solver.cache), 0)
+
+    def test_solutions_are_memoized(self):
+        '''Solving the same line again is served from the cache.'''
+        offers = self._create_offers()
+        solver = OfferSolver()
+        for _ in range(2):
+            cart = Cart(self._create_product_store())
+            cart.add('strawberries', 3)
+            cart.add('apple', 3)
+            solver.get_total(cart, offers)
+        self.assertEqual(solver.cache.hits, 1)
+
+
+class HalfPriceOffer(AbstractOffer):
+
+    '''An offer implementing only calculate_line_total.'''
+
+    def calculate_line_total(self, cart_item, store, *args):
+        return cart_item.get_line_total(store) / 2
+
+
+class PricingTableTest(unittest.TestCase):
+
+    '''Tests for offers compiled into a PricingTable.'''
+
+    def _create_product_store(self):
+        '''Helper method to create populated ProductStore.'''
+        products = [
+            ('apple', Decimal('0.15')),
+            ('ice cream', Decimal('3.49')),
+            ('strawberries', Decimal('2.00')),
+            ('snickers bar', Decimal('0.70')),
+            ('mars bar', Decimal('0.65'))
+        ]
+        return ProductStore(products)
+
+    def _create_offers(self):
+        '''Helper method to create a list of offers.'''
+        return [
+            MultiBuyOffer('strawberries', 1, 1),
+            DependentDiscountOffer('strawberries', 'apple', Decimal('0.2')),
+            MultiBuyOffer('apple', 2, 1),
+            DependentDiscountOffer('mars bar', 'snickers bar', Decimal('0.2')),
+            NoOffer('ice cream'),
+            MultiBuyOffer('bike', 1, 1),
+        ]
+
+    def test_totals_match_get_total(self):
+        '''Compiled offers price carts as Cart.get_total does.'''
+        product_store = self._create_product_store()
+        offers = self._create_offers()
+        pricing_table = PricingTable(offers, product_store)
+        for quantity in range(1, 8):
+            cart = Cart(product_store)
+            cart.add('strawberries', quantity)
+            cart.add('apple', quantity % 3)
+            cart.add('mars bar', quantity)
+            cart.add('snickers bar', quantity % 4)
+            cart.add('ice cream')
+            self.assertEqual(pricing_table.get_total(cart), cart.get_total(offers))
+
+    def test_recompiles_on_price_change(self):
+        '''The table is recompiled when the store's prices change.'''
+        product_store = self._create_product_store()
+        pricing_table = PricingTable(self._create_offers(), product_store)
+        cart = Cart(product_store)
+        cart.add('strawberries', 2)
+        self.assertEqual(pricing_table.get_total(cart), Decimal('2.00'))
+        product_store.set_product_price('strawberries', Decimal('1.50'))
+        self.assertEqual(pricing_table.get_total(cart), Decimal('1.50'))
+
+    def test_uncompiled_offer(self):
+        '''Offers without a specialised compile are priced through
+        calculate_line_total.'''
+        product_store = self._create_product_store()
+        cart = Cart(product_store)
+        cart.add('strawberries', 2)
+        self.assertEqual(
+            PricingTable([HalfPriceOffer('strawberries')], product_store).get_total(cart),
+            Decimal('2.00'))
+
+
+class PricingServiceTest(unittest.TestCase):
+
+    '''Tests for the asyncio pricing service.'''
+
+    def _create_product_store(self):
+        '''Helper method to create populated ProductStore.'''
+        products = [
+            ('apple', Decimal('0.15')),
+            ('ice cream', Decimal('3.49')),
+            ('strawberries', Decimal('2.00')),
+            ('snickers bar', Decimal('0.70')),
+        ]
+        return ProductStore(products)
+
+    def _serve(self, client, offers=None, store=None):
+        '''Helper method to run client(service, path) against a service
+        listening on a Unix socket.'''
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'pricing.sock')
+        if store is None:
+            store = self._create_product_store()
+        service = PricingService(store, offers, max_delay=0.01)
+
+        async def run():
+            server = await service.serve(path)
+            try:
+                return await client(service, path)
+            finally:
+                server.close()
+                await server.wait_closed()
+                await service.stop()
+
+        try:
+            return service, asyncio.run(run())
+        finally:
+            shutil.rmtree(directory)
+
+    def test_concurrent_requests_are_batched(self):
+        '''Concurrent requests are priced together, each with its own
+        total.'''
+        offers = [MultiBuyOffer('strawberries', 1, 1)]
+
+        async def client(service, path):
+            return await asyncio.gather(*[
+                service.price([['strawberries', quantity], ['apple', 1]])
+                for quantity in range(1, 11)])
+
+        service, totals = self._serve(client, offers)
+        self.assertEqual(totals, [
+            Decimal('2.00') * ((quantity + 1) // 2) + Decimal('0.15')
+            for quantity in range(1, 11)])
+        self.assertLess(service.batches, 10)
+
+    def test_batch_prices_are_looked_up_together(self):
+        '''The prices a batch needs are looked up in one call, and only
+        once.'''
+        store = BatchCountingProductStore([
+            ('apple', Decimal('0.15')),
+            ('ice cream', Decimal('3.49')),
+            ('strawberries', Decimal('2.00')),
+        ])
+
+        async def client(service, path):
+            totals = await asyncio.gather(*[
+                service.price([['strawberries', quantity], ['apple', 1], ['ice cream', 1]])
+                for quantity in range(1, 11)])
+            totals.append(await service.price([['apple', 2]]))
+            return totals
+
+        _, totals = self._serve(client, [MultiBuyOffer('strawberries', 1, 1)], store)
+        self.assertEqual(totals[-1], Decimal('0.30'))
+        self.assertEqual(store.batches, [{'apple', 'ice cream'}])
+
+    def test_socket_requests(self):
+        '''Requests over the socket are answered in order, with errors for
+        unknown products and malformed requests.'''
+
+        async def client(service, path):
+            reader, writer = await asyncio.open_unix_connection(path)
+            writer.write(b'{"id": 1, "lines": [["apple", 2], ["ice cream", 1]]}\n')
+            writer.write(b'{"id": 2, "lines": [["bike", 1]]}\n')
+            writer.write(b'not json\n')
+            writer.write(b'[1, 2]\n')
+            writer.write(b'{"id": 3, "lines": [["apple", 1]]}\n')
+            await writer.drain()
+            responses = [await reader.readline() for _ in range(5)]
+            writer.close()
+            return [json.loads(response) for response in responses]
+
+        _, responses = self._serve(client)
+        self.assertEqual(responses[0], {'id': 1, 'total': '3.79'})
+        self.assertEqual(responses[1]['id'], 2)
+        self.assertIn('bike', responses[1]['error'])
+        self.assertIn('Bad request', responses[2]['error'])
+        self.assertIn('Bad request', responses[3]['error'])
+        self.assertEqual(responses[4], {'id': 3, 'total': '0.15'})
+
+    def test_load_test(self):
+        '''run_load_test reports throughput and latency percentiles.'''
+        carts = [[['apple', 1]], [['strawberries', 2], ['snickers bar', 1]]]
+
+        async def client(service, path):
+            return await run_load_test(carts, requests=50, concurrency=5, path=path)
+
+        _, report = self._serve(client)
+        self.assertEqual(report['requests'], 50)
+        self.assertGreater(report['throughput'], 0)
+        self.assertLessEqual(report['p50'], report['p99'])
+
+
+class MinorUnitPricingTableTest(unittest.TestCase):
+
+    '''Tests for pricing in integer minor units.'''
+
+    def _create_product_store(self):
+        '''Helper method to create populated ProductStore.'''
+        products = [
+            ('apple', Decimal('0.15')),
+            ('ice cream', Decimal('3.49')),
+            ('strawberries', Decimal('2.00')),
+            ('snickers bar', Decimal('0.70')),
+            ('mars bar', Decimal('0.65'))
+        ]
+        return ProductStore(products)
+
+    def _create_offers(self):
+        '''Helper method to create a list of offers whose line totals are
+        whole numbers of minor units.'''
+        return [
+            MultiBuyOffer('strawberries', 1, 1),
+            DependentDiscountOffer('strawberries', 'apple', Decimal('0.2')),
+            MultiBuyOffer('apple', 2, 1),
+            DependentDiscountOffer('mars bar', ('snickers bar', 'apple'), Decimal('0.2')),
+            NoOffer('ice cream'),
+            MultiBuyOffer('bike', 1, 1),
+        ]
+
+    def test_totals_match_get_total(self):
+        '''Integer totals match Cart.get_total, for every kind of
+        store.'''
+        offers = self._create_offers()
+        product_store = self._create_product_store()
+        compact_store = CompactProductStore(product_store.items)
+        for store in (product_store, compact_store):
+            pricing_table = MinorUnitPricingTable(offers, store)
+            for quantity in range(1, 8):
+                cart = Cart(store)
+                cart.add('strawberries', quantity)
+                cart.add('apple', quantity % 3)
+                cart.add('mars bar', quantity)
+                cart.add('snickers bar', quantity % 4)
+                cart.add('ice cream')
+                self.assertEqual(pricing_table.get_total(cart), cart.get_total(offers))
+                self.assertEqual(pricing_table.get_total_minor_units(cart),
+                                 to_minor_units(cart.get_total(offers)))
+
+    def test_rounding(self):
+        '''Line totals that aren't whole minor units are rounded with the
+        table's rounding mode.'''
+        product_store = self._create_product_store()
+        # 15% off three 0.15 apples is 0.3825.
+        offers = [DependentDiscountOffer('apple', 'ice cream', Decimal('0.15'))]
+        cart = Cart(product_store)
+        cart.add('apple', 3)
+        cart.add('ice cream', 3)
+        self.assertEqual(cart.get_total(offers), Decimal('10.8525'))
+        for rounding, total in ((ROUND_HALF_UP, Decimal('10.85')),
+                                (ROUND_FLOOR, Decimal('10.85')),
+                                (ROUND_CEILING, Decimal('10.86'))):
+            self.assertEqual(
+                MinorUnitPricingTable(offers, product_store, rounding=rounding).get_total(cart),
+                total)
+        # 15% off six apples is 0.765.
+        cart.add('apple', 3)
+        cart.add('ice cream', 3)
+        self.assertEqual(MinorUnitPricingTable(
+            offers, product_store, rounding=ROUND_HALF_UP).get_total(cart), Decimal('21.71'))
+        self.assertEqual(MinorUnitPricingTable(
+            offers, product_store, rounding=ROUND_HALF_EVEN).get_total(cart), Decimal('21.70'))
+
+    def test_uncompiled_offer(self):
+        '''Offers without integer pricing have their Decimal totals
+        rounded.'''
+        product_store = self._create_product_store()
+        cart = Cart(product_store)
+        cart.add('apple', 3)
+        self.assertEqual(
+            MinorUnitPricingTable([HalfPriceOffer('apple')], product_store).get_total(cart),
+            Decimal('0.23'))